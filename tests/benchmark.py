@@ -0,0 +1,478 @@
+"""
+Synthetic-scale benchmark for the rule processor.
+
+A synthetic directory and Adobe org are generated at each of the requested sizes, and a full
+RuleProcessor.run is done against UMAPI connectors whose connection is simulated locally, with
+paging, latency and throttling.  The wall time, peak RSS and throughput of each phase
+(directory load, UMAPI load, diff, execute) are reported.
+
+Run from the root of the repository, for example:
+
+    PYTHONPATH=. python tests/benchmark.py --users 1000,10000,100000 --latency 0.05 -o shard_count=4
+"""
+
+import logging
+import random
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import click
+import psutil
+import six
+import yaml
+
+from user_sync.connector.helper import create_blank_user
+from user_sync.connector.umapi import ActionManager, UmapiConnector
+from user_sync.rules import AdobeGroup, RuleProcessor, UmapiConnectors
+
+PHASES = ('directory load', 'umapi load', 'diff', 'execute')
+
+
+class PhaseRecorder(object):
+    """
+    Accumulates the wall time of each phase, and samples the RSS of the process on a
+    background thread to find the peak of each phase.  The RSS includes that of any worker
+    processes, such as those of sharded syncs.  Phases don't nest: a phase that
+    starts while another is under way (e.g. on a worker thread) is counted in the outer one.
+    """
+
+    def __init__(self, phases=PHASES, sample_interval=0.02):
+        self.process = psutil.Process()
+        self.sample_interval = sample_interval
+        self.seconds = OrderedDict((phase, 0.0) for phase in phases)
+        self.peak_rss = OrderedDict((phase, 0) for phase in phases)
+        self.current_phase = None
+        self.stopped = threading.Event()
+        self.sampler = threading.Thread(target=self.sample_rss)
+        self.sampler.daemon = True
+        self.sampler.start()
+
+    def sample_rss(self):
+        while not self.stopped.wait(self.sample_interval):
+            self.record_rss()
+
+    def record_rss(self):
+        phase = self.current_phase
+        if phase is not None:
+            rss = self.process.memory_info().rss
+            for child in self.process.children(recursive=True):
+                try:
+                    rss += child.memory_info().rss
+                except psutil.Error:
+                    pass
+            self.peak_rss[phase] = max(self.peak_rss[phase], rss)
+
+    @contextmanager
+    def phase(self, phase):
+        if self.current_phase is not None:
+            yield
+            return
+        self.current_phase = phase
+        self.record_rss()
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.seconds[phase] += time.time() - start_time
+            self.record_rss()
+            self.current_phase = None
+
+    def stop(self):
+        self.stopped.set()
+        self.sampler.join()
+
+
+class InstrumentedRuleProcessor(RuleProcessor):
+    """
+    A rule processor that records each phase of its run.  The Adobe users are downloaded
+    in full before the diff starts, so that loading and matching can be timed apart.
+    """
+
+    def __init__(self, caller_options, recorder):
+        """
+        :type caller_options: dict
+        :type recorder: PhaseRecorder
+        """
+        super(InstrumentedRuleProcessor, self).__init__(caller_options)
+        self.recorder = recorder
+
+    def __getstate__(self):
+        # shards run in other processes, where there is nothing to record
+        state = super(InstrumentedRuleProcessor, self).__getstate__()
+        state['recorder'] = None
+        return state
+
+    def read_desired_user_groups(self, mappings, directory_connector):
+        with self.recorder.phase('directory load'):
+            super(InstrumentedRuleProcessor, self).read_desired_user_groups(mappings, directory_connector)
+
+    def load_umapi_users(self, umapi_connectors):
+        with self.recorder.phase('umapi load'):
+            connectors = self.get_targeted_umapi_connectors(umapi_connectors)
+            self.prefetch_umapi_users(connectors, len(connectors))
+            for umapi_name, _ in connectors:
+                self.umapi_user_prefetch[umapi_name].result()
+
+    def sync_umapi_users(self, umapi_connectors):
+        if self.recorder is None:
+            return super(InstrumentedRuleProcessor, self).sync_umapi_users(umapi_connectors)
+        self.load_umapi_users(umapi_connectors)
+        with self.recorder.phase('diff'):
+            return super(InstrumentedRuleProcessor, self).sync_umapi_users(umapi_connectors)
+
+    def create_shards(self, umapi_connectors):
+        self.load_umapi_users(umapi_connectors)
+        with self.recorder.phase('diff'):
+            return super(InstrumentedRuleProcessor, self).create_shards(umapi_connectors)
+
+    def send_shards(self, connections, shard_args, umapi_connectors):
+        with self.recorder.phase('diff'):
+            super(InstrumentedRuleProcessor, self).send_shards(connections, shard_args, umapi_connectors)
+
+    def merge_shard_matches(self, connections):
+        # the shards match their users while this waits for them
+        with self.recorder.phase('diff'):
+            super(InstrumentedRuleProcessor, self).merge_shard_matches(connections)
+
+    def merge_shard_executions(self, connections):
+        # the shards send their commands while this waits for them
+        with self.recorder.phase('execute'):
+            super(InstrumentedRuleProcessor, self).merge_shard_executions(connections)
+
+    def process_strays(self, primary_commands, secondary_command_lists, umapi_connectors):
+        with self.phase('diff'):
+            return super(InstrumentedRuleProcessor, self).process_strays(primary_commands, secondary_command_lists,
+                                                                         umapi_connectors)
+
+    def execute_secondary_commands(self, secondary_command_lists, umapi_connectors):
+        with self.phase('execute'):
+            super(InstrumentedRuleProcessor, self).execute_secondary_commands(secondary_command_lists,
+                                                                              umapi_connectors)
+
+    def execute_commands(self, command_list, connector, sync_started=False):
+        with self.phase('execute'):
+            super(InstrumentedRuleProcessor, self).execute_commands(command_list, connector, sync_started)
+
+    def phase(self, phase):
+        return record_phase(self.recorder, phase)
+
+
+class InstrumentedUmapiConnectors(UmapiConnectors):
+    def __init__(self, primary_connector, secondary_connectors, recorder):
+        super(InstrumentedUmapiConnectors, self).__init__(primary_connector, secondary_connectors)
+        self.recorder = recorder
+
+    def __getstate__(self):
+        # shards run in other processes, where there is nothing to record
+        state = self.__dict__.copy()
+        state['recorder'] = None
+        return state
+
+    def execute_actions(self):
+        with record_phase(self.recorder, 'execute'):
+            super(InstrumentedUmapiConnectors, self).execute_actions()
+
+
+@contextmanager
+def record_phase(recorder, phase):
+    """
+    :param recorder: None in shard processes
+    :type recorder: PhaseRecorder
+    :type phase: str
+    """
+    if recorder is None:
+        yield
+    else:
+        with recorder.phase(phase):
+            yield
+
+
+class SimulatedConnection(object):
+    """
+    Stands in for umapi_client.Connection.  Users are served in pages, and every request
+    waits for the given latency.  A throttled request waits retry_after seconds more, the
+    way the client waits out a 429 response before trying again.
+    """
+
+    def __init__(self, users, page_size=200, latency=0.0, throttle_rate=0.0, retry_after=0.0, seed=0):
+        """
+        :type users: list(dict)
+        :type page_size: int
+        :param latency: seconds per request
+        :type latency: float
+        :param throttle_rate: fraction of requests that are throttled
+        :type throttle_rate: float
+        :type retry_after: float
+        :type seed: int
+        """
+        self.users = users
+        self.page_size = page_size
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.request_count = 0
+        self.throttled_count = 0
+        self.action_count = 0
+        self.sync_started = self.sync_ended = False
+
+    def __getstate__(self):
+        # each shard process gets a copy, that counts its own requests.  Shards don't list the users.
+        state = self.__dict__.copy()
+        del state['lock']
+        state['users'] = []
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def wait_for_response(self):
+        with self.lock:
+            self.request_count += 1
+            throttled = self.random.random() < self.throttle_rate
+            if throttled:
+                self.throttled_count += 1
+        delay = self.latency + (self.retry_after + self.latency if throttled else 0)
+        if delay:
+            time.sleep(delay)
+
+    def query_multiple(self, object_type, page=0, url_params=None, query_params=None):
+        self.wait_for_response()
+        page_count = max((len(self.users) + self.page_size - 1) // self.page_size, 1)
+        values = self.users[page * self.page_size:(page + 1) * self.page_size]
+        return values, page >= page_count - 1, len(self.users), page_count, page + 1, self.page_size
+
+    def execute_multiple(self, actions, immediate=True):
+        self.wait_for_response()
+        with self.lock:
+            self.action_count += len(actions)
+            self.sync_started = self.sync_ended = False
+        return 0, len(actions), len(actions)
+
+    def execute_single(self, action, immediate=False):
+        return self.execute_multiple([action], immediate)
+
+    def start_sync(self):
+        self.sync_started = True
+
+    def end_sync(self):
+        self.sync_ended = True
+
+
+class SimulatedUmapiConnector(UmapiConnector):
+    """
+    A UmapiConnector that talks to the given connection, without authenticating
+    """
+
+    def __init__(self, name, connection, server_options=None):
+        """
+        :type name: str
+        :type connection: SimulatedConnection
+        :type server_options: dict
+        """
+        self.init_args = (name, connection, server_options)
+        options = {'batch_size': 10, 'flush_interval': 0, 'concurrent_requests': 1, 'page_fetch_workers': 1,
+                   'page_fetch_ordered': True}
+        options.update(server_options or {})
+        self.name = 'umapi' + name
+        self.trusted = False
+        self.options = {'server': options, 'test_mode': False}
+        self.logger = logging.getLogger(self.name)
+        self.org_id = self.name
+        self.connection = connection
+        self.action_manager = ActionManager(connection, self.org_id, self.logger,
+                                            batch_size=options['batch_size'],
+                                            flush_interval=options['flush_interval'],
+                                            concurrent_requests=options['concurrent_requests'],
+                                            connection_factory=lambda: connection)
+
+
+class SyntheticDirectory(object):
+    """
+    Stands in for a directory connector, with users spread at random over the groups
+    """
+
+    def __init__(self, user_count, group_count=20, groups_per_user=3, seed=0):
+        """
+        :type user_count: int
+        :type group_count: int
+        :type groups_per_user: int
+        :type seed: int
+        """
+        rng = random.Random(seed)
+        self.group_names = ['Directory Group %d' % i for i in range(group_count)]
+        self.users = []
+        for i in range(user_count):
+            user = create_blank_user()
+            name = 'user%07d' % i
+            user.update({'identity_type': 'federatedID', 'username': name + '@example.com',
+                         'domain': 'example.com', 'email': name + '@example.com', 'firstname': name,
+                         'lastname': 'User', 'country': 'US', 'source_attributes': {},
+                         'groups': rng.sample(self.group_names, min(groups_per_user, group_count))})
+            self.users.append(user)
+
+    def get_mappings(self):
+        """
+        :return: each directory group is mapped to an Adobe group of the same number
+        :rtype: dict(str, list(AdobeGroup))
+        """
+        return dict((group_name, [AdobeGroup.create(group_name.replace('Directory', 'Adobe'))])
+                    for group_name in self.group_names)
+
+    def load_users_and_groups(self, groups, extended_attributes, all_users):
+        return iter(self.users)
+
+
+def make_adobe_users(directory, drift_rate=0.05, stray_rate=0.01, seed=0):
+    """
+    The users of an Adobe org that was synced with the directory, and has drifted from it since.
+    A drifted user is either missing from the org, has had a group changed, or has had their
+    name changed.  Adobe-only users are added on top of that.
+    :type directory: SyntheticDirectory
+    :param drift_rate: fraction of directory users that differ in the org
+    :type drift_rate: float
+    :param stray_rate: number of Adobe-only users, as a fraction of the directory users
+    :type stray_rate: float
+    :type seed: int
+    :rtype: list(dict)
+    """
+    rng = random.Random(seed)
+    adobe_groups = [group_name.replace('Directory', 'Adobe') for group_name in directory.group_names]
+    users = []
+    for directory_user in directory.users:
+        user = {'type': directory_user['identity_type'], 'username': directory_user['username'],
+                'domain': directory_user['domain'], 'email': directory_user['email'],
+                'firstname': directory_user['firstname'], 'lastname': directory_user['lastname'],
+                'country': directory_user['country'], 'status': 'active',
+                'groups': [group_name.replace('Directory', 'Adobe') for group_name in directory_user['groups']]}
+        if rng.random() < drift_rate:
+            drift = rng.choice(('missing', 'groups', 'attributes'))
+            if drift == 'missing':
+                continue
+            if drift == 'groups':
+                user['groups'] = user['groups'][1:] + [rng.choice(adobe_groups)]
+            else:
+                user['lastname'] = 'Changed'
+        users.append(user)
+    for i in range(int(len(directory.users) * stray_rate)):
+        name = 'stray%07d' % i
+        users.append({'type': 'federatedID', 'username': name + '@example.com', 'domain': 'example.com',
+                      'email': name + '@example.com', 'firstname': name, 'lastname': 'User', 'country': 'US',
+                      'status': 'active', 'groups': [rng.choice(adobe_groups)]})
+    return users
+
+
+def run_benchmark(user_count, group_count=20, groups_per_user=3, drift_rate=0.05, stray_rate=0.01,
+                  page_size=200, latency=0.0, throttle_rate=0.0, retry_after=0.0, seed=0,
+                  rule_options=None, server_options=None):
+    """
+    Sync a synthetic directory of the given size with a simulated Adobe org
+    :param rule_options: options for the rule processor, over the benchmark's defaults
+    :type rule_options: dict
+    :param server_options: server options for the umapi connector, e.g. batch_size or concurrent_requests
+    :type server_options: dict
+    :return: the results of the run, see report_results
+    :rtype: dict
+    """
+    AdobeGroup.index_map.clear()
+    directory = SyntheticDirectory(user_count, group_count, groups_per_user, seed)
+    adobe_users = make_adobe_users(directory, drift_rate, stray_rate, seed)
+    connection = SimulatedConnection(adobe_users, page_size, latency, throttle_rate, retry_after, seed)
+    recorder = PhaseRecorder()
+    options = {'exclude_unmapped_users': False, 'max_adobe_only_users': len(adobe_users),
+               'process_groups': True, 'remove_strays': True, 'update_user_info': True}
+    options.update(rule_options or {})
+    processor = InstrumentedRuleProcessor(options, recorder)
+    umapi_connectors = InstrumentedUmapiConnectors(SimulatedUmapiConnector('', connection, server_options), {},
+                                                   recorder)
+    start_time = time.time()
+    try:
+        processor.run(directory.get_mappings(), directory, umapi_connectors)
+    finally:
+        recorder.stop()
+    counts = OrderedDict([
+        ('directory load', len(processor.directory_user_by_user_key)),
+        ('umapi load', len(adobe_users)),
+        ('diff', processor.primary_user_count),
+        ('execute', processor.get_action_statistics(umapi_connectors.get_primary_connector())[0]),
+    ])
+    return {
+        'user_count': user_count,
+        'total_seconds': time.time() - start_time,
+        'phases': OrderedDict((phase, {'seconds': recorder.seconds[phase],
+                                       'peak_rss': recorder.peak_rss[phase],
+                                       'count': counts[phase]})
+                              for phase in PHASES),
+        # in a sharded sync, the shards send their actions on copies of the connection, so this is
+        # only the requests of the main process, which downloads the users
+        'request_count': connection.request_count,
+        'throttled_count': connection.throttled_count,
+        'action_summary': processor.action_summary,
+    }
+
+
+def report_results(results):
+    """
+    :type results: dict
+    :rtype: list(str)
+    """
+    lines = ['%d users: %.2fs, %d requests (%d throttled)' % (results['user_count'], results['total_seconds'],
+                                                              results['request_count'],
+                                                              results['throttled_count'])]
+    lines.append('  %-15s %10s %12s %10s %12s' % ('phase', 'seconds', 'peak RSS MB', 'items', 'items/s'))
+    for phase, result in six.iteritems(results['phases']):
+        rate = result['count'] / result['seconds'] if result['seconds'] else 0
+        lines.append('  %-15s %10.3f %12.1f %10d %12.0f' % (phase, result['seconds'],
+                                                            result['peak_rss'] / 1024.0 / 1024.0,
+                                                            result['count'], rate))
+    return lines
+
+
+def parse_options(values):
+    """
+    :param values: options given as name=value, where the value is YAML
+    :type values: list(str)
+    :rtype: dict
+    """
+    options = {}
+    for value in values:
+        name, _, text = value.partition('=')
+        options[name.strip()] = yaml.safe_load(text)
+    return options
+
+
+@click.command()
+@click.option('--users', default='1000,10000,100000,1000000', show_default=True,
+              help='comma-separated directory sizes to benchmark')
+@click.option('--group-count', default=20, show_default=True, help='number of mapped groups')
+@click.option('--groups-per-user', default=3, show_default=True)
+@click.option('--drift-rate', default=0.05, show_default=True, help='fraction of users that differ in Adobe')
+@click.option('--stray-rate', default=0.01, show_default=True, help='Adobe-only users, as a fraction of users')
+@click.option('--page-size', default=200, show_default=True)
+@click.option('--latency', default=0.0, show_default=True, help='seconds per UMAPI request')
+@click.option('--throttle-rate', default=0.0, show_default=True, help='fraction of requests answered with 429')
+@click.option('--retry-after', default=1.0, show_default=True, help='seconds to wait after a 429')
+@click.option('--seed', default=0, show_default=True)
+@click.option('-o', '--option', 'rule_options', multiple=True, metavar='NAME=VALUE',
+              help='rule processor option, e.g. shard_count=4')
+@click.option('-s', '--server-option', 'server_options', multiple=True, metavar='NAME=VALUE',
+              help='umapi server option, e.g. concurrent_requests=4')
+def main(users, group_count, groups_per_user, drift_rate, stray_rate, page_size, latency, throttle_rate,
+         retry_after, seed, rule_options, server_options):
+    """Benchmark the rule processor against synthetic directories and Adobe orgs"""
+    logging.Logger.progress = lambda self, *args, **kwargs: None
+    logging.basicConfig(level=logging.WARNING)
+    for user_count in users.split(','):
+        results = run_benchmark(int(user_count), group_count, groups_per_user, drift_rate, stray_rate, page_size,
+                                latency, throttle_rate, retry_after, seed, parse_options(rule_options),
+                                parse_options(server_options))
+        for line in report_results(results):
+            click.echo(line)
+
+
+if __name__ == '__main__':
+    main()
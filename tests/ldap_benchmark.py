@@ -0,0 +1,309 @@
+"""
+Offline benchmark for the LDAP directory connector.
+
+A synthetic directory of users and groups, with nested groups and large member attributes,
+is loaded into an ldap3 mock server, and LDAPDirectoryConnector.load_users_and_groups is run
+against it in each of its modes.  The number of searches (counting each page), the entries the
+server returned per second and the peak RSS of each mode are reported.  The mock server is much
+slower than a real one, so the search counts are what to compare between versions.  A latency can
+be added to each search, to see the effect of a connection pool, and the values of large member
+attributes can be returned a range at a time, as Active Directory does.
+
+Run from the root of the repository, for example:
+
+    PYTHONPATH=. python tests/ldap_benchmark.py --users 1000,5000 --mode "two steps nested"
+"""
+
+import logging
+import random
+import time
+from collections import Counter, OrderedDict
+
+import click
+import ldap3
+import six
+
+from benchmark import PhaseRecorder
+from user_sync.connector.directory_ldap import LDAPDirectoryConnector
+
+BASE_DN = 'dc=example,dc=com'
+
+# the connector options and load arguments for each mode
+MODES = OrderedDict([
+    ('group filter', {'all_users': False}),
+    ('all users', {'all_users': True}),
+    ('pipelined groups', {'all_users': False, 'options': {'pipeline_user_load': True}}),
+    ('two steps', {'all_users': False,
+                   'options': {'two_steps_lookup': {'group_member_attribute_name': 'member'}}}),
+    ('two steps nested', {'all_users': False,
+                          'options': {'two_steps_lookup': {'group_member_attribute_name': 'member',
+                                                           'nested_group': True}}}),
+    ('two steps batched', {'all_users': False,
+                           'options': {'two_steps_lookup': {'group_member_attribute_name': 'member',
+                                                            'dn_batch_size': 200}}}),
+    ('dynamic memberOf', {'all_users': True, 'additional_group_filters': True,
+                          'options': {'dynamic_group_member_attribute': 'memberOf'}}),
+])
+
+
+class SyntheticLDAPDirectory(object):
+    """
+    The entries of a directory in which each user is a member of a few groups, and each parent
+    group has some of the groups as members.  Memberships are kept in both the member attribute
+    of the groups and the memberOf attribute of the users, as in Active Directory.
+    """
+
+    def __init__(self, user_count, group_count=20, groups_per_user=3, parent_group_count=4, seed=0):
+        """
+        :type user_count: int
+        :type group_count: int
+        :type groups_per_user: int
+        :param parent_group_count: number of groups whose members are groups
+        :type parent_group_count: int
+        :type seed: int
+        """
+        rng = random.Random(seed)
+        self.group_names = ['Group %d' % i for i in range(group_count)]
+        self.parent_group_names = ['Parent Group %d' % i for i in range(parent_group_count)]
+        members_by_group = OrderedDict((group_name, []) for group_name in self.group_names + self.parent_group_names)
+        self.user_entries = []
+        for i in range(user_count):
+            dn = 'cn=user%07d,ou=users,%s' % (i, BASE_DN)
+            group_dns = [self.get_group_dn(group_name)
+                         for group_name in rng.sample(self.group_names, min(groups_per_user, group_count))]
+            for group_dn in group_dns:
+                members_by_group[ldap3.utils.dn.safe_rdn(group_dn)[0][3:]].append(dn)
+            self.user_entries.append((dn, {'objectClass': ['top', 'person', 'user'], 'distinguishedName': dn,
+                                           'cn': 'user%07d' % i,
+                                           'mail': 'user%07d@example.com' % i, 'givenName': 'User',
+                                           'sn': '%07d' % i, 'c': 'US', 'memberOf': group_dns}))
+        for index, group_name in enumerate(self.group_names):
+            if self.parent_group_names:
+                parent_group_name = self.parent_group_names[index % len(self.parent_group_names)]
+                members_by_group[parent_group_name].append(self.get_group_dn(group_name))
+        self.group_entries = [(self.get_group_dn(group_name), {'objectClass': ['top', 'group'], 'cn': group_name,
+                                                               'distinguishedName': self.get_group_dn(group_name),
+                                                               'member': members})
+                              for group_name, members in six.iteritems(members_by_group)]
+
+    @staticmethod
+    def get_group_dn(group_name):
+        return 'cn=%s,ou=groups,%s' % (group_name, BASE_DN)
+
+    def get_group_names(self):
+        """
+        :return: the names of all the groups, as they would be given in the group mappings
+        :rtype: list(str)
+        """
+        return self.group_names + self.parent_group_names
+
+    def add_entries(self, connection):
+        """
+        :type connection: ldap3.Connection
+        """
+        connection.strategy.add_entry(BASE_DN, {'objectClass': ['top', 'domain'], 'dc': 'example'})
+        for dn, attributes in self.group_entries + self.user_entries:
+            connection.strategy.add_entry(dn, attributes)
+
+
+class CountingConnection(ldap3.Connection):
+    """
+    A connection that counts the searches it does, also by filter, and the entries they return.
+    Each page of a paged search is a search of its own, and each search takes at least the latency.
+    If a max_value_range is given, the member attribute is returned at most that many values at a time,
+    like member;range=0-1499, as Active Directory does with MaxValRange.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.latency = kwargs.pop('latency', 0)
+        self.max_value_range = kwargs.pop('max_value_range', 0)
+        super(CountingConnection, self).__init__(*args, **kwargs)
+        self.search_count = 0
+        self.search_count_by_filter = Counter()
+        self.entry_count = 0
+
+    def search(self, *args, **kwargs):
+        self.search_count += 1
+        self.search_count_by_filter[kwargs['search_filter'] if 'search_filter' in kwargs else args[1]] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        range_start = None
+        if self.max_value_range and kwargs.get('attributes'):
+            attributes = kwargs['attributes']
+            attributes = [attributes] if isinstance(attributes, six.string_types) else list(attributes)
+            for index, attribute in enumerate(attributes):
+                name, _, value_range = attribute.partition(';range=')
+                if name.lower() == 'member':
+                    range_start = int(value_range.partition('-')[0]) if value_range else 0
+                    attributes[index] = name
+            kwargs['attributes'] = attributes
+        result = super(CountingConnection, self).search(*args, **kwargs)
+        if range_start is not None:
+            for entry in self.response or []:
+                if entry['type'] == 'searchResEntry':
+                    self.select_member_range(entry, range_start)
+        self.entry_count += sum(1 for entry in self.response or [] if entry['type'] == 'searchResEntry')
+        return result
+
+    def select_member_range(self, entry, range_start):
+        """
+        Replace the member attribute of a search result entry with the range of its values that the server returns
+        :type entry: dict
+        :type range_start: int
+        """
+        values = entry['attributes'].pop('member', [])
+        entry['raw_attributes'].pop('member', None)
+        if range_start == 0 and len(values) <= self.max_value_range:
+            entry['attributes']['member'] = entry['raw_attributes']['member'] = values
+            return
+        range_values = values[range_start:range_start + self.max_value_range]
+        if range_start + self.max_value_range >= len(values):
+            name = 'member;range=%d-*' % range_start
+        else:
+            name = 'member;range=%d-%d' % (range_start, range_start + len(range_values) - 1)
+        entry['attributes'][name] = entry['raw_attributes'][name] = range_values
+
+
+class MockLDAPDirectoryConnector(LDAPDirectoryConnector):
+    """
+    An LDAP connector connected to ldap3 mock servers that hold the given directory, one for each connection
+    """
+
+    def __init__(self, caller_options, directory, latency=0, max_value_range=0):
+        """
+        :type caller_options: dict
+        :type directory: SyntheticLDAPDirectory
+        :param latency: seconds added to each search
+        :type latency: float
+        :param max_value_range: the most member values returned at a time, if not 0
+        :type max_value_range: int
+        """
+        self.directory = directory
+        self.latency = latency
+        self.max_value_range = max_value_range
+        self.server = None
+        super(MockLDAPDirectoryConnector, self).__init__(caller_options)
+
+    def create_connection(self, server, connection_class, **connection_args):
+        # the server the connector would have connected to
+        self.server = server
+        connection_args['auto_bind'] = ldap3.AUTO_BIND_NONE
+        connection = CountingConnection(ldap3.Server('mock'), client_strategy=ldap3.MOCK_SYNC, latency=self.latency,
+                                        max_value_range=self.max_value_range, **connection_args)
+        self.directory.add_entries(connection)
+        connection.bind()
+        return connection
+
+    def get_highest_committed_usn(self):
+        # the mock server has no root DSE, so this is the highest uSNChanged in the directory
+        usns = [0]
+        for _, attributes in self.directory.user_entries:
+            usn = attributes.get('uSNChanged', 0)
+            usns.append(int(usn[0] if isinstance(usn, list) else usn))
+        return str(max(usns))
+
+
+def make_connector(directory, mode, latency=0, max_value_range=0, **options):
+    """
+    :type directory: SyntheticLDAPDirectory
+    :param mode: one of the MODES
+    :type mode: str
+    :param latency: seconds added to each search
+    :type latency: float
+    :param max_value_range: the most member values returned at a time, if not 0
+    :type max_value_range: int
+    :param options: more connector options
+    :rtype: MockLDAPDirectoryConnector
+    """
+    caller_options = {
+        'host': 'mock',
+        'base_dn': BASE_DN,
+        'all_users_filter': '(objectClass=person)',
+        'group_filter_format': '(&(objectClass=group)(cn={group}))',
+    }
+    caller_options.update(MODES[mode].get('options', {}))
+    caller_options.update(options)
+    connector = MockLDAPDirectoryConnector(caller_options, directory, latency, max_value_range)
+    if MODES[mode].get('additional_group_filters'):
+        connector.additional_group_filters = ['^Group']
+    return connector
+
+
+def run_ldap_benchmark(directory, mode, latency=0, max_value_range=0, **options):
+    """
+    Load the users and groups of the directory in the given mode
+    :type directory: SyntheticLDAPDirectory
+    :type mode: str
+    :param latency: seconds added to each search
+    :type latency: float
+    :param max_value_range: the most member values returned at a time, if not 0
+    :type max_value_range: int
+    :param options: more connector options
+    :return: the results of the load, see report_results
+    :rtype: dict
+    """
+    connector = make_connector(directory, mode, latency, max_value_range, **options)
+    # the searches done to connect don't count
+    for connection in connector.connections:
+        connection.search_count = connection.entry_count = 0
+    recorder = PhaseRecorder(phases=[mode])
+    try:
+        with recorder.phase(mode):
+            users = list(connector.load_users_and_groups(directory.get_group_names(), [], MODES[mode]['all_users']))
+    finally:
+        recorder.stop()
+    return {
+        'mode': mode,
+        'seconds': recorder.seconds[mode],
+        'peak_rss': recorder.peak_rss[mode],
+        'search_count': sum(connection.search_count for connection in connector.connections),
+        'entry_count': sum(connection.entry_count for connection in connector.connections),
+        'user_count': len(users),
+        'membership_count': sum(len(user['groups']) for user in users),
+    }
+
+
+def report_results(results):
+    """
+    :type results: list(dict)
+    :rtype: list(str)
+    """
+    lines = ['  %-18s %9s %9s %10s %10s %8s %12s' % ('mode', 'seconds', 'searches', 'entries', 'entries/s',
+                                                     'users', 'peak RSS MB')]
+    for result in results:
+        rate = result['entry_count'] / result['seconds'] if result['seconds'] else 0
+        lines.append('  %-18s %9.3f %9d %10d %10.0f %8d %12.1f' % (
+            result['mode'], result['seconds'], result['search_count'], result['entry_count'], rate,
+            result['user_count'], result['peak_rss'] / 1024.0 / 1024.0))
+    return lines
+
+
+@click.command()
+@click.option('--users', default='1000,10000', show_default=True, help='comma-separated directory sizes')
+@click.option('--group-count', default=20, show_default=True)
+@click.option('--groups-per-user', default=3, show_default=True)
+@click.option('--parent-group-count', default=4, show_default=True, help='number of groups of groups')
+@click.option('--page-size', default=200, show_default=True, help='search_page_size of the connector')
+@click.option('--pool-size', default=1, show_default=True, help='connection_pool_size of the connector')
+@click.option('--latency', default=0.0, show_default=True, help='seconds added to each search')
+@click.option('--max-value-range', default=0, show_default=True,
+              help='most member values returned at a time, like MaxValRange in AD (0 for all)')
+@click.option('--mode', 'modes', multiple=True, type=click.Choice(list(MODES)),
+              help='mode to benchmark (default all)')
+@click.option('--seed', default=0, show_default=True)
+def main(users, group_count, groups_per_user, parent_group_count, page_size, pool_size, latency, max_value_range,
+         modes, seed):
+    """Benchmark the LDAP connector against a synthetic mock directory"""
+    logging.basicConfig(level=logging.WARNING)
+    for user_count in users.split(','):
+        directory = SyntheticLDAPDirectory(int(user_count), group_count, groups_per_user, parent_group_count, seed)
+        results = [run_ldap_benchmark(directory, mode, latency, max_value_range, search_page_size=page_size,
+                                      connection_pool_size=pool_size)
+                   for mode in modes or MODES]
+        click.echo('%s users, %d groups' % (user_count, len(directory.get_group_names())))
+        for line in report_results(results):
+            click.echo(line)
+
+
+if __name__ == '__main__':
+    main()
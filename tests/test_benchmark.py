@@ -0,0 +1,38 @@
+import logging
+
+import pytest
+
+from benchmark import PHASES, SimulatedConnection, report_results, run_benchmark
+
+
+@pytest.fixture(autouse=True)
+def progress_logging(monkeypatch):
+    # progress logging is installed by the app at startup
+    monkeypatch.setattr(logging.Logger, 'progress', lambda *args, **kwargs: None, raising=False)
+
+
+def test_simulated_paging_and_throttling():
+    connection = SimulatedConnection([{'email': 'user%d@example.com' % i} for i in range(25)], page_size=10,
+                                     throttle_rate=1.0)
+    values, last_page, total, page_count, _, _ = connection.query_multiple('user', 2)
+    assert [u['email'] for u in values] == ['user%d@example.com' % i for i in range(20, 25)]
+    assert last_page and total == 25 and page_count == 3
+    assert connection.execute_multiple([object(), object()]) == (0, 2, 2)
+    assert (connection.request_count, connection.throttled_count, connection.action_count) == (2, 2, 2)
+
+
+@pytest.mark.parametrize('rule_options', [{}, {'shard_count': 2}])
+def test_benchmark_smoke(rule_options):
+    results = run_benchmark(200, drift_rate=0.2, stray_rate=0.05, page_size=50, throttle_rate=0.1,
+                            rule_options=rule_options, server_options={'concurrent_requests': 2})
+    phases = results['phases']
+    assert list(phases) == list(PHASES)
+    assert phases['directory load']['count'] == 200
+    assert all(phase['seconds'] >= 0 and phase['peak_rss'] > 0 for phase in phases.values())
+    summary = results['action_summary']
+    assert summary['primary_users_created'] > 0
+    assert summary['primary_strays_processed'] == 10
+    # every created, updated and removed user is one action
+    assert phases['execute']['count'] == (summary['primary_users_created'] + summary['updated_user_count'] +
+                                          summary['primary_strays_processed'])
+    assert len(report_results(results)) == len(PHASES) + 2
@@ -234,3 +234,15 @@ def test_shell_exec_flag(tmp_config_files, modify_root_config, cli_args, monkeyp
             directory_connector = DirectoryConnector(directory_connector_module)
             with pytest.raises(AssertionException):
                 config_loader.get_directory_connector_options(directory_connector.name)
+
+
+@pytest.mark.parametrize('performance_section', ['', 'performance:\n'])
+def test_incremental_default_state_file(tmp_config_files, cli_args, performance_section):
+    """Test that --incremental gets the default state file with no performance settings"""
+    (root_config_file, _, _) = tmp_config_files
+    with open(root_config_file, 'a') as f:
+        f.write(performance_section)
+
+    options = ConfigLoader(cli_args({'config_filename': root_config_file, 'incremental': True})).get_rule_options()
+    assert options['incremental']
+    assert options['incremental_state_file'] == os.path.join(os.path.dirname(root_config_file), 'user-sync-state.db')
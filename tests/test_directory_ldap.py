@@ -0,0 +1,365 @@
+import datetime
+import re
+
+import ldap3
+import pytest
+
+from ldap_benchmark import SyntheticLDAPDirectory, make_connector
+from user_sync.connector.directory_ldap import DN_BATCH_SIZE, LDAPDirectoryConnector
+from user_sync.error import AssertionException
+
+
+@pytest.fixture(scope='module')
+def directory():
+    return SyntheticLDAPDirectory(30, group_count=5, groups_per_user=2, parent_group_count=0)
+
+
+def load_groups(connector, directory, all_users):
+    connector.connection.search_count = 0
+    users = connector.load_users_and_groups(directory.get_group_names(), [], all_users)
+    return dict((user['email'], user['groups']) for user in users)
+
+
+@pytest.mark.parametrize('member_filter', [None, '(|(memberOf={group_dn})(member={group_dn}))'])
+def test_all_users_single_pass(directory, member_filter):
+    options = {'search_page_size': 10}
+    if member_filter:
+        options['group_member_filter_format'] = member_filter
+    expected = load_groups(make_connector(directory, 'group filter', **options), directory, False)
+    connector = make_connector(directory, 'all users', **options)
+    assert load_groups(connector, directory, True) == expected
+    # all users are read in a single paged search
+    assert connector.connection.search_count_by_filter['(objectClass=person)'] == 4
+    if not member_filter:
+        # and apart from that, only the group DNs are looked up, all in one search
+        assert connector.connection.search_count == 1 + 4
+
+
+@pytest.mark.parametrize('member_filter,attribute', [
+    ('(memberOf={group_dn})', 'memberOf'),
+    ('isMemberOf={group_dn}', 'isMemberOf'),
+    ('(&(memberOf={group_dn})(objectClass=user))', None),
+    ('(memberOf:1.2.840.113556.1.4.1941:={group_dn})', None),
+])
+def test_get_membership_attribute(member_filter, attribute):
+    assert LDAPDirectoryConnector.get_membership_attribute(member_filter) == attribute
+
+
+@pytest.mark.parametrize('batch_size', [0, 4])
+def test_two_steps_dn_resolution(directory, batch_size):
+    connector = make_connector(directory, 'two steps', two_steps_lookup={'group_member_attribute_name': 'member',
+                                                                         'dn_batch_size': batch_size})
+    user_dns = [dn for dn, _ in directory.user_entries[:6]]
+    member_dns = user_dns + [directory.get_group_dn('Group 0'), 'cn=outside,dc=example,dc=org']
+    connection = connector.connection
+    connection.search_count = 0
+    assert sorted(dn for dn, _ in connector.iter_users_by_dn(member_dns, [])) == sorted(user_dns)
+    # the DN outside the base DN is never searched for
+    assert connection.search_count == (2 if batch_size else 7)
+    # and nothing is searched for again
+    assert sorted(dn for dn, _ in connector.iter_users_by_dn(member_dns, [])) == sorted(user_dns)
+    assert connection.search_count == (2 if batch_size else 7)
+
+
+def test_two_steps_batched_load(directory):
+    expected = load_groups(make_connector(directory, 'two steps'), directory, False)
+    connector = make_connector(directory, 'two steps batched')
+    assert load_groups(connector, directory, False) == expected
+    # for each group, a search to find it, one to read its members, and at most one for the new ones
+    assert connector.connection.search_count <= 3 * len(directory.get_group_names())
+
+
+@pytest.mark.parametrize('active_directory,two_steps_options,batch_size', [
+    (False, {}, 0),
+    (True, {}, DN_BATCH_SIZE),
+    (False, {'dn_attribute_name': 'entryDN'}, DN_BATCH_SIZE),
+    (True, {'dn_batch_size': 0}, 0),
+    (False, {'dn_batch_size': 50}, 50),
+])
+def test_two_steps_dn_batch_size(directory, monkeypatch, active_directory, two_steps_options, batch_size):
+    two_steps_options = dict({'group_member_attribute_name': 'member'}, **two_steps_options)
+    connector = make_connector(directory, 'two steps', two_steps_lookup=two_steps_options)
+    monkeypatch.setattr(connector, 'is_active_directory', lambda: active_directory)
+    assert connector.get_dn_batch_size() == batch_size
+
+
+def test_two_steps_active_directory_load(directory, monkeypatch):
+    expected = load_groups(make_connector(directory, 'two steps'), directory, False)
+    connector = make_connector(directory, 'two steps')
+    # with Active Directory, members are read in batches by distinguishedName without being asked to
+    monkeypatch.setattr(connector, 'is_active_directory', lambda: True)
+    assert load_groups(connector, directory, False) == expected
+    assert connector.connection.search_count <= 3 * len(directory.get_group_names())
+
+
+@pytest.fixture(scope='module')
+def nested_directory():
+    directory = SyntheticLDAPDirectory(30, group_count=6, groups_per_user=2, parent_group_count=2)
+    # the parent groups are members of each other
+    for dn, attributes in directory.group_entries[-2:]:
+        other_dn = directory.get_group_dn([name for name in directory.parent_group_names if name not in dn][0])
+        attributes['member'] = attributes['member'] + [other_dn]
+    return directory
+
+
+def test_two_steps_nested_groups(nested_directory):
+    connector = make_connector(nested_directory, 'two steps nested')
+    users = load_groups(connector, nested_directory, False)
+    # each user is in the parent groups of its groups, and each parent group is in the other
+    for index, (_, attributes) in enumerate(nested_directory.user_entries):
+        group_names = [dn.split(',')[0][3:] for dn in attributes['memberOf']]
+        assert sorted(users['user%07d@example.com' % index]) == sorted(group_names +
+                                                                       nested_directory.parent_group_names)
+    # apart from the root DSE, only the groups are read for their members, each once in the run
+    assert connector.connection.search_count_by_filter['(objectClass=*)'] == len(nested_directory.group_entries) + 1
+    # and each member is looked up once as a user, the groups included, as they are all nested
+    assert connector.connection.search_count_by_filter['(objectClass=person)'] == (
+        len(nested_directory.user_entries) + len(nested_directory.group_entries))
+
+
+@pytest.mark.parametrize('two_steps_options,in_chain', [
+    ({}, True),
+    ({'nested_group_in_chain': False}, False),
+    ({'group_member_attribute_name': 'uniqueMember'}, False),
+])
+def test_two_steps_in_chain(nested_directory, monkeypatch, two_steps_options, in_chain):
+    options = {'two_steps_lookup': dict({'group_member_attribute_name': 'member', 'nested_group': True},
+                                        **two_steps_options)}
+    # the mock server has no root DSE, so nested groups are expanded by the connector
+    expected = load_groups(make_connector(nested_directory, 'two steps nested'), nested_directory, False)
+    connector = make_connector(nested_directory, 'two steps nested', **options)
+    assert not connector.is_active_directory()
+    if two_steps_options.get('group_member_attribute_name', 'member') == 'member':
+        assert load_groups(connector, nested_directory, False) == expected
+
+    # when the server supports it, nested groups are expanded by the server unless that is turned off
+    connector = make_connector(nested_directory, 'two steps nested', **options)
+    monkeypatch.setattr(connector, 'is_active_directory', lambda: True)
+    filters = []
+    monkeypatch.setattr(connector, 'iter_users',
+                        lambda base_dn, users_filter, *args, **kwargs: filters.append(users_filter) or [])
+    load_groups(connector, nested_directory, False)
+    if not in_chain:
+        assert not [users_filter for users_filter in filters if '1.2.840.113556.1.4.1941' in users_filter]
+        return
+    assert filters == [connector.format_in_chain_filter(nested_directory.get_group_dn(name))
+                       for name in nested_directory.get_group_names()]
+    assert filters[0] == ('(&(objectClass=person)(memberOf:1.2.840.113556.1.4.1941:='
+                          'cn=Group 0,ou=groups,dc=example,dc=com))')
+
+
+@pytest.mark.parametrize('mode', ['group filter', 'all users', 'two steps nested'])
+def test_connection_pool(nested_directory, mode):
+    expected = load_groups(make_connector(nested_directory, mode), nested_directory, mode == 'all users')
+    connector = make_connector(nested_directory, mode, connection_pool_size=4)
+    assert len(connector.connections) == 4
+    users = list(connector.load_users_and_groups(nested_directory.get_group_names(), [], mode == 'all users'))
+    # each user is made once, and has its groups in the order of the mappings
+    assert len(set(id(user) for user in users)) == len(users) == len(expected)
+    assert dict((user['email'], user['groups']) for user in users) == expected
+    if mode != 'all users':
+        # with all users, the group DNs are found in one search, so there is nothing to share
+        assert sum(connection.search_count for connection in connector.connections[1:]) > 0
+
+
+def test_host_list(directory):
+    connector = make_connector(directory, 'group filter', host=['ldap://dc1', 'ldap://dc2'])
+    assert isinstance(connector.server, ldap3.ServerPool)
+    assert [server.host for server in connector.server.servers] == ['dc1', 'dc2']
+    assert isinstance(make_connector(directory, 'group filter').server, ldap3.Server)
+    with pytest.raises(AssertionException):
+        make_connector(directory, 'group filter', host=[])
+    with pytest.raises(AssertionException):
+        make_connector(directory, 'group filter', connection_pool_size=0)
+
+
+@pytest.mark.parametrize('all_users', [False, True])
+def test_pipeline_user_load(directory, all_users):
+    options = {'search_page_size': 10}
+    groups = directory.get_group_names()[:3]
+    expected = make_connector(directory, 'group filter', **options).load_users_and_groups(groups, [], all_users)
+    expected = dict((user['email'], user['groups']) for user in expected)
+    connector = make_connector(directory, 'group filter', pipeline_user_load=True, **options)
+    connector.connection.search_count = 0
+    users = connector.load_users_and_groups(groups, [], all_users)
+    # the groups are found first, then the users are read a page at a time, and not kept
+    first_user = next(users)
+    assert connector.connection.search_count == 2
+    users = [first_user] + list(users)
+    assert dict((user['email'], user['groups']) for user in users) == expected
+    assert not connector.user_by_dn
+
+
+def test_pipeline_user_load_fallback(directory):
+    expected = load_groups(make_connector(directory, 'two steps'), directory, False)
+    connector = make_connector(directory, 'two steps', pipeline_user_load=True)
+    assert load_groups(connector, directory, False) == expected
+
+
+@pytest.mark.parametrize('mode,all_users', [('two steps', False), ('two steps', True), ('two steps batched', False)])
+def test_two_steps_member_dn_case(mode, all_users):
+    directory = SyntheticLDAPDirectory(20, group_count=3, groups_per_user=2, parent_group_count=0)
+    expected = load_groups(make_connector(directory, 'group filter'), directory, all_users)
+    # the member values differ from the DNs of the users in case
+    for _, attributes in directory.group_entries:
+        attributes['member'] = [dn.upper() for dn in attributes['member']]
+    connector = make_connector(directory, mode)
+    assert load_groups(connector, directory, all_users) == expected
+    assert not connector.non_user_dns
+
+
+@pytest.mark.parametrize('dn,normalized_dn', [
+    ('cn=User,ou=Users,dc=example,dc=com', 'cn=user,ou=users,dc=example,dc=com'),
+    (' CN = Smith\\, John , OU=Users ', 'cn=smith\\, john,ou=users'),
+    ('cn=a+uid=b,dc=com', 'cn=a+uid=b,dc=com'),
+])
+def test_normalize_dn(dn, normalized_dn):
+    assert LDAPDirectoryConnector.normalize_dn(dn) == normalized_dn
+
+
+def test_two_steps_ranged_members(nested_directory):
+    expected = load_groups(make_connector(nested_directory, 'two steps nested'), nested_directory, False)
+    connector = make_connector(nested_directory, 'two steps nested', max_value_range=4)
+    assert load_groups(connector, nested_directory, False) == expected
+    assert connector.connection.auto_range
+
+    # the members are returned as each range is read
+    connector = make_connector(nested_directory, 'two steps', max_value_range=4)
+    group_dn = nested_directory.get_group_dn('Group 0')
+    connector.connection.search_count = 0
+    member_dns = connector.get_group_member_dns(group_dn, 'member')
+    assert [next(member_dns) for _ in range(4)]
+    assert connector.connection.search_count == 1
+    member_dns = [member_dn for dn, attributes in nested_directory.group_entries
+                  if dn == group_dn for member_dn in attributes['member']]
+    connector.connection.search_count = 0
+    assert list(connector.get_group_member_dns(group_dn, 'member')) == member_dns
+    assert connector.member_dns_by_group_dn[group_dn] == member_dns
+    assert connector.connection.search_count == (len(member_dns) + 3) // 4
+
+
+@pytest.mark.parametrize('attributes,values,next_name', [
+    ({'member': ['a', 'b']}, ['a', 'b'], None),
+    ({'member': 'a'}, ['a'], None),
+    ({'Member;Range=0-1': ['a', 'b']}, ['a', 'b'], 'member;range=2-*'),
+    ({'member;range=2-*': ['c']}, ['c'], None),
+    ({'member;range=2-3': []}, [], None),
+    ({}, [], None),
+])
+def test_get_ranged_values(attributes, values, next_name):
+    assert LDAPDirectoryConnector.get_ranged_values(attributes, 'member') == (values, next_name)
+
+
+def test_group_dn_cache(directory, tmpdir):
+    groups = directory.get_group_names()
+    expected = load_groups(make_connector(directory, 'group filter'), directory, False)
+    cache_file = str(tmpdir.join('group_dns.json'))
+    group_filter = '(&(objectClass=group)(cn=Group 0))'
+
+    # the first run finds the DNs of all the groups with one search
+    connector = make_connector(directory, 'group filter', group_dn_cache_file=cache_file)
+    assert load_groups(connector, directory, False) == expected
+    assert connector.connection.search_count_by_filter[group_filter] == 0
+    assert connector.group_dn_by_name == dict((group, directory.get_group_dn(group)) for group in groups)
+
+    # the next run checks each cached DN instead
+    connector = make_connector(directory, 'group filter', group_dn_cache_file=cache_file)
+    assert load_groups(connector, directory, False) == expected
+    assert connector.connection.search_count_by_filter[group_filter] == 1
+    assert not any(search_filter.startswith('(|') for search_filter in connector.connection.search_count_by_filter)
+
+    # a DN that is no longer valid is found again, and the cache is ignored once it is too old
+    with open(cache_file) as f:
+        content = f.read()
+    with open(cache_file, 'w') as f:
+        f.write(content.replace(directory.get_group_dn('Group 0'), 'cn=Group 9,ou=groups,dc=example,dc=com'))
+    connector = make_connector(directory, 'group filter', group_dn_cache_file=cache_file)
+    assert load_groups(connector, directory, False) == expected
+    assert connector.group_dn_by_name['Group 0'] == directory.get_group_dn('Group 0')
+    connector = make_connector(directory, 'group filter', group_dn_cache_file=cache_file, group_dn_cache_ttl=0)
+    assert load_groups(connector, directory, False) == expected
+    assert connector.connection.search_count_by_filter[group_filter] == 0
+
+    # a group filter that can't be searched for many groups at once falls back to a search for each group
+    connector = make_connector(directory, 'group filter', group_filter_format='(&(objectClass=group)(cn={group}*))')
+    assert load_groups(connector, directory, False) == expected
+    assert not connector.group_dn_by_name
+
+
+def test_delta_load(tmpdir):
+    directory = SyntheticLDAPDirectory(30, group_count=5, groups_per_user=2, parent_group_count=0)
+    for index, (_, attributes) in enumerate(directory.user_entries):
+        attributes['uSNChanged'] = str(100 + index)
+    groups = directory.get_group_names()
+    delta_load = {'snapshot_file': str(tmpdir.join('snapshot.db'))}
+
+    def load(mode, all_users, **options):
+        connector = make_connector(directory, mode, **options)
+        users = connector.load_users_and_groups(groups, [], all_users)
+        return connector, dict((user['email'], user['groups']) for user in users)
+
+    def load_all_modes():
+        for mode, all_users in [('group filter', True), ('group filter', False), ('two steps', False)]:
+            connector, users = load(mode, all_users, delta_load=delta_load)
+            assert users == load(mode, all_users)[1]
+        return connector
+
+    load_all_modes()
+    # one user changes, one is deleted, one is added, and one no longer matches the all_users_filter
+    changed_dn, changed_attributes = directory.user_entries[0]
+    changed_attributes.update({'mail': 'changed@example.com', 'uSNChanged': '200'})
+    deleted_dn, _ = directory.user_entries.pop(1)
+    directory.user_entries[1][1]['objectClass'] = ['top', 'contact']
+    added_dn = 'cn=added,ou=users,dc=example,dc=com'
+    directory.user_entries.append((added_dn, {'objectClass': ['top', 'person', 'user'], 'cn': 'added',
+                                              'mail': 'added@example.com', 'uSNChanged': '201',
+                                              'memberOf': [directory.get_group_dn('Group 0')]}))
+    for _, attributes in directory.group_entries:
+        if deleted_dn in attributes['member']:
+            attributes['member'] = [dn for dn in attributes['member'] if dn != deleted_dn]
+    directory.group_entries[0][1]['member'].append(added_dn)
+
+    connector = load_all_modes()
+    # only the changed users are read, and the others come from the snapshot
+    assert connector.connection.search_count_by_filter['(&(objectClass=person)(uSNChanged>=202))'] == 1
+    assert connector.connection.search_count_by_filter['(objectClass=person)'] == 1
+
+
+def test_delta_load_change_during_search(tmpdir, monkeypatch):
+    directory = SyntheticLDAPDirectory(10, group_count=2, groups_per_user=1, parent_group_count=0)
+    for index, (_, attributes) in enumerate(directory.user_entries):
+        attributes['uSNChanged'] = str(100 + index)
+    options = {'delta_load': {'snapshot_file': str(tmpdir.join('snapshot.db'))}}
+    groups = directory.get_group_names()
+
+    def load(connector):
+        users = connector.load_users_and_groups(groups, [], True)
+        return dict((user['email'], user['groups']) for user in users)
+
+    load(make_connector(directory, 'group filter', **options))
+    # the first user is read in the delta load, and changes again before it ends, after the second user
+    # changed: the second user has the highest uSNChanged that is read, but the first one is still picked up
+    first_attributes, second_attributes = directory.user_entries[0][1], directory.user_entries[1][1]
+    first_attributes['uSNChanged'] = '110'
+    second_attributes.update({'mail': 'second@example.com', 'uSNChanged': '112'})
+    connector = make_connector(directory, 'group filter', **options)
+    monkeypatch.setattr(connector, 'get_highest_committed_usn', lambda: '109')
+    connection_search = connector.connection.search
+
+    def search(*args, **kwargs):
+        result = connection_search(*args, **kwargs)
+        search_filter = kwargs['search_filter'] if 'search_filter' in kwargs else args[1]
+        if search_filter == '(&(objectClass=person)(uSNChanged>=110))':
+            first_attributes.update({'mail': 'first@example.com', 'uSNChanged': '111'})
+        return result
+
+    monkeypatch.setattr(connector.connection, 'search', search)
+    users = load(connector)
+    assert 'second@example.com' in users and 'first@example.com' not in users
+    users = load(make_connector(directory, 'group filter', **options))
+    assert users == load(make_connector(directory, 'group filter'))
+    assert 'first@example.com' in users
+
+    # with a timestamp, the next load starts a little before this one did
+    mark = connector.get_change_mark('modifyTimestamp')
+    assert re.match(r'^\d{14}Z$', mark) and mark < datetime.datetime.utcnow().strftime('%Y%m%d%H%M%SZ')
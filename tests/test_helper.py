@@ -0,0 +1,73 @@
+import pickle
+
+import pytest
+
+from collections import OrderedDict
+
+from user_sync.connector.helper import AttributeTemplate, DirectoryUser, UserExtractor, create_blank_user
+
+
+def test_blank_user_behaves_like_dict():
+    user = create_blank_user()
+    assert user == {'identity_type': None, 'username': None, 'domain': None, 'firstname': None,
+                    'lastname': None, 'email': None, 'groups': [], 'country': None}
+    # slots that were never set are missing keys
+    assert 'uid' not in user
+    assert user.get('member_groups', []) == []
+    with pytest.raises(KeyError):
+        user['source_attributes']
+    user['uid'] = 'abc'
+    assert user['uid'] == 'abc' and 'uid' in user
+    del user['uid']
+    assert 'uid' not in user
+
+
+def test_extra_keys():
+    user = DirectoryUser(email='user@example.com', nickname='user')
+    assert user['nickname'] == 'user'
+    assert dict(user) == {'email': 'user@example.com', 'nickname': 'user'}
+    user.update({'nickname': 'other', 'country': 'US'})
+    assert user.copy() == {'email': 'user@example.com', 'nickname': 'other', 'country': 'US'}
+    assert user.pop('nickname') == 'other'
+    assert len(user) == 2
+    # methods are not keys
+    with pytest.raises(KeyError):
+        user['get']
+
+
+def test_pickle():
+    user = create_blank_user()
+    user.update({'email': 'user@example.com', 'groups': ['group'], 'extra': 1})
+    assert pickle.loads(pickle.dumps(user)) == user
+
+
+@pytest.mark.parametrize('string_format,expected', [
+    (None, (None, None)),
+    ('{mail}', ('jdoe@example.com', 'mail')),
+    ('{givenName} {sn}', ('John Doe', 'sn')),
+    ('{sn:>5}-{uid}', ('  Doe-42', 'uid')),
+    ('{givenName!r}', ("'John'", 'givenName')),
+    ('{uid}', ('42', 'uid')),
+    ('{givenName}.{missing}.{sn}', (None, 'missing')),
+    ('fixed', ('fixed', None)),
+])
+def test_attribute_template(string_format, expected):
+    record = {'mail': 'jdoe@example.com', 'givenName': 'John', 'sn': 'Doe', 'uid': 42}
+    template = AttributeTemplate(string_format)
+    assert template.generate_value(record) == expected
+    if string_format is not None and expected[0] is not None:
+        # the same as formatting the whole string
+        assert expected[0] == string_format.format(**record)
+
+
+def test_user_extractor():
+    templates = OrderedDict([('email', AttributeTemplate('{mail}')), ('username', AttributeTemplate('{uid}@{domain}')),
+                             ('domain', AttributeTemplate('{domain}'))])
+    extractor = UserExtractor(templates)
+    assert extractor.get_attribute_names() == ['mail', 'uid', 'domain']
+    record = {'mail': 'jdoe@example.com', 'uid': 'jdoe', 'domain': 'example.com'}
+    assert extractor.extract(record) == {'email': ('jdoe@example.com', 'mail'),
+                                         'username': ('jdoe@example.com', 'domain'),
+                                         'domain': ('example.com', 'domain')}
+    del record['domain']
+    assert extractor.extract(record)['username'] == (None, 'domain')
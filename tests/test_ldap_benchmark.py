@@ -0,0 +1,27 @@
+import pytest
+
+from ldap_benchmark import MODES, SyntheticLDAPDirectory, report_results, run_ldap_benchmark
+
+
+@pytest.fixture(scope='module')
+def directory():
+    return SyntheticLDAPDirectory(40, group_count=6, groups_per_user=2, parent_group_count=2)
+
+
+@pytest.mark.parametrize('mode', list(MODES))
+def test_ldap_benchmark_smoke(directory, mode):
+    result = run_ldap_benchmark(directory, mode, search_page_size=10)
+    assert result['user_count'] == 40
+    assert result['search_count'] > 0 and result['entry_count'] > 0
+    # every user is in two groups, and in nested mode also in the parents of those groups
+    if mode == 'two steps nested':
+        assert 80 < result['membership_count'] <= 160
+    else:
+        assert result['membership_count'] == 80
+    assert len(report_results([result])) == 2
+
+
+def test_group_filter_search_count(directory):
+    result = run_ldap_benchmark(directory, 'group filter', search_page_size=0)
+    # one search to find all the groups, and one for the members of each
+    assert result['search_count'] == 1 + len(directory.get_group_names())
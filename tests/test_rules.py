@@ -0,0 +1,457 @@
+import logging
+import multiprocessing
+import re
+import threading
+
+import pytest
+
+from user_sync.connector.helper import create_blank_user
+from user_sync.connector.umapi import GroupCommands
+from user_sync.error import AssertionException
+from user_sync.rules import RuleProcessor, AdobeGroup, UmapiConnectors, UmapiTargetInfo, UserExclusionFilter, UserKey
+
+
+@pytest.fixture(autouse=True)
+def rule_environment(monkeypatch):
+    # progress logging is installed by the app at startup
+    monkeypatch.setattr(logging.Logger, 'progress', lambda *args, **kwargs: None, raising=False)
+    monkeypatch.setattr(AdobeGroup, 'index_map', {})
+
+
+class FakeActionManager(object):
+    def get_statistics(self):
+        return 0, 0
+
+    def has_work(self):
+        return False
+
+
+class FakeUmapiConnector(object):
+    def __init__(self, name, users):
+        self.name = 'umapi' + name
+        self.trusted = False
+        self.users = users
+        self.commands = []
+        self.group_commands = []
+        self.events = []
+        self.listed_on = None
+        self.listing_started = threading.Event()
+        self.lookups = []
+
+    def __getstate__(self):
+        # sharded syncs send the connectors to their workers
+        state = self.__dict__.copy()
+        state['listed_on'] = state['listing_started'] = None
+        return state
+
+    def iter_users(self, in_group=None):
+        self.listed_on = threading.current_thread()
+        self.listing_started.set()
+        for user in self.users:
+            yield dict(user)
+
+    def get_user(self, email):
+        self.lookups.append(email)
+        for user in self.users:
+            if user['email'] == email:
+                return dict(user)
+
+    def get_action_manager(self):
+        return FakeActionManager()
+
+    def send_commands(self, commands, callback=None):
+        if isinstance(commands, GroupCommands):
+            self.group_commands.append(commands)
+        else:
+            self.commands.append(commands)
+        self.events.append(commands.do_list[0][0])
+
+    def start_sync(self):
+        self.events.append('start_sync')
+
+    def end_sync(self):
+        self.events.append('end_sync')
+
+
+class FakeDirectoryConnector(object):
+    def __init__(self, users, wait_for=None):
+        self.users = users
+        self.wait_for = wait_for
+
+    def load_users_and_groups(self, groups, extended_attributes, all_users):
+        if self.wait_for is not None:
+            assert self.wait_for.wait(5)
+        return iter(self.users)
+
+
+def make_directory_user(name, groups):
+    user = create_blank_user()
+    user.update({'identity_type': 'federatedID', 'username': name + '@example.com', 'domain': 'example.com',
+                 'email': name + '@example.com', 'firstname': name, 'lastname': 'User', 'country': 'US',
+                 'groups': groups, 'source_attributes': {}})
+    return user
+
+
+def make_umapi_user(name, groups):
+    return {'type': 'federatedID', 'username': name + '@example.com', 'domain': 'example.com',
+            'email': name + '@example.com', 'firstname': name, 'lastname': 'User', 'country': 'US',
+            'groups': groups}
+
+
+def make_processor(**options):
+    rule_options = {'exclude_unmapped_users': False, 'process_groups': True}
+    rule_options.update(options)
+    return RuleProcessor(rule_options)
+
+
+def get_mappings():
+    return {
+        'Directory Group': [AdobeGroup.create('Adobe Group')],
+        'Other Directory Group': [AdobeGroup.create('secondary::Other Adobe Group')],
+    }
+
+
+def describe_commands(connector):
+    return sorted((c.username, tuple((name, tuple(sorted(params.get('groups', [])))) for name, params in c.do_list))
+                  for c in connector.commands if c is not None)
+
+
+def sync_fixture():
+    directory_users = [
+        make_directory_user('matched', ['Directory Group']),
+        make_directory_user('both', ['Directory Group', 'Other Directory Group']),
+        make_directory_user('new', ['Directory Group']),
+    ]
+    primary = FakeUmapiConnector('', [make_umapi_user('matched', []), make_umapi_user('both', ['Adobe Group'])])
+    secondary = FakeUmapiConnector('.secondary', [make_umapi_user('both', [])])
+    return directory_users, primary, secondary
+
+
+@pytest.mark.parametrize('pipelined', [False, True])
+def test_sync_results(pipelined):
+    directory_users, primary, secondary = sync_fixture()
+    processor = make_processor(pipeline_umapi_load=pipelined)
+    umapi_connectors = UmapiConnectors(primary, {'secondary': secondary})
+    processor.run(get_mappings(), FakeDirectoryConnector(directory_users), umapi_connectors)
+    assert describe_commands(primary) == [
+        ('matched@example.com', (('add_to_groups', ('adobe group',)),)),
+        ('new@example.com', (('create', ()), ('add_to_groups', ('adobe group',)))),
+    ]
+    assert describe_commands(secondary) == [
+        ('both@example.com', (('add_to_groups', ('other adobe group',)),)),
+    ]
+    assert processor.primary_user_count == 2
+
+
+def test_pipelined_load_overlaps_directory_load():
+    directory_users, primary, secondary = sync_fixture()
+    processor = make_processor(pipeline_umapi_load=True)
+    umapi_connectors = UmapiConnectors(primary, {'secondary': secondary})
+    # the directory load can only finish once the umapi listing is under way
+    directory_connector = FakeDirectoryConnector(directory_users, wait_for=primary.listing_started)
+    processor.run(get_mappings(), directory_connector, umapi_connectors)
+    assert primary.listed_on is not threading.current_thread()
+    assert secondary.listed_on is not threading.current_thread()
+
+
+def test_parallel_secondaries_match_serial_results():
+    results = []
+    for workers in (1, 4):
+        AdobeGroup.index_map.clear()
+        mappings = get_mappings()
+        mappings['Third Directory Group'] = [AdobeGroup.create('third::Third Adobe Group')]
+        directory_users = [make_directory_user('user%d' % i, ['Directory Group', 'Other Directory Group',
+                                                              'Third Directory Group'])
+                           for i in range(10)]
+        primary = FakeUmapiConnector('', [make_umapi_user('user%d' % i, []) for i in range(10)])
+        secondary = FakeUmapiConnector('.secondary', [make_umapi_user('user%d' % i, []) for i in range(0, 10, 2)])
+        third = FakeUmapiConnector('.third', [make_umapi_user('user%d' % i, []) for i in range(1, 10, 2)])
+        processor = make_processor(secondary_umapi_workers=workers)
+        umapi_connectors = UmapiConnectors(primary, {'secondary': secondary, 'third': third})
+        processor.run(mappings, FakeDirectoryConnector(directory_users), umapi_connectors)
+        results.append((describe_commands(primary), describe_commands(secondary), describe_commands(third),
+                        processor.secondary_users_created, processor.updated_user_keys))
+        if workers > 1:
+            assert secondary.listed_on is not threading.current_thread()
+            assert third.listed_on is not threading.current_thread()
+    assert results[0] == results[1]
+    assert len(results[1][3]) == 10
+
+
+def run_sharded_sync(shard_count, **options):
+    AdobeGroup.index_map.clear()
+    directory_users = [make_directory_user('user%d' % i, ['Directory Group', 'Other Directory Group'])
+                       for i in range(30)]
+    umapi_users = [make_umapi_user('user%d' % i, ['Adobe Group'] if i % 3 else []) for i in range(20)]
+    umapi_users.extend(make_umapi_user('stray%d' % i, ['Adobe Group']) for i in range(6))
+    umapi_users.append(make_umapi_user('admin', ['Adobe Group']))
+    primary = FakeUmapiConnector('', umapi_users)
+    secondary = FakeUmapiConnector('.secondary', [make_umapi_user('user%d' % i, []) for i in range(0, 30, 2)])
+    processor = make_processor(shard_count=shard_count, remove_strays=True,
+                               exclude_users=[re.compile(r'\Aadmin@')], **options)
+    # the shards send their commands from the worker processes
+    manager = multiprocessing.Manager()
+    try:
+        for connector in (primary, secondary):
+            connector.commands, connector.events = manager.list(), manager.list()
+        processor.run(get_mappings(), FakeDirectoryConnector(directory_users),
+                      UmapiConnectors(primary, {'secondary': secondary}))
+        for connector in (primary, secondary):
+            connector.commands, connector.events = list(connector.commands), list(connector.events)
+    finally:
+        manager.shutdown()
+    return processor, primary, secondary
+
+
+def test_sharded_sync_matches_serial_results():
+    results = []
+    for shard_count in (1, 3):
+        processor, primary, secondary = run_sharded_sync(shard_count)
+        results.append((describe_commands(primary), describe_commands(secondary), processor.primary_user_count,
+                        processor.excluded_user_count, processor.primary_users_created,
+                        processor.secondary_users_created, processor.updated_user_keys,
+                        set(processor.get_stray_keys()), processor.user_exclusion_filter.exclusion_counts,
+                        processor.post_sync_data.umapi_data, processor.action_summary['primary_strays_processed']))
+    assert results[0] == results[1]
+    assert len(results[1][7]) == 6
+    # keys coming back from the shards are interned again
+    for user_key in results[1][4]:
+        assert UserKey.create(*user_key) is user_key
+
+
+def test_sharded_sync_spawns_workers(monkeypatch):
+    # workers are not forked, as threads may be running in the parent
+    methods = []
+    get_context = multiprocessing.get_context
+
+    def record_context(method=None):
+        methods.append(method)
+        return get_context(method)
+
+    monkeypatch.setattr(multiprocessing, 'get_context', record_context)
+    run_sharded_sync(2)
+    assert methods == ['spawn']
+
+
+def test_sharded_sync_limits_strays_globally():
+    # each shard has fewer Adobe-only users than the limit, but together they have more
+    processor, primary, secondary = run_sharded_sync(3, max_adobe_only_users=5)
+    assert processor.stray_limit_exceeded
+    # as in a serial sync, none of the shards send any commands
+    assert primary.commands == secondary.commands == []
+    assert processor.action_summary['primary_strays_processed'] == 0
+
+
+class FailingUmapiConnector(FakeUmapiConnector):
+    def send_commands(self, commands, callback=None):
+        raise ValueError('cannot send')
+
+
+def test_sharded_sync_reports_shard_errors():
+    directory_users = [make_directory_user('user%d' % i, ['Directory Group']) for i in range(5)]
+    processor = make_processor(shard_count=2)
+    with pytest.raises(AssertionException, match='cannot send'):
+        processor.run(get_mappings(), FakeDirectoryConnector(directory_users),
+                      UmapiConnectors(FailingUmapiConnector('', []), {}))
+
+
+@pytest.mark.parametrize('streamed', [False, True])
+def test_streamed_commands(streamed):
+    directory_users = [make_directory_user('user%d' % i, ['Directory Group']) for i in range(20)]
+    umapi_users = [make_umapi_user('user%d' % i, []) for i in range(10)]
+    umapi_users.extend(make_umapi_user('stray%d' % i, ['Adobe Group']) for i in range(3))
+    primary = FakeUmapiConnector('', umapi_users)
+    processor = make_processor(stream_commands=streamed, command_queue_size=2, remove_strays=True)
+    processor.run(get_mappings(), FakeDirectoryConnector(directory_users), UmapiConnectors(primary, {}))
+    assert len(primary.commands) == 23
+    # the signals bracket all the commands, and the strays come last
+    assert primary.events[0] == 'start_sync'
+    assert primary.events[-2:] == ['end_sync', 'remove_from_organization']
+    assert primary.events.count('start_sync') == primary.events.count('end_sync') == 1
+    assert set(primary.events[-4:-2]) == {'remove_from_organization'}
+
+
+def test_streamed_commands_stray_limit():
+    directory_users = [make_directory_user('user%d' % i, ['Directory Group']) for i in range(20)]
+    umapi_users = [make_umapi_user('user%d' % i, []) for i in range(10)]
+    umapi_users.extend(make_umapi_user('stray%d' % i, ['Adobe Group']) for i in range(3))
+    primary = FakeUmapiConnector('', umapi_users)
+    processor = make_processor(stream_commands=True, command_queue_size=2, remove_strays=True,
+                               max_adobe_only_users=1)
+    processor.run(get_mappings(), FakeDirectoryConnector(directory_users), UmapiConnectors(primary, {}))
+    assert processor.stray_limit_exceeded
+    # the strays are dropped, but every streamed command is sent, and the sync is ended
+    assert len(primary.commands) == 20
+    assert primary.events.count('start_sync') == primary.events.count('end_sync') == 1
+    assert primary.events[-2] == 'end_sync'
+    assert 'remove_from_organization' not in primary.events
+
+
+def test_bulk_group_actions():
+    mappings = get_mappings()
+    mappings['Small Directory Group'] = [AdobeGroup.create('Small Adobe Group')]
+    directory_users = [make_directory_user('user%d' % i, ['Directory Group']) for i in range(25)]
+    directory_users.append(make_directory_user('small', ['Directory Group', 'Small Directory Group']))
+    directory_users.append(make_directory_user('new', ['Directory Group']))
+    umapi_users = [make_umapi_user('user%d' % i, ['Small Adobe Group']) for i in range(25)]
+    umapi_users.append(make_umapi_user('small', []))
+    primary = FakeUmapiConnector('', umapi_users)
+    processor = make_processor(bulk_group_actions=True, bulk_group_chunk_size=10, bulk_group_min_users=5)
+    processor.run(mappings, FakeDirectoryConnector(directory_users), UmapiConnectors(primary, {}))
+    # the new user and the changes below the threshold stay per-user
+    assert describe_commands(primary) == [
+        ('new@example.com', (('create', ()), ('add_to_groups', ('adobe group',)))),
+        ('small@example.com', (('add_to_groups', ('small adobe group',)),)),
+    ]
+    changes = [(c.group_name, name, len(params['users'])) for c in primary.group_commands
+               for name, params in c.do_list]
+    assert changes == [('adobe group', 'add_users', 10), ('adobe group', 'add_users', 10),
+                       ('adobe group', 'add_users', 6),
+                       ('small adobe group', 'remove_users', 10), ('small adobe group', 'remove_users', 10),
+                       ('small adobe group', 'remove_users', 5)]
+
+
+def test_incremental_sync(tmpdir):
+    state_file = str(tmpdir.join('state.db'))
+
+    def run_sync(directory_users, umapi_users, **options):
+        AdobeGroup.index_map.clear()
+        primary = FakeUmapiConnector('', umapi_users)
+        processor = make_processor(incremental=True, incremental_state_file=state_file, update_user_info=True,
+                                   remove_strays=True, **options)
+        processor.run(get_mappings(), FakeDirectoryConnector(directory_users), UmapiConnectors(primary, {}))
+        return processor, primary
+
+    directory_users = [make_directory_user('user%d' % i, ['Directory Group']) for i in range(5)]
+    umapi_users = [make_umapi_user('user%d' % i, ['Adobe Group']) for i in range(5)]
+    processor, primary = run_sync(directory_users, umapi_users)
+    assert processor.is_full_sync
+    assert primary.listed_on is not None and not primary.lookups
+
+    # one user changes, one leaves the directory, and one joins
+    directory_users[1]['lastname'] = 'Changed'
+    del directory_users[2]
+    directory_users.append(make_directory_user('new', ['Directory Group']))
+    processor, primary = run_sync(directory_users, umapi_users)
+    assert not processor.is_full_sync
+    assert primary.listed_on is None
+    assert sorted(primary.lookups) == ['new@example.com', 'user1@example.com', 'user2@example.com']
+    assert describe_commands(primary) == [
+        ('new@example.com', (('create', ()), ('add_to_groups', ('adobe group',)))),
+        ('user1@example.com', (('update', ()),)),
+        ('user2@example.com', (('remove_from_organization', ()),)),
+    ]
+
+    # nothing changed since the last run
+    umapi_users = [make_umapi_user(u['firstname'], ['Adobe Group']) for u in directory_users]
+    umapi_users[1]['lastname'] = 'Changed'
+    processor, primary = run_sync(directory_users, umapi_users)
+    assert not primary.lookups and not primary.commands
+
+    # a full sync is due, which catches changes made on the Adobe side
+    umapi_users[0]['groups'] = []
+    processor, primary = run_sync(directory_users, umapi_users, full_sync_interval=0)
+    assert processor.is_full_sync
+    assert describe_commands(primary) == [('user0@example.com', (('add_to_groups', ('adobe group',)),))]
+
+
+def test_user_keys():
+    processor = make_processor()
+    user_key = processor.get_user_key('federatedID', 'User@Example.com', 'example.com')
+    assert user_key == ('federatedID', 'user@example.com', '')
+    assert str(user_key) == 'federatedID,user@example.com,'
+    # equal keys are the same instance, also when parsed from their string form
+    assert processor.get_user_key('federatedID', 'user@example.com', None) is user_key
+    assert UserKey.parse(str(user_key)) is user_key
+    assert processor.get_user_key('enterpriseID', 'user', 'Example.com').domain == 'example.com'
+    assert processor.get_user_key('federatedID', 'user', None) is None
+
+
+def test_stray_list_round_trip(tmpdir):
+    stray_file = str(tmpdir.join('strays.csv'))
+    processor = make_processor(stray_list_output_path=stray_file)
+    keys = [processor.get_user_key('federatedID', 'user@example.com', ''),
+            processor.get_user_key('enterpriseID', 'user', 'example.com')]
+    processor.add_stray(None, None)
+    for user_key in keys:
+        processor.add_stray(None, user_key)
+    processor.write_stray_key_map()
+    with open(stray_file) as f:
+        assert f.read().splitlines() == ['type,username,domain', 'federatedID,user@example.com,',
+                                         'enterpriseID,user,example.com']
+    assert set(make_processor(stray_list_input_path=stray_file).get_stray_keys()) == set(keys)
+
+
+@pytest.mark.parametrize('hook', [None, "target_groups.add('Hook Adobe Group')"])
+def test_desired_groups(hook):
+    mappings = get_mappings()
+    AdobeGroup.create('Hook Adobe Group')
+    directory_users = [make_directory_user('user1', ['Directory Group', 'Other Directory Group']),
+                       make_directory_user('user2', ['Other Directory Group', 'Directory Group', 'Unmapped']),
+                       make_directory_user('user3', [])]
+    processor = make_processor(after_mapping_hook=compile(hook, '<hook>', 'exec') if hook else None)
+    processor.read_desired_user_groups(mappings, FakeDirectoryConnector(directory_users))
+    keys = [processor.get_directory_user_key(u) for u in directory_users]
+    primary = processor.get_umapi_info(None).get_desired_groups_by_user_key()
+    secondary = processor.get_umapi_info('secondary').get_desired_groups_by_user_key()
+    hook_groups = {'hook adobe group'} if hook else set()
+    assert primary == {keys[0]: {'adobe group'} | hook_groups, keys[1]: {'adobe group'} | hook_groups,
+                       keys[2]: hook_groups}
+    assert secondary == {keys[0]: {'other adobe group'}, keys[1]: {'other adobe group'}}
+    if not hook:
+        # users with the same mapped groups share them
+        assert primary[keys[0]] is primary[keys[1]]
+        assert processor.after_mapping_hook_scope['target_groups'] is None
+
+
+def test_group_masks():
+    umapi_info = UmapiTargetInfo(None)
+    for group in ('Group A', 'Group B', 'Group C'):
+        umapi_info.add_mapped_group(group)
+    exclude_mask = umapi_info.get_groups_mask(frozenset(['excluded']))
+    current = umapi_info.get_current_groups_mask(['GROUP A', 'Group C', 'Unmapped', 'Excluded'])
+    desired = umapi_info.get_groups_mask(frozenset(['group a', 'group b']))
+    assert current & exclude_mask
+    assert umapi_info.get_group_names(desired & ~current) == {'group b'}
+    assert umapi_info.get_group_names(current & ~desired & umapi_info.get_mapped_groups_mask()) == {'group c'}
+    assert umapi_info.get_group_names(0) == set()
+
+
+def test_excluded_and_stray_groups():
+    mappings = get_mappings()
+    directory_users = [make_directory_user('user', ['Directory Group'])]
+    umapi_users = [make_umapi_user('user', ['Unmapped']),
+                   make_umapi_user('excluded', ['Excluded Group', 'Adobe Group']),
+                   make_umapi_user('stray', ['Adobe Group', 'Unmapped'])]
+    primary = FakeUmapiConnector('', umapi_users)
+    processor = make_processor(exclude_groups=['Excluded Group'], remove_strays=False)
+    processor.run(mappings, FakeDirectoryConnector(directory_users), UmapiConnectors(primary, {}))
+    assert processor.excluded_user_count == 1
+    assert describe_commands(primary) == [
+        ('stray@example.com', (('remove_from_groups', ('adobe group',)),)),
+        ('user@example.com', (('add_to_groups', ('adobe group',)),)),
+    ]
+
+
+@pytest.mark.parametrize('patterns', [
+    ['admin.*@example.com', 'svc-[0-9]+@example.com', r'test(\d)\1@example.com'],
+    ['admin.*@example.com', 'svc-[0-9]+@example.com', 'test(?P<digit>[0-9])[0-9]@example.com'],
+])
+def test_user_exclusion_filter(patterns):
+    regexes = [re.compile(r'\A' + p + r'\Z', re.UNICODE | re.IGNORECASE) for p in patterns]
+    exclusion_filter = UserExclusionFilter(['adobeID'], regexes)
+    # patterns that refer back to their own groups can't be merged
+    assert (exclusion_filter.exclude_users_regex is None) == ('\\1' in patterns[2])
+    processor = make_processor()
+    rules = []
+    for id_type, username, groups in [('adobeID', 'someone@example.com', ()),
+                                      ('federatedID', 'Admin1@example.com', ()),
+                                      ('federatedID', 'admin2@example.com', {'b', 'a'}),
+                                      ('federatedID', 'svc-12@example.com', ()),
+                                      ('federatedID', 'svc-x@example.com', ()),
+                                      ('federatedID', 'test11@example.com', ())]:
+        user_key = processor.get_user_key(id_type, username, None)
+        rules.append(exclusion_filter.get_exclusion_rule(user_key, groups))
+    assert rules == ['type: adobeID', 'name: ' + regexes[0].pattern, 'group: a', 'name: ' + regexes[1].pattern,
+                     None, 'name: ' + regexes[2].pattern]
+    assert sorted(exclusion_filter.exclusion_counts.values()) == [1, 1, 1, 1, 1]
@@ -0,0 +1,283 @@
+import logging
+import threading
+import time
+from unittest.mock import Mock
+
+import pytest
+import umapi_client
+
+from user_sync.connector.umapi import ActionManager, Commands, GroupCommands, UmapiConnector
+from user_sync.error import AssertionException
+
+
+@pytest.fixture
+def connection():
+    conn = Mock()
+    conn.execute_multiple.side_effect = lambda actions, immediate=True: (0, len(actions), len(actions))
+    conn.sync_started = conn.sync_ended = False
+    return conn
+
+
+def make_commands(username, *groups):
+    commands = Commands(identity_type='federatedID', email=username, username=username, domain='example.com')
+    commands.add_groups(set(groups or ['group1']))
+    return commands
+
+
+def add_users(action_manager, count, callback=None):
+    for i in range(count):
+        action = action_manager.create_action(make_commands('user%d@example.com' % i))
+        action_manager.add_action(action, callback)
+
+
+def test_batches_are_sent_when_full(connection):
+    action_manager = ActionManager(connection, 'org', logging.getLogger(), batch_size=4)
+    add_users(action_manager, 10)
+    assert [len(c[0][0]) for c in connection.execute_multiple.call_args_list] == [4, 4]
+    assert action_manager.has_work()
+    action_manager.flush()
+    assert [len(c[0][0]) for c in connection.execute_multiple.call_args_list] == [4, 4, 2]
+    assert not action_manager.has_work()
+    assert action_manager.get_statistics() == (10, 0)
+
+
+def test_flush_interval_sends_partial_batch(connection):
+    action_manager = ActionManager(connection, 'org', logging.getLogger(), batch_size=100, flush_interval=0.000001)
+    add_users(action_manager, 3)
+    assert connection.execute_multiple.call_count == 3
+    assert not action_manager.has_work()
+
+
+def test_errors_are_attributed_per_action(connection):
+    def execute(actions, immediate=True):
+        actions[1].report_command_error({'index': 1, 'step': 0, 'errorCode': 'error.code', 'message': 'failed'})
+        return 0, len(actions), len(actions) - 1
+
+    connection.execute_multiple.side_effect = execute
+    results = []
+    action_manager = ActionManager(connection, 'org', logging.getLogger(), batch_size=3)
+    add_users(action_manager, 3, results.append)
+    assert [r['is_success'] for r in results] == [True, False, True]
+    assert action_manager.get_statistics() == (3, 1)
+
+
+def test_batch_error_fails_whole_batch(connection):
+    def execute(actions, immediate=True):
+        raise umapi_client.BatchError([Exception('bad response')], 0, len(actions), 0)
+
+    connection.execute_multiple.side_effect = execute
+    results = []
+    action_manager = ActionManager(connection, 'org', logging.getLogger(), batch_size=2)
+    add_users(action_manager, 3, results.append)
+    action_manager.flush()
+    assert [r['is_success'] for r in results] == [False, False, False]
+    assert action_manager.get_statistics() == (3, 3)
+
+
+def test_concurrent_batches_keep_user_order():
+    lock = threading.Lock()
+    sent = []
+
+    def execute(actions, immediate=True):
+        # later batches finish sooner, so out-of-order completion would show up
+        time.sleep(0.001 * (20 - int(actions[0].commands[0]['add']['group'][0][5:])))
+        with lock:
+            sent.extend((a.frame['user'], a.commands[0]['add']) for a in actions)
+        return 0, len(actions), len(actions)
+
+    conn = Mock()
+    conn.execute_multiple.side_effect = execute
+    conn.sync_started = conn.sync_ended = False
+    results = []
+    action_manager = ActionManager(conn, 'org', logging.getLogger(), batch_size=2, concurrent_requests=4,
+                                   connection_factory=lambda: conn)
+    for i in range(20):
+        username = 'user%d@example.com' % (i % 3)
+        commands = make_commands(username, 'group%d' % i)
+        action_manager.add_action(action_manager.create_action(commands), results.append)
+    action_manager.flush()
+    assert not action_manager.has_work()
+    assert action_manager.get_statistics() == (20, 0)
+    assert len(results) == 20
+    for u in range(3):
+        username = 'user%d@example.com' % u
+        groups = [c['group'][0] for user, c in sent if user == username]
+        assert groups == ['group%d' % i for i in range(20) if i % 3 == u]
+
+
+def test_concurrent_batch_errors_are_counted():
+    def execute(actions, immediate=True):
+        if actions[0].frame['user'] == 'user0@example.com':
+            raise umapi_client.BatchError([Exception('bad response')], 0, len(actions), 0)
+        return 0, len(actions), len(actions)
+
+    conn = Mock()
+    conn.execute_multiple.side_effect = execute
+    conn.sync_started = conn.sync_ended = False
+    action_manager = ActionManager(conn, 'org', logging.getLogger(), batch_size=1, concurrent_requests=3,
+                                   connection_factory=lambda: conn)
+    add_users(action_manager, 6)
+    action_manager.flush()
+    assert action_manager.get_statistics() == (6, 1)
+
+
+def test_concurrent_group_actions_keep_user_order():
+    lock = threading.Lock()
+    events = []
+
+    def execute(actions, immediate=True):
+        name = actions[0].frame.get('user') or actions[0].frame['usergroup']
+        with lock:
+            events.append(('start', name))
+        # the per-user batches are slow, so a group action sent alongside them would overtake them
+        time.sleep(0.005 if 'user' in actions[0].frame else 0)
+        with lock:
+            events.append(('end', name))
+        return 0, len(actions), len(actions)
+
+    conn = Mock()
+    conn.execute_multiple.side_effect = execute
+    conn.sync_started = conn.sync_ended = False
+    action_manager = ActionManager(conn, 'org', logging.getLogger(), batch_size=1, concurrent_requests=4,
+                                   connection_factory=lambda: conn)
+    add_users(action_manager, 2)
+    commands = GroupCommands('Group 1')
+    commands.add_users(['user0@example.com', 'user1@example.com'])
+    action_manager.add_action(action_manager.create_action(commands))
+    add_users(action_manager, 2)
+    action_manager.flush()
+    group_start, group_end = events.index(('start', 'Group 1')), events.index(('end', 'Group 1'))
+    # the group action starts once the earlier user actions are done, and ends before the later ones start
+    assert group_end == group_start + 1
+    assert [event for event, _ in events[:group_start]] == ['start', 'start', 'end', 'end']
+    assert len(events) == group_end + 5
+
+
+def test_concurrent_batches_use_own_connections():
+    lock = threading.Lock()
+    in_flight = []
+    sent = []
+
+    def make_connection(name):
+        conn = Mock()
+        conn.sync_started = conn.sync_ended = False
+
+        def execute(actions, immediate=True):
+            with lock:
+                in_flight.append(name)
+                signal = 'start' if conn.sync_started else 'end' if conn.sync_ended else None
+                conn.sync_started = conn.sync_ended = False
+                sent.append((name, signal, len(in_flight), [a.frame['user'] for a in actions]))
+            time.sleep(0.002)
+            with lock:
+                in_flight.remove(name)
+            return 0, len(actions), len(actions)
+
+        conn.execute_multiple.side_effect = execute
+        return conn
+
+    main = make_connection('main')
+    workers = []
+
+    def connection_factory():
+        with lock:
+            workers.append(make_connection('worker%d' % len(workers)))
+            return workers[-1]
+
+    action_manager = ActionManager(main, 'org', logging.getLogger(), batch_size=1, concurrent_requests=4,
+                                   connection_factory=connection_factory)
+    main.sync_started = True
+    add_users(action_manager, 8)
+    main.sync_ended = True
+    action_manager.add_action(action_manager.create_action(make_commands('last@example.com')))
+    action_manager.flush()
+    # the signals are each sent once, on the main connection, with no other batch in flight
+    assert [(name, signal, count) for name, signal, count, _ in sent if signal] == [('main', 'start', 1),
+                                                                                  ('main', 'end', 1)]
+    assert sent[0][3] == ['user0@example.com'] and sent[-1][3] == ['last@example.com']
+    # the other batches are sent on the worker connections, which are never shared
+    assert set(name for name, signal, _, _ in sent if not signal) <= set('worker%d' % i for i in range(4))
+    assert 1 < len(workers) <= 4
+    assert max(count for _, _, count, _ in sent) > 1
+
+
+@pytest.mark.parametrize('batch_size', [0, 11])
+def test_batch_size_limits(batch_size):
+    options = {'server': {'batch_size': batch_size}, 'enterprise': {'org_id': 'org', 'tech_acct_id': 'tech'}}
+    with pytest.raises(AssertionException, match='batch_size must be from 1 to 10'):
+        UmapiConnector('', options)
+
+
+class PagedConnection(object):
+    """A stand-in for the connection that serves user pages out of a list"""
+
+    def __init__(self, users, page_size):
+        self.pages = [users[i:i + page_size] for i in range(0, len(users), page_size)]
+        self.page_size = page_size
+        self.total = len(users)
+
+    def query_multiple(self, object_type, page=0, url_params=None, query_params=None):
+        # later pages answer sooner, to exercise out-of-order delivery
+        time.sleep(0.001 * (len(self.pages) - page))
+        values = self.pages[page] if page < len(self.pages) else []
+        last_page = page >= len(self.pages) - 1
+        return values, last_page, self.total, len(self.pages), page + 1, self.page_size
+
+
+def make_connector(connection, page_fetch_workers, page_fetch_ordered=True):
+    connector = UmapiConnector.__new__(UmapiConnector)
+    connector.connection = connection
+    connector.logger = Mock()
+    connector.options = {'server': {'page_fetch_workers': page_fetch_workers,
+                                    'page_fetch_ordered': page_fetch_ordered}}
+    return connector
+
+
+@pytest.fixture
+def umapi_users():
+    users = [{'email': 'user%d@example.com' % i} for i in range(95)]
+    # duplicates across pages are only reported once
+    users.insert(50, {'email': 'user3@example.com'})
+    return users
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_iter_users_in_order(umapi_users, workers):
+    connector = make_connector(PagedConnection(umapi_users, 10), workers)
+    emails = [u['email'] for u in connector.iter_users()]
+    assert emails == ['user%d@example.com' % i for i in range(95)]
+    connector.logger.progress.assert_called_with(96, 96)
+
+
+def test_iter_users_out_of_order(umapi_users):
+    connector = make_connector(PagedConnection(umapi_users, 10), 4, page_fetch_ordered=False)
+    emails = [u['email'] for u in connector.iter_users()]
+    assert sorted(emails) == sorted('user%d@example.com' % i for i in range(95))
+    assert len(emails) == 95
+
+
+def test_iter_users_listing_grows(umapi_users):
+    connection = PagedConnection(umapi_users, 10)
+    first_page = connection.query_multiple
+
+    def query_multiple(object_type, page=0, url_params=None, query_params=None):
+        values, last_page, total, page_count, number, size = first_page(object_type, page, url_params, query_params)
+        if page == 0:
+            # the first response under-reports the page count
+            page_count = 5
+        return values, last_page, total, page_count, number, size
+
+    connection.query_multiple = query_multiple
+    connector = make_connector(connection, 3)
+    assert len(list(connector.iter_users())) == 95
+
+
+def test_group_commands_action(connection):
+    action_manager = ActionManager(connection, 'org', logging.getLogger())
+    commands = GroupCommands('Group 1')
+    commands.add_users(['user1@example.com', 'user2@example.com'])
+    commands.remove_users(['user3@example.com'])
+    wire = action_manager.create_action(commands).wire_dict()
+    assert wire['usergroup'] == 'Group 1'
+    assert wire['do'] == [{'add': {'user': ['user1@example.com', 'user2@example.com']}},
+                          {'remove': {'user': ['user3@example.com']}}]
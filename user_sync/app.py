@@ -19,6 +19,7 @@
 # SOFTWARE.
 from sys import platform
 import logging
+import multiprocessing
 import os
 import platform
 import shutil
@@ -141,6 +142,9 @@ def main():
               metavar='ldap|okta|csv|adobe_console [path-to-file.csv]')
 @click.option('--exclude-unmapped-users/--include-unmapped-users', default=None,
               help='Exclude users that is not part of a mapped group from being created on Adobe side')
+@click.option('--incremental/--no-incremental', default=None,
+              help='only sync the directory users that changed since the last successful run, '
+                   'with a periodic full sync to catch changes made on the Adobe side.')
 @click.option('--process-groups/--no-process-groups', default=None,
               help='if membership in mapped groups differs between the enterprise directory and Adobe sides, '
                    'the group membership is updated on the Adobe side so that the memberships in mapped '
@@ -312,16 +316,7 @@ def init_log(logging_config):
     """
     :type logging_config: user_sync.config.DictConfig
     """
-
-    def progress(self, count, total, message="", *args, **kws):
-        if self.show_progress:
-            count = int(count)
-            total = int(total)
-            percent_done = round(100*count/total, 1) if total > 0 else 0
-            message = "{0}/{1} ({2}%) {3}".format(count, total, percent_done, message)
-        if message:
-            self._log(logging.INFO, message, args, **kws)
-    logging.Logger.progress = progress
+    logging.Logger.progress = user_sync.helper.log_progress
 
     builder = user_sync.config.OptionsBuilder(logging_config)
     builder.set_bool_value('log_to_file', False)
@@ -555,4 +550,7 @@ def certgen(randomize, key, certificate, overwrite):
 
 
 if __name__ == '__main__':
+    # in the frozen executable, the shard workers run this script too, and must be told apart
+    # before the command line is parsed
+    multiprocessing.freeze_support()
     main()
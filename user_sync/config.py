@@ -34,6 +34,9 @@ from user_sync import flags
 from user_sync.error import AssertionException
 import user_sync.post_sync.connectors as post_sync_connectors
 
+# name of the incremental sync state file, resolved relative to the main config file
+DEFAULT_INCREMENTAL_STATE_FILE = "user-sync-state.db"
+
 
 class ConfigLoader(object):
     # default values for reading configuration files
@@ -53,6 +56,7 @@ class ConfigLoader(object):
         'connector': ['ldap'],
         'encoding_name': 'utf8',
         'exclude_unmapped_users': False,
+        'incremental': False,
         'process_groups': False,
         'ssl_cert_verify': True,
         'strategy': 'sync',
@@ -556,6 +560,9 @@ class ConfigLoader(object):
                     raise AssertionException(validation_message)
                 exclude_groups.append(group.get_group_name())
             options['exclude_groups'] = exclude_groups
+        # merge the identity type and username exclusions into a single filter
+        options['user_exclusion_filter'] = user_sync.rules.UserExclusionFilter(options['exclude_identity_types'],
+                                                                               options['exclude_users'])
 
         # get the limits
         limits_config = self.main_config.get_dict_config('limits')
@@ -573,6 +580,30 @@ class ConfigLoader(object):
             except ValueError:
                 raise AssertionException("Unable to parse max_adobe_only_users value. Value must be a percentage or an integer.")
 
+        # get the performance settings, if any
+        performance_config = self.main_config.get_dict_config('performance', True)
+        if performance_config:
+            for key in ('bulk_group_actions', 'pipeline_umapi_load', 'stream_commands'):
+                value = performance_config.get_bool(key, True)
+                if value is not None:
+                    options[key] = value
+            for key in ('bulk_group_chunk_size', 'bulk_group_min_users', 'command_queue_size',
+                        'full_sync_interval', 'secondary_umapi_workers', 'shard_count'):
+                value = performance_config.get_int(key, True)
+                if value is not None:
+                    if value < 1:
+                        raise AssertionException("Performance setting %s must be at least 1" % key)
+                    options[key] = value
+            state_file = performance_config.get_string('incremental_state_file', True)
+            if state_file:
+                options['incremental_state_file'] = state_file
+        if not options['incremental_state_file']:
+            # the state file defaults to living next to the main config file,
+            # whether or not there is a performance section to carry it
+            config_filename = self.args['config_filename'] or self.config_defaults['config_filename']
+            options['incremental_state_file'] = os.path.join(os.path.dirname(os.path.abspath(config_filename)),
+                                                             DEFAULT_INCREMENTAL_STATE_FILE)
+
         # now get the directory extension, if any
         extension_config = self.get_directory_extension_options()
         options['extension_enabled'] = flags.get_flag('UST_EXTENSION')
@@ -909,13 +940,16 @@ class ConfigFileLoader:
                              '/directory_users/connectors/*': (True, False, None),
                              '/directory_users/extension': (True, False, None),
                              '/logging/file_log_directory': (False, False, "logs"),
+                             '/performance/incremental_state_file': (False, False, DEFAULT_INCREMENTAL_STATE_FILE),
         '/post_sync/connectors/sign_sync': (False, False, False),
         '/post_sync/connectors/future_feature': (False, False, False)
                              }
 
     # like ROOT_CONFIG_PATH_KEYS, but for non-root configuration files
     SUB_CONFIG_PATH_KEYS = {'/enterprise/priv_key_path': (True, False, None),
-                            '/integration/priv_key_path': (True, False, None)}
+                            '/integration/priv_key_path': (True, False, None),
+                            '/delta_load/snapshot_file': (False, False, None),
+                            '/group_dn_cache_file': (False, False, None)}
 
     @classmethod
     def load_root_config(cls, filename):
@@ -1045,7 +1079,7 @@ class ConfigFileLoader:
                     if isinstance(dictionary[key], dict):
                         cls.process_path_key(dictionary[key], keys, level + 1,
                                              must_exist, can_have_subdict, default_val)
-            elif key in dictionary:
+            elif key in dictionary and dictionary[key] is not None:
                 # if the key refers to a dictionary, recurse into it to go
                 # further down the path key
                 if isinstance(dictionary[key], dict):
@@ -203,7 +203,7 @@ class AdobeConsoleConnector(object):
 
         source_attributes['country'] = user['country'] = record['country']
 
-        user['source_attributes'] = source_attributes.copy()
+        user['source_attributes'] = source_attributes
         return user
 
     def iter_umapi_groups(self):
@@ -18,8 +18,16 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import datetime
+import hashlib
+import json
+import os
+import re
 import six
-import string
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import ldap3
 
@@ -28,10 +36,32 @@ import user_sync.connector.helper
 import user_sync.error
 import user_sync.identity_type
 from user_sync.error import AssertionException
+from user_sync.state import DirectorySnapshotStore
 
 import platform
 import ssl
 
+# the separators of the parts of a DN, with any spaces around them
+DN_SEPARATOR_PATTERN = re.compile(r'\s*(?<!\\)([,=+])\s*')
+
+# the number of groups found with each search by find_ldap_group_dns
+GROUP_BATCH_SIZE = 100
+
+# the name of the range of values that an attribute is returned in, like member;range=0-1499 or member;range=1500-*
+RANGED_ATTRIBUTE_PATTERN = re.compile(r'^([^;]+);range=(\d+)-(\d+|\*)$', re.IGNORECASE)
+
+# seconds before the start of a delta load from which changes are read again by the next one,
+# when the change_attribute is a timestamp
+CHANGE_TIME_MARGIN = 300
+
+# LDAP_MATCHING_RULE_IN_CHAIN, and the root DSE capabilities of the servers that support it (AD and AD LDS)
+MATCHING_RULE_IN_CHAIN = '1.2.840.113556.1.4.1941'
+ACTIVE_DIRECTORY_CAPABILITIES = frozenset(['1.2.840.113556.1.4.800', '1.2.840.113556.1.4.1851'])
+
+# number of member DNs read with each search in two-steps mode, unless dn_batch_size is set
+DN_BATCH_SIZE = 200
+
+
 def connector_metadata():
     metadata = {
         'name': LDAPDirectoryConnector.name
@@ -79,6 +109,15 @@ class LDAPDirectoryConnector(object):
         self.user_given_name_formatter = LDAPValueFormatter(options['user_given_name_format'])
         self.user_surname_formatter = LDAPValueFormatter(options['user_surname_format'])
         self.user_country_code_formatter = LDAPValueFormatter(options['user_country_code_format'])
+        self.user_extractor = user_sync.connector.helper.UserExtractor(OrderedDict([
+            ('firstname', self.user_given_name_formatter),
+            ('lastname', self.user_surname_formatter),
+            ('country', self.user_country_code_formatter),
+            ('identity_type', self.user_identity_type_formatter),
+            ('email', self.user_email_formatter),
+            ('username', self.user_username_formatter),
+            ('domain', self.user_domain_formatter),
+        ]))
 
         auth_method = options['authentication_method'].lower()
         auth_cred_required = ['simple', 'ntlm']
@@ -127,17 +166,85 @@ class LDAPDirectoryConnector(object):
         if options['require_tls_cert']:
             tls = ldap3.Tls(validate=ssl.CERT_REQUIRED, version=ssl.PROTOCOL_TLSv1_2)
         try:
-            server = ldap3.Server(host=options['host'], allowed_referral_hosts=True, tls=tls)
-            if server.ssl is False and tls is not None:
+            servers = [ldap3.Server(host=host, allowed_referral_hosts=True, tls=tls) for host in options['hosts']]
+            if tls is not None and any(server.ssl is False for server in servers):
                 auto_bind = ldap3.AUTO_BIND_TLS_BEFORE_BIND
-            connection = Connection(server, auto_bind=auto_bind, read_only=True, **auth)
+            # with several hosts, each connection of the pool is bound to the next available one
+            server = servers[0] if len(servers) == 1 else ldap3.ServerPool(servers, ldap3.ROUND_ROBIN, active=True)
+            self.connections = [self.create_connection(server, Connection, auto_bind=auto_bind, read_only=True, **auth)
+                                for _ in range(options['connection_pool_size'])]
         except Exception as e:
             raise AssertionException('LDAP connection failure: %s' % e)
-        self.connection = connection
-        logger.debug('Connected as %s', connection.extend.standard.who_am_i())
+        # the searches of each worker thread use the pooled connection it holds
+        self.thread_state = threading.local()
+        logger.debug('Connected as %s', self.connection.extend.standard.who_am_i())
+        # user_by_dn is shared by the worker threads, and only changed while holding user_lock.
+        # It is keyed by normalized DN (see normalize_dn), as are the other sets of DNs
+        self.user_lock = threading.Lock()
         self.user_by_dn = {}
+        # the DNs found in two-steps mode that are not users, or are out of scope
+        self.non_user_dns = set()
+        # the DNs of the groups found by resolve_group_dns
+        self.group_dn_by_name = {}
+        # whether every user has been read into user_by_dn, so a DN that is not there is not a user
+        self.all_users_read = False
+        # the direct members of the entries read in two-steps mode, by DN
+        self.member_dns_by_group_dn = {}
+        # whether the server is Active Directory, once its root DSE has been read
+        self.active_directory = None
+        # the number of member DNs to read with each search in two-steps mode, once it is known
+        self.dn_batch_size = None
         self.additional_group_filters = None
 
+    @property
+    def connection(self):
+        """
+        The connection to search with: the pooled connection held by the current thread, or else the first one
+        :rtype: ldap3.Connection
+        """
+        return getattr(self.thread_state, 'connection', self.connections[0])
+
+    def iter_pooled(self, function, items):
+        """
+        Call the function on each item, concurrently on the pooled connections if there are more than one,
+        and yield the results in the order of the items.
+        :type function: callable
+        :type items: list
+        :rtype iterable
+        """
+        if len(self.connections) < 2:
+            for item in items:
+                yield function(item)
+            return
+        free_connections = six.moves.queue.Queue()
+        for connection in self.connections:
+            free_connections.put(connection)
+
+        def call(item):
+            self.thread_state.connection = free_connections.get()
+            try:
+                return function(item)
+            finally:
+                free_connections.put(self.thread_state.connection)
+                del self.thread_state.connection
+
+        executor = ThreadPoolExecutor(len(self.connections))
+        try:
+            for result in executor.map(call, items):
+                yield result
+        finally:
+            executor.shutdown()
+
+    def create_connection(self, server, connection_class, **connection_args):
+        """
+        Open the connection to the server.  This is the one place the connector talks to ldap3
+        about connecting, so it can be replaced, for instance by a connection to a mock server.
+        :type server: ldap3.Server
+        :type connection_class: type
+        :rtype: ldap3.Connection
+        """
+        return connection_class(server, **connection_args)
+
     @staticmethod
     def get_options(caller_config):
         builder = user_sync.config.OptionsBuilder(caller_config)
@@ -159,19 +266,44 @@ class LDAPDirectoryConnector(object):
         builder.set_string_value('dynamic_group_member_attribute', None)
         builder.set_string_value('user_identity_type', None)
         builder.set_int_value('search_page_size', 200)
+        builder.set_bool_value('pipeline_user_load', False)
+        builder.set_dict_value('delta_load', None)
+        builder.set_string_value('group_dn_cache_file', None)
+        builder.set_int_value('group_dn_cache_ttl', 24)
         builder.set_string_value('logger_name', LDAPDirectoryConnector.name)
         builder.set_string_value('authentication_method', six.text_type('simple'))
         builder.set_string_value('username', None)
-        builder.require_string_value('host')
+        builder.set_int_value('connection_pool_size', 1)
+        builder.require_value('host', (str, list))
         builder.require_string_value('base_dn')
         options = builder.get_options()
 
+        options['hosts'] = [options['host']] if isinstance(options['host'], str) else options['host']
+        if not options['hosts'] or not all(isinstance(host, str) for host in options['hosts']):
+            raise AssertionException("'host' must be a host name or a list of host names")
+        if options['connection_pool_size'] < 1:
+            raise AssertionException("'connection_pool_size' must be at least 1")
+
+        if options['delta_load'] is not None:
+            delta_config = caller_config.get_dict_config('delta_load', True)
+            delta_builder = user_sync.config.OptionsBuilder(delta_config)
+            delta_builder.require_string_value('snapshot_file')
+            delta_builder.set_string_value('change_attribute', six.text_type('uSNChanged'))
+            delta_builder.set_int_value('full_load_interval', 24)
+            options['delta_load'] = delta_builder.get_options()
+            if options['delta_load']['change_attribute'] == 'uSNChanged' and len(options['hosts']) > 1:
+                raise AssertionException("Each domain controller has its own uSNChanged values, so 'delta_load' "
+                                         "with uSNChanged needs a single host")
+
         options['two_steps_enabled'] = False
         if options['two_steps_lookup'] is not None:
             ts_config = caller_config.get_dict_config('two_steps_lookup', True)
             ts_builder = user_sync.config.OptionsBuilder(ts_config)
             ts_builder.require_string_value('group_member_attribute_name')
             ts_builder.set_bool_value('nested_group', False)
+            ts_builder.set_bool_value('nested_group_in_chain', True)
+            ts_builder.set_int_value('dn_batch_size', None)
+            ts_builder.set_string_value('dn_attribute_name', None)
             options['two_steps_enabled'] = True
             options['two_steps_lookup'] = ts_builder.get_options()
             if options['group_member_filter_format']:
@@ -195,81 +327,416 @@ class LDAPDirectoryConnector(object):
         all_users_filter = six.text_type(options['all_users_filter'])
         group_member_filter_format = six.text_type(options['group_member_filter_format'])
         grouped_user_records = {}
+        in_chain = False
         if options['two_steps_enabled']:
-            group_member_attribute_name = six.text_type(options['two_steps_lookup']['group_member_attribute_name'])
+            two_steps_options = options['two_steps_lookup']
+            # the server can only expand the member attribute, through its memberOf back link
+            if (two_steps_options['nested_group'] and two_steps_options['nested_group_in_chain'] and
+                    six.text_type(two_steps_options['group_member_attribute_name']).lower() == 'member'):
+                in_chain = self.is_active_directory()
+                if not in_chain:
+                    self.logger.debug('The LDAP server does not support nested group expansion, '
+                                      'nested groups will be expanded by User Sync')
+            # known before the groups are read on the worker threads
+            self.get_dn_batch_size()
+
+        self.resolve_group_dns(groups)
 
-        # save all the users to memory for faster 2-steps lookup or all_users process
-        if all_users:
+        # in all users mode, the whole directory is only read once.  If group membership can be read
+        # from an attribute of the users, as with the default (memberOf={group_dn}) filter, it is taken
+        # from there as the users are read, and no group searches are needed.
+        membership_attribute = None
+        delta_load = options['delta_load'] is not None
+        if not options['two_steps_enabled']:
+            membership_attribute = self.get_membership_attribute(group_member_filter_format)
+        if options['pipeline_user_load'] and not delta_load:
+            if membership_attribute is not None:
+                return self.iter_pipelined_users(groups, extended_attributes, all_users, membership_attribute)
+            self.logger.warning("'pipeline_user_load' needs a group_member_filter_format like "
+                                "(memberOf={group_dn}), users are loaded before they are synced")
+        if not all_users or delta_load:
+            membership_attribute = None
+        if delta_load:
+            # the users all come from the snapshot, so the group members are found by DN.  The membership
+            # attribute of the stored users isn't used, as it doesn't change when a group does.
+            self.load_snapshot(extended_attributes)
+        elif all_users:
+            groups_by_dn = None
+            if membership_attribute is not None:
+                groups_by_dn = self.find_groups_by_dn(groups)
             try:
-                all_users_records = dict(self.iter_users(base_dn, all_users_filter, extended_attributes))
+                all_users_records = dict(self.iter_users(base_dn, all_users_filter, extended_attributes,
+                                                         membership_attribute, groups_by_dn))
             except Exception as e:
                 raise AssertionException('Unexpected LDAP failure reading all users: %s' % e)
+            self.all_users_read = True
 
-        # for each group that's required, do one search for the users of that group
-        for group in groups:
-            group_users = 0
-            group_dn = self.find_ldap_group_dn(group)
-            if not group_dn:
-                self.logger.warning("No group found for: %s", group)
-                continue
-            group_member_subfilter = self.format_ldap_query_string(group_member_filter_format, group_dn=group_dn)
-            if not group_member_subfilter.startswith('('):
-                group_member_subfilter = six.text_type('(') + group_member_subfilter + six.text_type(')')
-            user_subfilter = all_users_filter
-            if not user_subfilter.startswith('('):
-                user_subfilter = six.text_type('(') + user_subfilter + six.text_type(')')
-            group_user_filter = six.text_type('(&') + group_member_subfilter + user_subfilter + six.text_type(')')
-            group_users = 0
+        # for each group that's required, do one search for the users of that group.  With a connection pool,
+        # the groups are read concurrently, but their users are still given their groups in the order of the groups.
+        group_user_lists = self.iter_pooled(
+            lambda group: self.get_group_users(group, self.all_users_read, in_chain, extended_attributes),
+            groups if membership_attribute is None else [])
+        for group, group_users in six.moves.zip(groups, group_user_lists):
+            for user_dn, user in group_users:
+                user['groups'].append(group)
+                grouped_user_records[user_dn] = user
+            self.logger.debug('Count of users in group "%s": %d', group, len(group_users))
+
+        # if all users are requested, count the ones in groups, from the users that have been read
+        if all_users and groups:
+            grouped_users = sum(1 for user in six.itervalues(self.user_by_dn) if user['groups'])
+            self.logger.debug('Count of users in any groups: %d', grouped_users)
+            self.logger.debug('Count of users not in any groups: %d', len(self.user_by_dn) - grouped_users)
+
+        users = list(six.itervalues(self.user_by_dn))
+        if delta_load and not all_users:
+            users = [user for user in users if user['groups']]
+        self.logger.debug('Total users loaded: %d', len(users))
+        return users
+
+    def iter_pipelined_users(self, groups, extended_attributes, all_users, membership_attribute):
+        """
+        Read the users and their groups with a single paged search, and yield each user as soon as it is read,
+        so the rule processor maps the groups of each user while the next page is read.  The groups of a user
+        are taken from its membership attribute, so they are final as soon as the user is read.  This only
+        overlaps the directory load with group mapping: the rule processor keeps every user it is given.
+        If not all users are wanted, the search is for the users that are members of any of the groups.
+        :type groups: list(str)
+        :type extended_attributes: list(str)
+        :type all_users: bool
+        :param membership_attribute: the user attribute that lists the groups of a user
+        :type membership_attribute: str
+        :rtype iterable(dict)
+        """
+        base_dn = six.text_type(self.options['base_dn'])
+        users_filter = six.text_type(self.options['all_users_filter'])
+        groups_by_dn = self.find_groups_by_dn(groups)
+        if not all_users:
+            if not groups_by_dn:
+                self.logger.debug('Total users loaded: 0')
+                return
+            group_member_subfilter = six.text_type('(|') + six.text_type('').join(
+                self.format_ldap_query_string(six.text_type('(%s={group_dn})') % membership_attribute,
+                                              group_dn=group_dn) for group_dn in groups_by_dn) + six.text_type(')')
+            if not users_filter.startswith('('):
+                users_filter = six.text_type('(') + users_filter + six.text_type(')')
+            users_filter = six.text_type('(&') + users_filter + group_member_subfilter + six.text_type(')')
+        user_count = grouped_user_count = 0
+        try:
+            for _, user in self.iter_users(base_dn, users_filter, extended_attributes, membership_attribute,
+                                           groups_by_dn, keep_users=False):
+                user_count += 1
+                if user['groups']:
+                    grouped_user_count += 1
+                yield user
+        except AssertionException:
+            raise
+        except Exception as e:
+            raise AssertionException('Unexpected LDAP failure reading users: %s' % e)
+        if groups:
+            self.logger.debug('Count of users in any groups: %d', grouped_user_count)
+        self.logger.debug('Total users loaded: %d', user_count)
+
+    def load_snapshot(self, extended_attributes):
+        """
+        Read all the users into user_by_dn from the snapshot of the directory kept in the snapshot_file.
+        A full load, which reads every user and replaces the snapshot, is done on the first run, when the
+        settings that decide what is read change, and every full_load_interval hours.  Otherwise, only the
+        users that changed since the last load started are read, along with the DNs of all the users, to forget
+        the ones that were removed or no longer match the all_users_filter.  The mark that the next load starts
+        from is taken before the users are read (see get_change_mark), so the changes made while they are
+        being read are picked up by the next load.
+        :type extended_attributes: list(str)
+        """
+        options = self.options
+        delta_options = options['delta_load']
+        base_dn = six.text_type(options['base_dn'])
+        all_users_filter = six.text_type(options['all_users_filter'])
+        change_attribute = six.text_type(delta_options['change_attribute'])
+        user_attribute_names, extended_attributes = self.get_user_attribute_names(extended_attributes)
+        attribute_names = user_attribute_names + [change_attribute]
+        fingerprint = hashlib.sha1(repr([options['hosts'], base_dn, all_users_filter, change_attribute,
+                                         sorted(attribute_names)]).encode('utf8')).hexdigest()
+
+        store = DirectorySnapshotStore(delta_options['snapshot_file'])
+        try:
+            high_water_mark = store.get_setting('high_water_mark')
+            last_full_load = store.get_setting('last_full_load')
+            full_load_reason = None
+            if high_water_mark is None or last_full_load is None:
+                full_load_reason = 'no snapshot found'
+            elif store.get_setting('fingerprint') != fingerprint:
+                full_load_reason = 'directory settings have changed'
+            elif time.time() - float(last_full_load) >= delta_options['full_load_interval'] * 3600:
+                full_load_reason = 'full load interval has passed'
             try:
-                if options['two_steps_enabled']:
-                    for user_dn in self.iter_group_member_dns(group_dn, group_member_attribute_name):
-                        # check to make sure user_dn are within the base_dn scope
-                        if self.is_dn_within_base_dn_scope(base_dn, user_dn):
-                            # replace base_dn with user_dn and filter with all_users_filter to do user lookup based on DN
-                            result = list(self.iter_users(user_dn, all_users_filter, extended_attributes))
-                            if result:
-                                # iter_users should only return 1 user when doing two_steps lookup.
-                                if len(result) > 1:
-                                    raise AssertionException(
-                                        "Unexpected multiple LDAP object found in 'two_steps_lookup' mode for: %s" % user_dn)
-                                else:
-                                    user = result[0][1]
-                                    user['groups'].append(group)
-                                    group_users += 1
-                                    grouped_user_records[user_dn] = user
+                next_high_water_mark = self.get_change_mark(change_attribute)
+                if full_load_reason is not None:
+                    self.logger.info('Delta load: %s, reading all users', full_load_reason)
+                    last_full_load = time.time()
+                    changed_entries = dict(self.iter_search_result(base_dn, ldap3.SUBTREE, all_users_filter,
+                                                                   attribute_names))
+                    entries = {}
+                    removed_dns = []
                 else:
-                    for user_dn, user in self.iter_users(base_dn, group_user_filter, extended_attributes):
-                        user['groups'].append(group)
-                        group_users += 1
-                        grouped_user_records[user_dn] = user
+                    entries = store.get_entries()
+                    # later changes are numbered above the highestCommittedUSN, but a time mark is inclusive
+                    lowest_value = six.text_type(int(high_water_mark) + 1) if high_water_mark.isdigit() \
+                        else high_water_mark
+                    changed_filter = (six.text_type('(&') + self.format_filter(all_users_filter) +
+                                      six.text_type('(%s>=') % change_attribute +
+                                      self.format_ldap_query_string(six.text_type('{value}'), value=lowest_value) +
+                                      six.text_type('))'))
+                    changed_entries = dict(self.iter_search_result(base_dn, ldap3.SUBTREE, changed_filter,
+                                                                   attribute_names))
+                    # the DNs of all the users, to find the ones that are gone, and any that came
+                    # into the scope of the all_users_filter without changing themselves
+                    user_dns = set(dn for dn, _ in self.iter_search_result(base_dn, ldap3.SUBTREE, all_users_filter,
+                                                                           None))
+                    removed_dns = [dn for dn in entries if dn not in user_dns]
+                    for dn in user_dns:
+                        if dn not in entries and dn not in changed_entries:
+                            changed_entries.update(self.iter_search_result(dn, ldap3.BASE, all_users_filter,
+                                                                           attribute_names))
+                    self.logger.info('Delta load: %d users changed, %d removed', len(changed_entries),
+                                     len(removed_dns))
             except Exception as e:
-                raise AssertionException('Unexpected LDAP failure reading group members: %s' % e)
-            self.logger.debug('Count of users in group "%s": %d', group, group_users)
+                raise AssertionException('Unexpected LDAP failure reading users: %s' % e)
+
+            # the attributes are stored under the names they were asked for, as records are case-insensitive
+            changed_entries = dict((dn, DirectorySnapshotStore.encode_entry(
+                dict((name, record.get(name)) for name in user_attribute_names)))
+                for dn, record in six.iteritems(changed_entries))
+            store.update_entries(changed_entries, removed_dns, replace=full_load_reason is not None)
+            store.set_setting('high_water_mark', next_high_water_mark)
+            store.set_setting('last_full_load', repr(float(last_full_load)))
+            store.set_setting('fingerprint', fingerprint)
+        finally:
+            store.close()
 
-        # if all users are requested, do an additional search for all of them
-        if all_users:
-            ungrouped_users = 0
-            grouped_users = 0
+        for dn in removed_dns:
+            del entries[dn]
+        entries.update(changed_entries)
+        normalized_dns = {}
+        for dn, record in six.iteritems(entries):
+            user = self.create_user(dn, record, extended_attributes, None, None, normalized_dns)
+            if user is not None:
+                self.user_by_dn[self.normalize_dn(dn)] = user
+        self.all_users_read = True
+
+    @staticmethod
+    def format_change_value(value):
+        """
+        The value of the change attribute of an entry, as it is written in a filter: a number for
+        uSNChanged, or a generalized time for modifyTimestamp.
+        :type value: object
+        :rtype str
+        """
+        if isinstance(value, list):
+            value = value[0] if value else None
+        if value is None:
+            return None
+        if isinstance(value, datetime.datetime):
+            if value.utcoffset() is not None:
+                value = (value - value.utcoffset()).replace(tzinfo=None)
+            return six.text_type(value.strftime('%Y%m%d%H%M%SZ'))
+        return six.text_type(value)
+
+    def get_change_mark(self, change_attribute):
+        """
+        The value of the change attribute that the changes made from now on will be at least at.  For uSNChanged,
+        this is the highestCommittedUSN of the server, which every later change is numbered above.  For a
+        timestamp, it is the current time less CHANGE_TIME_MARGIN, as the clocks of the server and this
+        machine may differ, and changes are not always committed in the order of their timestamps.
+        :type change_attribute: str
+        :rtype str
+        """
+        if change_attribute.lower() == 'usnchanged':
+            highest_committed_usn = self.get_highest_committed_usn()
+            if highest_committed_usn is None or not highest_committed_usn.isdigit():
+                raise AssertionException('Unable to read the highestCommittedUSN of the server for delta_load')
+            return highest_committed_usn
+        return self.format_change_value(datetime.datetime.utcfromtimestamp(time.time() - CHANGE_TIME_MARGIN))
+
+    def get_highest_committed_usn(self):
+        """
+        The highestCommittedUSN in the root DSE of the server
+        :rtype str
+        """
+        try:
+            self.connection.search(search_base='', search_filter='(objectClass=*)', search_scope=ldap3.BASE,
+                                   attributes=['highestCommittedUSN'])
+            result = self.connection.entries
+        except Exception as e:
+            self.logger.debug('Unable to read the root DSE: %s', e)
+            return None
+        if not result:
+            return None
+        return self.format_change_value(LDAPValueFormatter.get_attribute_value(result[0].entry_attributes_as_dict,
+                                                                               'highestCommittedUSN'))
+
+    @staticmethod
+    def normalize_dn(dn):
+        """
+        The form in which DNs are compared: in lowercase, without spaces around the separators
+        :type dn: str
+        :rtype str
+        """
+        return DN_SEPARATOR_PATTERN.sub(r'\1', dn.lower()).strip()
+
+    @staticmethod
+    def format_filter(filter_string):
+        """
+        :param filter_string: a filter, with or without its outer parentheses
+        :type filter_string: str
+        :rtype str
+        """
+        if not filter_string.startswith('('):
+            filter_string = six.text_type('(') + filter_string + six.text_type(')')
+        return filter_string
+
+    def find_groups_by_dn(self, groups):
+        """
+        Find the DNs of the groups, concurrently if there is a connection pool.
+        :type groups: list(str)
+        :return: the (index, name) of the groups, by normalized DN
+        :rtype dict(str, list(tuple(int, str)))
+        """
+        groups_by_dn = {}
+        group_dns = self.iter_pooled(self.find_ldap_group_dn, groups)
+        for index, (group, group_dn) in enumerate(six.moves.zip(groups, group_dns)):
+            if not group_dn:
+                self.logger.warning("No group found for: %s", group)
+                continue
+            groups_by_dn.setdefault(self.normalize_dn(group_dn), []).append((index, group))
+        return groups_by_dn
+
+    def get_group_users(self, group, all_users, in_chain, extended_attributes):
+        """
+        Find a group, and read the users that are its members.  This runs on the worker threads of the connection pool.
+        :type group: str
+        :param all_users: whether all the users have been read already, so only their DNs are needed
+        :type all_users: bool
+        :param in_chain: whether the server expands the nested groups
+        :type in_chain: bool
+        :type extended_attributes: list(str)
+        :rtype list(tuple(str, dict))
+        """
+        options = self.options
+        base_dn = six.text_type(options['base_dn'])
+        group_dn = self.find_ldap_group_dn(group)
+        if not group_dn:
+            self.logger.warning("No group found for: %s", group)
+            return []
+        try:
+            if options['two_steps_enabled'] and not in_chain:
+                group_member_attribute_name = six.text_type(options['two_steps_lookup']['group_member_attribute_name'])
+                return list(self.iter_group_users_by_dn(group_dn, group_member_attribute_name, extended_attributes))
+            if in_chain:
+                group_user_filter = self.format_in_chain_filter(group_dn)
+            else:
+                group_user_filter = self.format_group_user_filter(group_dn)
+            if all_users:
+                user_dns = [user_dn for user_dn, _ in
+                            self.iter_search_result(base_dn, ldap3.SUBTREE, group_user_filter, None)]
+                users = ((user_dn, self.user_by_dn.get(self.normalize_dn(user_dn))) for user_dn in user_dns)
+                return [(user_dn, user) for user_dn, user in users if user is not None]
+            return list(self.iter_users(base_dn, group_user_filter, extended_attributes))
+        except Exception as e:
+            raise AssertionException('Unexpected LDAP failure reading group members: %s' % e)
+
+    def resolve_group_dns(self, groups):
+        """
+        Find the DNs of all the groups before their members are read.  The DNs found in earlier runs are kept
+        in the group_dn_cache_file, if there is one, for group_dn_cache_ttl hours, and each of those is checked
+        with a base search of the DN.  The other groups are found with a search for many groups at once, if
+        the groups can be told apart by the attribute the group_filter_format matches their names with.
+        The groups that are not found this way are looked up one at a time by find_ldap_group_dn.
+        :type groups: list(str)
+        """
+        options = self.options
+        cache = None
+        cached_dns = {}
+        if options['group_dn_cache_file']:
+            cache = GroupDNCache(options['group_dn_cache_file'], [options['hosts'], options['base_dn'],
+                                                                  options['group_filter_format']], self.logger)
+            cached_dns = cache.get_group_dns(groups, options['group_dn_cache_ttl'] * 3600)
+        cached_groups = [group for group in groups if group in cached_dns]
+        valid_groups = self.iter_pooled(lambda group: self.is_group_dn_valid(group, cached_dns[group]), cached_groups)
+        for group, valid in six.moves.zip(cached_groups, list(valid_groups)):
+            if valid:
+                self.group_dn_by_name[group] = cached_dns[group]
+        missing_groups = [group for group in groups if group not in self.group_dn_by_name]
+        found_dns = self.find_ldap_group_dns(missing_groups)
+        self.group_dn_by_name.update(found_dns)
+        self.logger.debug('Group DNs: %d found in the cache, %d found with one search, %d to look up one at a time',
+                          len(self.group_dn_by_name) - len(found_dns), len(found_dns),
+                          len(missing_groups) - len(found_dns))
+        if cache is not None:
+            cache.update_group_dns(found_dns)
+
+    def is_group_dn_valid(self, group, group_dn):
+        """
+        Whether the entry with the DN still matches the group filter for the group
+        :type group: str
+        :type group_dn: str
+        :rtype bool
+        """
+        filter_string = self.format_ldap_query_string(six.text_type(self.options['group_filter_format']), group=group)
+        try:
+            self.connection.search(search_base=group_dn, search_scope=ldap3.BASE, search_filter=filter_string)
+            return len(self.connection.entries) == 1
+        except Exception as e:
+            self.logger.debug('Cached DN of group %s is no longer valid: %s', group, e)
+            return False
+
+    def find_ldap_group_dns(self, groups):
+        """
+        Find the DNs of many groups with one search for each batch of groups, if the group_filter_format matches
+        the group name with an attribute, like the cn in (&(objectCategory=group)(cn={group})).  The entries found
+        are matched to the groups by that attribute.
+        :type groups: list(str)
+        :return: the DN of each group that was found
+        :rtype dict(str, str)
+        """
+        group_filter_format = six.text_type(self.options['group_filter_format'])
+        match = re.search(r'\(\s*([\w-]+)\s*=\s*\{group\}\s*\)', group_filter_format)
+        if match is None or group_filter_format.count('{group}') != 1:
+            return {}
+        name_attribute = match.group(1)
+        base_dn = six.text_type(self.options['base_dn'])
+        group_dns = {}
+        for start in range(0, len(groups), GROUP_BATCH_SIZE):
+            batch = groups[start:start + GROUP_BATCH_SIZE]
+            groups_by_name = {}
+            for group in batch:
+                groups_by_name.setdefault(group.lower(), []).append(group)
+            filter_string = six.text_type('(|') + six.text_type('').join(
+                self.format_filter(self.format_ldap_query_string(group_filter_format, group=group))
+                for group in batch) + six.text_type(')')
             try:
-                for user_dn, user in self.iter_users(base_dn, all_users_filter, extended_attributes):
-                    if not user['groups']:
-                        ungrouped_users += 1
-                    else:
-                        grouped_users += 1
-                if groups:
-                    self.logger.debug('Count of users in any groups: %d', grouped_users)
-                    self.logger.debug('Count of users not in any groups: %d', ungrouped_users)
+                for group_dn, record in self.iter_search_result(base_dn, ldap3.SUBTREE, filter_string,
+                                                                [name_attribute]):
+                    names = LDAPValueFormatter.get_attribute_value(record, name_attribute) or []
+                    if isinstance(names, six.string_types):
+                        names = [names]
+                    for name in names:
+                        for group in groups_by_name.get(six.text_type(name).lower(), []):
+                            if group_dns.setdefault(group, group_dn) != group_dn:
+                                raise AssertionException("Multiple LDAP groups found for: %s" % group)
+            except AssertionException:
+                raise
             except Exception as e:
-                raise AssertionException('Unexpected LDAP failure reading all users: %s' % e)
-
-        self.logger.debug('Total users loaded: %d', len(self.user_by_dn))
-        return six.itervalues(self.user_by_dn)
+                raise AssertionException('Unexpected LDAP failure reading group info: %s' % e)
+        return group_dns
 
     def find_ldap_group_dn(self, group):
         """
         :type group: str
         :rtype str
         """
+        if group in self.group_dn_by_name:
+            return self.group_dn_by_name[group]
         connection = self.connection
         options = self.options
         base_dn = six.text_type(options['base_dn'])
@@ -289,143 +756,437 @@ class LDAPDirectoryConnector(object):
                     group_dn = result[0].entry_dn
         return group_dn
 
-    def iter_group_member_dns(self, group_dn, member_attribute, searched_dns=None):
+    @staticmethod
+    def get_membership_attribute(group_member_filter_format):
         """
-        return group memberships dns from specified membership attribute in LDAP group object
-        :type group: str
+        The user attribute that lists the groups of a user, if the group member filter is just a match
+        of that attribute with the group DN, like the default (memberOf={group_dn}).
+        :type group_member_filter_format: str
+        :rtype str
+        """
+        match = re.match(r'^\(?\s*([\w-]+)\s*=\s*\{group_dn\}\s*\)?$', group_member_filter_format.strip())
+        return match.group(1) if match else None
+
+    @staticmethod
+    def get_groups_from_attribute(record, membership_attribute, groups_by_dn, normalized_dns):
+        """
+        The groups of a user, in the order they were requested, from the group DNs in the membership attribute.
+        :type record: dict
+        :type membership_attribute: str
+        :param groups_by_dn: the (index, name) of the requested groups, by lowercase DN
+        :type groups_by_dn: dict(str, list(tuple(int, str)))
+        :param normalized_dns: cache of the lowercase form of the DNs seen so far
+        :type normalized_dns: dict(str, str)
+        :rtype list(str)
+        """
+        member_of = LDAPValueFormatter.get_attribute_value(record, membership_attribute)
+        if not member_of:
+            return []
+        if isinstance(member_of, six.string_types):
+            member_of = [member_of]
+        user_groups = []
+        for group_dn in member_of:
+            normalized_dn = normalized_dns.get(group_dn)
+            if normalized_dn is None:
+                normalized_dn = normalized_dns[group_dn] = LDAPDirectoryConnector.normalize_dn(group_dn)
+            user_groups.extend(groups_by_dn.get(normalized_dn, ()))
+        if len(user_groups) > 1:
+            user_groups.sort()
+        return [group for _, group in user_groups]
+
+    def iter_group_users_by_dn(self, group_dn, member_attribute, extended_attributes, searched_dns=None):
+        """
+        The users that are members of a group, looked up by the DNs in its membership attribute.  If nested_group
+        is enabled, the members that turn out not to be users are then read as groups in turn, so the users are
+        never read to see whether they have members.  Each DN is looked up only once, even if groups are members
+        of each other.
+        :type group_dn: str
         :type member_attribute: str
-        :rtype iterable(str)
+        :type extended_attributes: list(str)
+        :param searched_dns: the normalized DNs seen so far, and the group the search started from
+        :type searched_dns: set(str)
+        :rtype iterable(tuple(str, dict))
         """
         if searched_dns is None:
-            searched_dns = []
+            # a group that is nested in one of its own members is not read again while its members are still read
+            searched_dns = set([self.normalize_dn(group_dn)])
+        new_member_dns = []
+
+        def iter_new_member_dns():
+            for member_dn in self.get_group_member_dns(group_dn, member_attribute):
+                normalized_dn = self.normalize_dn(member_dn)
+                if normalized_dn not in searched_dns:
+                    searched_dns.add(normalized_dn)
+                    new_member_dns.append((member_dn, normalized_dn))
+                    yield member_dn
+
+        user_dns = set()
+        for user_dn, user in self.iter_users_by_dn(iter_new_member_dns(), extended_attributes):
+            user_dns.add(self.normalize_dn(user_dn))
+            yield user_dn, user
+        if self.options['two_steps_lookup']['nested_group']:
+            for member_dn, normalized_dn in new_member_dns:
+                if normalized_dn not in user_dns:
+                    for user_dn, user in self.iter_group_users_by_dn(member_dn, member_attribute, extended_attributes,
+                                                                     searched_dns):
+                        yield user_dn, user
+
+    def get_group_member_dns(self, group_dn, member_attribute):
+        """
+        The DNs in the membership attribute of an entry.  Each entry is read at most once per run, so
+        groups that are members of several mapped groups are only expanded once, and the users that
+        have been read already are known to have no members.  The DNs of an entry that has not been
+        read yet are returned as each range of them is read.
+        :type group_dn: str
+        :type member_attribute: str
+        :rtype iterable(str)
+        """
+        if self.normalize_dn(group_dn) in self.user_by_dn:
+            return []
+        member_dns = self.member_dns_by_group_dn.get(group_dn)
+        if member_dns is None:
+            return self.iter_ranged_member_dns(group_dn, member_attribute)
+        return member_dns
+
+    def iter_ranged_member_dns(self, group_dn, member_attribute):
+        """
+        Read the DNs in the membership attribute of an entry, a range of values at a time if the server
+        returns them that way, as Active Directory does for attributes with more than MaxValRange values.
+        The DNs of each range are returned before the next one is read, and the whole list is kept in
+        member_dns_by_group_dn once it has been read.
+        :type group_dn: str
+        :type member_attribute: str
+        :rtype iterable(str)
+        """
         connection = self.connection
-        nested_group_search = self.options['two_steps_lookup']['nested_group']
-        try:
-            connection.search(search_base=group_dn, search_filter='(objectClass=*)', search_scope=ldap3.SUBTREE,
-                              attributes=member_attribute)
-            result = connection.entries
-            if result is not None:
-                record = result[0].entry_attributes_as_dict
-                member_dns = LDAPValueFormatter.get_attribute_value(record, member_attribute)
-                for member_dn in member_dns or []:
-                    # if nested_group search enabled, look up DN and see if group member attribute exist in that object
-                    # This will recurse through until there is no nested group.
-                    if member_dn not in searched_dns:
-                        searched_dns.append(member_dn)
-                        if nested_group_search:
-                            nested_members = self.iter_group_member_dns(member_dn, member_attribute, searched_dns)
-                            for nested_member_dn in nested_members:
-                                yield nested_member_dn
-                        yield member_dn
-        except Exception as e:
-            self.logger.warning('Error lookup %s : %s', group_dn, e)
-            pass
+        member_dns = []
+        attribute_name = member_attribute
+        while attribute_name:
+            auto_range = connection.auto_range
+            # ldap3 would otherwise read all the ranges before returning any of them
+            connection.auto_range = False
+            try:
+                connection.search(search_base=group_dn, search_filter='(objectClass=*)',
+                                  search_scope=ldap3.BASE, attributes=[attribute_name])
+                response = [entry for entry in connection.response or [] if entry['type'] == 'searchResEntry']
+            except Exception as e:
+                self.logger.warning('Error lookup %s : %s', group_dn, e)
+                return
+            finally:
+                connection.auto_range = auto_range
+            if not response:
+                break
+            values, attribute_name = self.get_ranged_values(response[0]['attributes'], member_attribute)
+            member_dns.extend(values)
+            for member_dn in values:
+                yield member_dn
+        self.member_dns_by_group_dn[group_dn] = member_dns
 
-    def iter_users(self, base_dn, users_filter, extended_attributes):
-        options = self.options
-        dynamic_group_member_attribute = options['dynamic_group_member_attribute']
-
-        user_attribute_names = []
-        user_attribute_names.extend(self.user_given_name_formatter.get_attribute_names())
-        user_attribute_names.extend(self.user_surname_formatter.get_attribute_names())
-        user_attribute_names.extend(self.user_country_code_formatter.get_attribute_names())
-        user_attribute_names.extend(self.user_identity_type_formatter.get_attribute_names())
-        user_attribute_names.extend(self.user_email_formatter.get_attribute_names())
-        user_attribute_names.extend(self.user_username_formatter.get_attribute_names())
-        user_attribute_names.extend(self.user_domain_formatter.get_attribute_names())
+    @staticmethod
+    def get_ranged_values(attributes, attribute_name):
+        """
+        The values of an attribute in a search result, and the name to request the next range of values with,
+        if they were returned as a range (like member;range=0-1499) that is not the last one (like member;range=1500-*).
+        :type attributes: dict
+        :type attribute_name: str
+        :rtype tuple(list(str), str)
+        """
+        for name, values in six.iteritems(attributes):
+            match = RANGED_ATTRIBUTE_PATTERN.match(name)
+            if match and match.group(1).lower() == attribute_name.lower():
+                values = [values] if isinstance(values, six.string_types) else list(values or [])
+                if match.group(3) == '*' or not values:
+                    return values, None
+                return values, six.text_type('%s;range=%d-*') % (attribute_name, int(match.group(3)) + 1)
+        values = LDAPValueFormatter.get_attribute_value(attributes, attribute_name) or []
+        return [values] if isinstance(values, six.string_types) else list(values), None
+
+    def is_active_directory(self):
+        """
+        Whether the server is Active Directory or AD LDS, which they announce in the supportedCapabilities
+        of their root DSE.  Only they can expand nested groups with the LDAP_MATCHING_RULE_IN_CHAIN
+        matching rule, and they keep the DN of each entry in its distinguishedName attribute.
+        The root DSE is read once per connector.
+        :rtype bool
+        """
+        if self.active_directory is None:
+            self.active_directory = False
+            try:
+                self.connection.search(search_base='', search_filter='(objectClass=*)', search_scope=ldap3.BASE,
+                                       attributes=['supportedCapabilities'])
+                result = self.connection.entries
+            except Exception as e:
+                self.logger.debug('Unable to read the root DSE: %s', e)
+                return False
+            if not result:
+                return False
+            capabilities = LDAPValueFormatter.get_attribute_value(result[0].entry_attributes_as_dict,
+                                                                  'supportedCapabilities') or []
+            if isinstance(capabilities, six.string_types):
+                capabilities = [capabilities]
+            self.active_directory = bool(ACTIVE_DIRECTORY_CAPABILITIES.intersection(capabilities))
+        return self.active_directory
+
+    def get_dn_batch_size(self):
+        """
+        The number of member DNs to read with each search in two-steps mode.  Unless a dn_batch_size is set,
+        members are read DN_BATCH_SIZE at a time if they can be searched for by an attribute that holds their
+        DN: the distinguishedName of Active Directory, or the dn_attribute_name, if one is set.  Otherwise,
+        each member is read with a base search of its DN.
+        :rtype int
+        """
+        if self.dn_batch_size is None:
+            two_steps_options = self.options['two_steps_lookup']
+            batch_size = two_steps_options['dn_batch_size']
+            if batch_size is None:
+                batch_size = 0
+                if two_steps_options['dn_attribute_name'] or self.is_active_directory():
+                    batch_size = DN_BATCH_SIZE
+            self.dn_batch_size = batch_size
+        return self.dn_batch_size
+
+    def format_in_chain_filter(self, group_dn):
+        """
+        The filter for the users that are members of the group, directly or through nested groups,
+        using the memberOf back link of the member attribute.
+        :type group_dn: str
+        :rtype str
+        """
+        user_subfilter = six.text_type(self.options['all_users_filter'])
+        if not user_subfilter.startswith('('):
+            user_subfilter = six.text_type('(') + user_subfilter + six.text_type(')')
+        in_chain_subfilter = self.format_ldap_query_string(
+            six.text_type('(memberOf:%s:={group_dn})') % MATCHING_RULE_IN_CHAIN, group_dn=group_dn)
+        return six.text_type('(&') + user_subfilter + in_chain_subfilter + six.text_type(')')
+
+    def iter_users_by_dn(self, member_dns, extended_attributes):
+        """
+        Look up the users with the given DNs that match the all_users_filter, as group members are
+        in two-steps mode.  Users that have been read already are not looked up again, and neither
+        are DNs that were found not to be users, or that are outside the base DN.  Once all the users
+        have been read, nothing else is looked up.  Other DNs are looked up in batches, with a single
+        search of the base DN for each batch, or one at a time with a base search (see get_dn_batch_size).
+        :type member_dns: iterable(str)
+        :type extended_attributes: list(str)
+        :rtype iterable(tuple(str, dict))
+        """
+        base_dn = six.text_type(self.options['base_dn'])
+        all_users_filter = six.text_type(self.options['all_users_filter'])
+        batch_size = self.get_dn_batch_size()
+        batch = []
+        for member_dn in member_dns:
+            # member values may differ from the DNs of the entries in case and spacing, as the server
+            # compares DNs without regard to them
+            normalized_dn = self.normalize_dn(member_dn)
+            user = self.user_by_dn.get(normalized_dn)
+            if user is not None:
+                yield member_dn, user
+                continue
+            if normalized_dn in self.non_user_dns or self.all_users_read:
+                continue
+            # check to make sure member_dn is within the base_dn scope
+            if not self.is_dn_within_base_dn_scope(base_dn, member_dn):
+                self.non_user_dns.add(normalized_dn)
+                continue
+            if batch_size > 1:
+                batch.append(member_dn)
+                if len(batch) >= batch_size:
+                    for user_dn, user in self.iter_user_dn_batch(batch, extended_attributes):
+                        yield user_dn, user
+                    batch = []
+            else:
+                user_dn = user = None
+                for user_dn, user in self.iter_users(member_dn, all_users_filter, extended_attributes,
+                                                     scope=ldap3.BASE):
+                    yield user_dn, user
+                if user is None:
+                    self.non_user_dns.add(normalized_dn)
+        if batch:
+            for user_dn, user in self.iter_user_dn_batch(batch, extended_attributes):
+                yield user_dn, user
+
+    def iter_user_dn_batch(self, member_dns, extended_attributes):
+        """
+        Look up a batch of DNs with one search, for the entries with one of the DNs in the dn_attribute_name
+        attribute that match the all_users_filter.  The DNs that are not found are remembered as non-users.
+        :type member_dns: list(str)
+        :type extended_attributes: list(str)
+        :rtype iterable(tuple(str, dict))
+        """
+        dn_attribute_name = six.text_type(self.options['two_steps_lookup']['dn_attribute_name'] or 'distinguishedName')
+        dn_subfilter = six.text_type('').join(
+            self.format_ldap_query_string(six.text_type('(%s={dn})') % dn_attribute_name, dn=member_dn)
+            for member_dn in member_dns)
+        user_subfilter = six.text_type(self.options['all_users_filter'])
+        if not user_subfilter.startswith('('):
+            user_subfilter = six.text_type('(') + user_subfilter + six.text_type(')')
+        batch_filter = six.text_type('(&') + user_subfilter + six.text_type('(|') + dn_subfilter + six.text_type('))')
+        found_dns = set()
+        for user_dn, user in self.iter_users(six.text_type(self.options['base_dn']), batch_filter,
+                                             extended_attributes):
+            found_dns.add(self.normalize_dn(user_dn))
+            yield user_dn, user
+        self.non_user_dns.update(normalized_dn for normalized_dn in (self.normalize_dn(member_dn)
+                                                                     for member_dn in member_dns)
+                                 if normalized_dn not in found_dns)
+
+    def iter_users(self, base_dn, users_filter, extended_attributes, membership_attribute=None, groups_by_dn=None,
+                   scope=ldap3.SUBTREE, keep_users=True):
+        """
+        :type base_dn: str
+        :type users_filter: str
+        :type extended_attributes: list(str)
+        :param membership_attribute: if given, the groups of each user are read from this attribute
+        :type membership_attribute: str
+        :param groups_by_dn: the (index, name) of the groups to read, by normalized DN
+        :type groups_by_dn: dict(str, list(tuple(int, str)))
+        :param scope: the search scope, e.g. ldap3.BASE to read a single user
+        :type scope: str
+        :param keep_users: whether to keep the users in user_by_dn, to be found again by later searches
+        :type keep_users: bool
+        :rtype iterable(tuple(str, dict))
+        """
+        user_attribute_names, extended_attributes = self.get_user_attribute_names(extended_attributes,
+                                                                                  membership_attribute)
+        normalized_dns = {}
+
+        result_iter = self.iter_search_result(base_dn, scope, users_filter, user_attribute_names)
+        for dn, record in result_iter:
+            if dn is None:
+                continue
+            if not keep_users:
+                user = self.create_user(dn, record, extended_attributes, membership_attribute, groups_by_dn,
+                                        normalized_dns)
+                if user is not None:
+                    yield (dn, user)
+                continue
+            # the same user can be found by several threads at once, but is only created once
+            normalized_dn = self.normalize_dn(dn)
+            with self.user_lock:
+                user = self.user_by_dn.get(normalized_dn)
+                if user is None:
+                    user = self.create_user(dn, record, extended_attributes, membership_attribute, groups_by_dn,
+                                            normalized_dns)
+                    if user is None:
+                        continue
+                    self.user_by_dn[normalized_dn] = user
+            yield (dn, user)
+
+    def get_user_attribute_names(self, extended_attributes, membership_attribute=None):
+        """
+        The attributes to read for each user.
+        :type extended_attributes: list(str)
+        :type membership_attribute: str
+        :return: the names of all the attributes, and of the extended attributes that are not used otherwise
+        :rtype tuple(list(str), list(str))
+        """
+        dynamic_group_member_attribute = self.options['dynamic_group_member_attribute']
+        user_attribute_names = list(self.user_extractor.get_attribute_names())
         if dynamic_group_member_attribute is not None:
             user_attribute_names.append(six.text_type(dynamic_group_member_attribute))
+        if membership_attribute is not None and membership_attribute not in user_attribute_names:
+            user_attribute_names.append(six.text_type(membership_attribute))
 
         extended_attributes = [six.text_type(attr) for attr in extended_attributes]
         extended_attributes = list(set(extended_attributes) - set(user_attribute_names))
         user_attribute_names.extend(extended_attributes)
+        return user_attribute_names, extended_attributes
 
-        result_iter = self.iter_search_result(base_dn, ldap3.SUBTREE, users_filter, user_attribute_names)
-        for dn, record in result_iter:
-            if dn is None:
-                continue
-            if dn in self.user_by_dn:
-                yield (dn, self.user_by_dn[dn])
-                continue
+    def create_user(self, dn, record, extended_attributes, membership_attribute, groups_by_dn, normalized_dns):
+        """
+        Make a user from the attributes of a directory entry.
+        :type dn: str
+        :type record: dict
+        :type extended_attributes: list(str)
+        :type membership_attribute: str
+        :type groups_by_dn: dict(str, list(tuple(int, str)))
+        :type normalized_dns: dict(str, str)
+        :return: the user, or None if the entry can't be synced
+        :rtype dict
+        """
+        dynamic_group_member_attribute = self.options['dynamic_group_member_attribute']
+        fields = self.user_extractor.extract(record)
 
-            email, last_attribute_name = self.user_email_formatter.generate_value(record)
-            email = email.strip() if email else None
-            if not email:
-                if last_attribute_name is not None:
-                    self.logger.warning('Skipping user with dn %s: empty email attribute (%s)', dn, last_attribute_name)
-                continue
+        email, last_attribute_name = fields['email']
+        email = email.strip() if email else None
+        if not email:
+            if last_attribute_name is not None:
+                self.logger.warning('Skipping user with dn %s: empty email attribute (%s)', dn, last_attribute_name)
+            return None
 
-            source_attributes = {}
+        source_attributes = {}
 
-            user = user_sync.connector.helper.create_blank_user()
-            source_attributes['email'] = email
-            user['email'] = email
+        user = user_sync.connector.helper.create_blank_user()
+        source_attributes['email'] = email
+        user['email'] = email
 
-            identity_type, last_attribute_name = self.user_identity_type_formatter.generate_value(record)
-            if last_attribute_name and not identity_type:
-                self.logger.warning('No identity_type attribute (%s) for user with dn: %s, defaulting to %s',
-                                    last_attribute_name, dn, self.user_identity_type)
-            source_attributes['identity_type'] = identity_type
-            if not identity_type:
-                user['identity_type'] = self.user_identity_type
-            else:
-                try:
-                    user['identity_type'] = user_sync.identity_type.parse_identity_type(identity_type)
-                except AssertionException as e:
-                    self.logger.warning('Skipping user with dn %s: %s', dn, e)
-                    continue
-
-            username, last_attribute_name = self.user_username_formatter.generate_value(record)
-            username = username.strip() if username else None
-            source_attributes['username'] = username
-            if username:
-                user['username'] = username
-            else:
-                if last_attribute_name:
-                    self.logger.warning('No username attribute (%s) for user with dn: %s, default to email (%s)',
-                                        last_attribute_name, dn, email)
-                user['username'] = email
-
-            domain, last_attribute_name = self.user_domain_formatter.generate_value(record)
-            domain = domain.strip() if domain else None
-            source_attributes['domain'] = domain
-            if domain:
-                user['domain'] = domain
-            elif username != email:
-                user['domain'] = email[email.find('@') + 1:]
-            elif last_attribute_name:
-                self.logger.warning('No domain attribute (%s) for user with dn: %s', last_attribute_name, dn)
-
-            given_name_value, last_attribute_name = self.user_given_name_formatter.generate_value(record)
-            source_attributes['givenName'] = given_name_value
-            if given_name_value is not None:
-                user['firstname'] = given_name_value
-            elif last_attribute_name:
-                self.logger.warning('No given name attribute (%s) for user with dn: %s', last_attribute_name, dn)
-            sn_value, last_attribute_name = self.user_surname_formatter.generate_value(record)
-            source_attributes['sn'] = sn_value
-            if sn_value is not None:
-                user['lastname'] = sn_value
-            elif last_attribute_name:
-                self.logger.warning('No surname attribute (%s) for user with dn: %s', last_attribute_name, dn)
-            c_value, last_attribute_name = self.user_country_code_formatter.generate_value(record)
-            source_attributes['c'] = c_value
-            if c_value is not None:
-                user['country'] = c_value.upper()
-
-            user['member_groups'] = self.get_member_groups(record, dynamic_group_member_attribute) if self.additional_group_filters else []
-
-            if extended_attributes is not None:
-                for extended_attribute in extended_attributes:
-                    extended_attribute_value = LDAPValueFormatter.get_attribute_value(record, extended_attribute)
-                    source_attributes[extended_attribute] = extended_attribute_value
-
-            user['source_attributes'] = source_attributes.copy()
-            if 'groups' not in user:
-                user['groups'] = []
-            self.user_by_dn[dn] = user
+        identity_type, last_attribute_name = fields['identity_type']
+        if last_attribute_name and not identity_type:
+            self.logger.warning('No identity_type attribute (%s) for user with dn: %s, defaulting to %s',
+                                last_attribute_name, dn, self.user_identity_type)
+        source_attributes['identity_type'] = identity_type
+        if not identity_type:
+            user['identity_type'] = self.user_identity_type
+        else:
+            try:
+                user['identity_type'] = user_sync.identity_type.parse_identity_type(identity_type)
+            except AssertionException as e:
+                self.logger.warning('Skipping user with dn %s: %s', dn, e)
+                return None
 
-            yield (dn, user)
+        username, last_attribute_name = fields['username']
+        username = username.strip() if username else None
+        source_attributes['username'] = username
+        if username:
+            user['username'] = username
+        else:
+            if last_attribute_name:
+                self.logger.warning('No username attribute (%s) for user with dn: %s, default to email (%s)',
+                                    last_attribute_name, dn, email)
+            user['username'] = email
+
+        domain, last_attribute_name = fields['domain']
+        domain = domain.strip() if domain else None
+        source_attributes['domain'] = domain
+        if domain:
+            user['domain'] = domain
+        elif username != email:
+            user['domain'] = email[email.find('@') + 1:]
+        elif last_attribute_name:
+            self.logger.warning('No domain attribute (%s) for user with dn: %s', last_attribute_name, dn)
+
+        given_name_value, last_attribute_name = fields['firstname']
+        source_attributes['givenName'] = given_name_value
+        if given_name_value is not None:
+            user['firstname'] = given_name_value
+        elif last_attribute_name:
+            self.logger.warning('No given name attribute (%s) for user with dn: %s', last_attribute_name, dn)
+        sn_value, last_attribute_name = fields['lastname']
+        source_attributes['sn'] = sn_value
+        if sn_value is not None:
+            user['lastname'] = sn_value
+        elif last_attribute_name:
+            self.logger.warning('No surname attribute (%s) for user with dn: %s', last_attribute_name, dn)
+        c_value, last_attribute_name = fields['country']
+        source_attributes['c'] = c_value
+        if c_value is not None:
+            user['country'] = c_value.upper()
+
+        user['member_groups'] = (self.get_member_groups(record, dynamic_group_member_attribute)
+                                 if self.additional_group_filters else [])
+
+        if extended_attributes is not None:
+            for extended_attribute in extended_attributes:
+                extended_attribute_value = LDAPValueFormatter.get_attribute_value(record, extended_attribute)
+                source_attributes[extended_attribute] = extended_attribute_value
+
+        user['source_attributes'] = source_attributes
+        if membership_attribute is not None:
+            user['groups'] = self.get_groups_from_attribute(record, membership_attribute, groups_by_dn,
+                                                            normalized_dns)
+        if 'groups' not in user:
+            user['groups'] = []
+        return user
 
     def get_member_groups(self, user, dynamic_group_member_attribute):
         """
@@ -540,53 +1301,77 @@ class LDAPDirectoryConnector(object):
         if (not (base_dn and base_dn.strip())):
             return True
 
-        split_base_dn = ldap3.utils.dn.parse_dn(base_dn.lower())
-        split_dn = ldap3.utils.dn.parse_dn(dn.lower())
+        split_base_dn = ldap3.utils.dn.parse_dn(LDAPDirectoryConnector.normalize_dn(base_dn))
+        split_dn = ldap3.utils.dn.parse_dn(LDAPDirectoryConnector.normalize_dn(dn))
         if split_base_dn == split_dn[-len(split_base_dn):]:
             return True
         return False
 
 
-class LDAPValueFormatter(object):
-    encoding = 'utf8'
+class GroupDNCache(object):
+    """
+    The DNs of groups found in earlier runs, kept in a JSON file with the time each was found.
+    The cache is for one directory and group filter: it is emptied if they change.
+    """
 
-    def __init__(self, string_format):
+    def __init__(self, path, settings, logger):
         """
-        The format string must be a unicode or ascii string: see notes above about being careful in Py2!
+        :type path: str
+        :param settings: the settings that decide which DN each group has
+        :type settings: list
+        :type logger: logging.Logger
         """
-        if string_format is None:
-            attribute_names = []
-        else:
-            string_format = six.text_type(string_format)  # force unicode so attribute values are unicode
-            formatter = string.Formatter()
-            attribute_names = [six.text_type(item[1]) for item in formatter.parse(string_format) if item[1]]
-        self.string_format = string_format
-        self.attribute_names = attribute_names
+        self.path = path
+        self.logger = logger
+        self.key = hashlib.sha1(repr(settings).encode('utf8')).hexdigest()
+        self.groups = {}
+        if os.path.exists(path):
+            try:
+                with open(path) as cache_file:
+                    content = json.load(cache_file)
+                if content.get('key') == self.key:
+                    self.groups = content['groups']
+            except (IOError, ValueError, KeyError, AttributeError) as e:
+                logger.warning("Ignoring unreadable group DN cache '%s': %s", path, e)
 
-    def get_attribute_names(self):
+    def get_group_dns(self, groups, max_age):
         """
-        :rtype list(str)
+        :type groups: list(str)
+        :param max_age: seconds for which a DN is kept
+        :type max_age: int
+        :return: the cached DN of each group that has one that is recent enough
+        :rtype dict(str, str)
         """
-        return self.attribute_names
+        now = time.time()
+        return dict((group, self.groups[group]['dn']) for group in groups
+                    if group in self.groups and now - self.groups[group]['found'] < max_age)
 
-    def generate_value(self, record):
+    def update_group_dns(self, group_dns):
         """
-        :type record: dict
-        :rtype (unicode, unicode)
-        """
-        result = None
-        attribute_name = None
-        if self.string_format is not None:
-            values = {}
-            for attribute_name in self.attribute_names:
-                value = self.get_attribute_value(record, attribute_name, first_only=True)
-                if value is None:
-                    values = None
-                    break
-                values[attribute_name] = value
-            if values is not None:
-                result = self.string_format.format(**values)
-        return result, attribute_name
+        Add the newly found DNs, and save the cache.  The DNs that were in the cache keep the time they were found.
+        :type group_dns: dict(str, str)
+        """
+        now = time.time()
+        for group, group_dn in six.iteritems(group_dns):
+            self.groups[group] = {'dn': group_dn, 'found': now}
+        temp_path = self.path + '.tmp'
+        try:
+            with open(temp_path, 'w') as cache_file:
+                json.dump({'key': self.key, 'groups': self.groups}, cache_file, indent=1, sort_keys=True)
+            os.replace(temp_path, self.path)
+        except (IOError, OSError) as e:
+            self.logger.warning("Unable to save group DN cache '%s': %s", self.path, e)
+
+
+class LDAPValueFormatter(user_sync.connector.helper.AttributeTemplate):
+    encoding = 'utf8'
+
+    def get_value(self, record, attribute_name):
+        # get_attribute_value(record, attribute_name, first_only=True), inlined as it is called for every attribute
+        attribute_values = record.get(attribute_name)
+        if not attribute_values:
+            return None
+        return attribute_values if isinstance(attribute_values, str) else attribute_values[0]
 
     @classmethod
     def get_attribute_value(cls, attributes, attribute_name, first_only=False):
@@ -20,7 +20,7 @@
 
 import okta
 import six
-import string
+from collections import OrderedDict
 from okta.framework.OktaError import OktaError
 
 import user_sync.config
@@ -91,6 +91,15 @@ class OktaDirectoryConnector(object):
         self.user_given_name_formatter = OKTAValueFormatter(options['user_given_name_format'])
         self.user_surname_formatter = OKTAValueFormatter(options['user_surname_format'])
         self.user_country_code_formatter = OKTAValueFormatter(options['user_country_code_format'])
+        self.user_extractor = user_sync.connector.helper.UserExtractor(OrderedDict([
+            ('firstname', self.user_given_name_formatter),
+            ('lastname', self.user_surname_formatter),
+            ('country', self.user_country_code_formatter),
+            ('identity_type', self.user_identity_type_formatter),
+            ('email', self.user_email_formatter),
+            ('username', self.user_username_formatter),
+            ('domain', self.user_domain_formatter),
+        ]))
 
         self.users_client = None
         self.groups_client = None
@@ -186,14 +195,7 @@ class OktaDirectoryConnector(object):
         :rtype iterator(str, str)
         """
 
-        user_attribute_names = []
-        user_attribute_names.extend(self.user_given_name_formatter.get_attribute_names())
-        user_attribute_names.extend(self.user_surname_formatter.get_attribute_names())
-        user_attribute_names.extend(self.user_country_code_formatter.get_attribute_names())
-        user_attribute_names.extend(self.user_identity_type_formatter.get_attribute_names())
-        user_attribute_names.extend(self.user_email_formatter.get_attribute_names())
-        user_attribute_names.extend(self.user_username_formatter.get_attribute_names())
-        user_attribute_names.extend(self.user_domain_formatter.get_attribute_names())
+        user_attribute_names = list(self.user_extractor.get_attribute_names())
         extended_attributes = list(set(extended_attributes) - set(user_attribute_names))
         user_attribute_names.extend(extended_attributes)
 
@@ -218,7 +220,8 @@ class OktaDirectoryConnector(object):
 
         source_attributes = {}
         source_attributes['login'] = login = OKTAValueFormatter.get_profile_value(record,'login')
-        email, last_attribute_name = self.user_email_formatter.generate_value(record)
+        fields = self.user_extractor.extract(record)
+        email, last_attribute_name = fields['email']
         email = email.strip() if email else None
         if not email:
             if last_attribute_name is not None:
@@ -241,7 +244,7 @@ class OktaDirectoryConnector(object):
 
 
 
-        username, last_attribute_name = self.user_username_formatter.generate_value(record)
+        username, last_attribute_name = fields['username']
         username = username.strip() if username else None
         source_attributes['username'] = username
         if username:
@@ -252,7 +255,7 @@ class OktaDirectoryConnector(object):
                                     last_attribute_name, login, email)
             user['username'] = email
 
-        domain, last_attribute_name = self.user_domain_formatter.generate_value(record)
+        domain, last_attribute_name = fields['domain']
         domain = domain.strip() if domain else None
         source_attributes['domain'] = domain
         if domain:
@@ -262,19 +265,19 @@ class OktaDirectoryConnector(object):
         elif last_attribute_name:
             self.logger.warning('No domain attribute (%s) for user with login: %s', last_attribute_name, login)
 
-        first_name_value, last_attribute_name = self.user_given_name_formatter.generate_value(record)
+        first_name_value, last_attribute_name = fields['firstname']
         source_attributes['firstName'] = first_name_value
         if first_name_value is not None:
             user['firstname'] = first_name_value
         elif last_attribute_name:
             self.logger.warning('No given name attribute (%s) for user with login: %s', last_attribute_name, login)
-        last_name_value, last_attribute_name = self.user_surname_formatter.generate_value(record)
+        last_name_value, last_attribute_name = fields['lastname']
         source_attributes['lastName'] = last_name_value
         if last_name_value is not None:
             user['lastname'] = last_name_value
         elif last_attribute_name:
             self.logger.warning('No last name attribute (%s) for user with login: %s', last_attribute_name, login)
-        country_value, last_attribute_name = self.user_country_code_formatter.generate_value(record)
+        country_value, last_attribute_name = fields['country']
         source_attributes['c'] = country_value
         if country_value is not None:
             user['country'] = country_value.upper()
@@ -286,7 +289,7 @@ class OktaDirectoryConnector(object):
                 extended_attribute_value = OKTAValueFormatter.get_profile_value(record, extended_attribute)
                 source_attributes[extended_attribute] = extended_attribute_value
 
-        user['source_attributes'] = source_attributes.copy()
+        user['source_attributes'] = source_attributes
         return user
 
     def iter_search_result(self, filter_string, attributes):
@@ -324,27 +327,11 @@ class OktaDirectoryConnector(object):
             raise AssertionException("Error filtering with predicate (%s): %s" % (filter_string, e))
 
 
-class OKTAValueFormatter(object):
+class OKTAValueFormatter(user_sync.connector.helper.AttributeTemplate):
     encoding = 'utf8'
 
-    def __init__(self, string_format):
-        """
-        The format string must be a unicode or ascii string: see notes above about being careful in Py2!
-        """
-        if string_format is None:
-            attribute_names = []
-        else:
-            string_format = six.text_type(string_format)  # force unicode so attribute values are unicode
-            formatter = string.Formatter()
-            attribute_names = [six.text_type(item[1]) for item in formatter.parse(string_format) if item[1]]
-        self.string_format = string_format
-        self.attribute_names = attribute_names
-
-    def get_attribute_names(self):
-        """
-        :rtype list(str)
-        """
-        return self.attribute_names
+    def get_value(self, record, attribute_name):
+        return self.get_profile_value(record, attribute_name)
 
     @staticmethod
     def get_extended_attribute_dict(attributes):
@@ -356,25 +343,6 @@ class OKTAValueFormatter(object):
 
         return attr_dict
 
-    def generate_value(self, record):
-        """
-        :type record: dict
-        :rtype (unicode, unicode)
-        """
-        result = None
-        attribute_name = None
-        if self.string_format is not None:
-            values = {}
-            for attribute_name in self.attribute_names:
-                value = self.get_profile_value(record, attribute_name)
-                if value is None:
-                    values = None
-                    break
-                values[attribute_name] = value
-            if values is not None:
-                result = self.string_format.format(**values)
-        return result, attribute_name
-
     @classmethod
     def get_profile_value(cls, record, attribute_name):
         """
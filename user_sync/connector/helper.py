@@ -19,6 +19,12 @@
 # SOFTWARE.
 
 import logging
+import string
+from collections import OrderedDict
+
+import six
+
+from user_sync.helper import SlotRecord
 
 
 def create_logger(options):
@@ -31,19 +37,167 @@ def create_logger(options):
     return logging.getLogger(logger_name)
      
 
+class DirectoryUser(SlotRecord):
+    """
+    A user read from the directory.  It behaves like a dict, and any key that is not
+    listed here can still be set, so connectors and hooks can use it as one.
+    """
+    __slots__ = ('identity_type', 'username', 'domain', 'firstname', 'lastname', 'email', 'groups', 'country',
+                 'uid', 'member_groups', 'source_attributes')
+    _fields = frozenset(__slots__)
+
+
 def create_blank_user():
     """
-    :rtype dict
-    """
-    user = {
-        "identity_type": None,
-        "username": None,
-        "domain": None,
-        "firstname": None,
-        "lastname": None,
-        "email": None,
-        "groups": [],
-        "country": None,
-    }
+    :rtype DirectoryUser
+    """
+    user = DirectoryUser(
+        identity_type=None,
+        username=None,
+        domain=None,
+        firstname=None,
+        lastname=None,
+        email=None,
+        groups=[],
+        country=None,
+    )
     return user
 
+
+class AttributeTemplate(object):
+    """
+    A format string of attribute names, like '{givenName} {sn}', that is parsed once and then filled in
+    for many records.  A format that is a single attribute, like '{mail}', is filled in by just fetching
+    that attribute, and other formats by joining their literal text with the formatted values.
+    Records are read like dicts; subclasses for other kinds of record override get_value.
+    """
+
+    def __init__(self, string_format):
+        """
+        The format string must be a unicode or ascii string: see notes above about being careful in Py2!
+        :type string_format: str
+        """
+        attribute_names = []
+        parts = []
+        if string_format is not None:
+            string_format = six.text_type(string_format)  # force unicode so attribute values are unicode
+            for literal_text, field_name, format_spec, conversion in string.Formatter().parse(string_format):
+                if field_name:
+                    attribute_names.append(six.text_type(field_name))
+                    if conversion or '{' in format_spec or '.' in field_name or '[' in field_name:
+                        # conversions, nested fields and attribute lookups are left to str.format
+                        parts = None
+                if parts is not None:
+                    parts.append((literal_text, six.text_type(field_name) if field_name else None, format_spec))
+        self.string_format = string_format
+        self.attribute_names = attribute_names
+        self.unique_attribute_names = list(OrderedDict.fromkeys(attribute_names))
+        self.last_attribute_name = attribute_names[-1] if attribute_names else None
+        self.parts = parts
+        # pick the simplest way to fill in the format
+        if string_format is None:
+            self.render = self.render_nothing
+        elif parts and len(parts) == 1 and not parts[0][0] and parts[0][1] and not parts[0][2]:
+            self.render = self.render_attribute
+        elif parts is None:
+            self.render = self.render_format
+        else:
+            self.render = self.render_parts
+
+    def get_attribute_names(self):
+        """
+        :rtype list(str)
+        """
+        return self.attribute_names
+
+    def get_value(self, record, attribute_name):
+        """
+        The value of an attribute of a record, or None if it has none.  Override this to read records
+        that are not dicts of attribute values.
+        :type record: dict
+        :type attribute_name: str
+        """
+        return record.get(attribute_name)
+
+    def generate_value(self, record):
+        """
+        :type record: object
+        :return: the value, or None if an attribute had no value, and the name of the last attribute read
+        :rtype (unicode, unicode)
+        """
+        values = {}
+        for attribute_name in self.unique_attribute_names:
+            values[attribute_name] = value = self.get_value(record, attribute_name)
+            if value is None:
+                return None, attribute_name
+        return self.render(values)
+
+    @staticmethod
+    def render_nothing(values):
+        return None, None
+
+    def render_attribute(self, values):
+        attribute_name = self.last_attribute_name
+        value = values[attribute_name]
+        if value is None or isinstance(value, six.text_type):
+            return value, attribute_name
+        return format(value, ''), attribute_name
+
+    def render_format(self, values):
+        for attribute_name in self.unique_attribute_names:
+            if values[attribute_name] is None:
+                return None, attribute_name
+        return self.string_format.format(**values), self.last_attribute_name
+
+    def render_parts(self, values):
+        for attribute_name in self.unique_attribute_names:
+            if values[attribute_name] is None:
+                return None, attribute_name
+        result = []
+        for literal_text, field_name, format_spec in self.parts:
+            result.append(literal_text)
+            if field_name is not None:
+                result.append(format(values[field_name], format_spec))
+        return six.text_type('').join(result), self.last_attribute_name
+
+
+class UserExtractor(object):
+    """
+    The templates of the fields of a user, made once per connector.  extract reads each attribute that any
+    template needs once, and fills in all the fields of a user from those values.
+    """
+
+    def __init__(self, templates):
+        """
+        :param templates: the template of each field
+        :type templates: OrderedDict(str, AttributeTemplate)
+        """
+        # the function that reads each attribute, from the first template that needs it
+        value_getters = OrderedDict()
+        for template in six.itervalues(templates):
+            for attribute_name in template.get_attribute_names():
+                value_getters.setdefault(attribute_name, template.get_value)
+        self.value_getters = list(six.iteritems(value_getters))
+        self.renderers = [(field, template.render) for field, template in six.iteritems(templates)]
+        self.attribute_names = list(value_getters)
+
+    def get_attribute_names(self):
+        """
+        The names of all the attributes of the fields, each once.
+        :rtype list(str)
+        """
+        return self.attribute_names
+
+    def extract(self, record):
+        """
+        :type record: object
+        :return: the value of each field, with the name of the last attribute read for it, as generate_value does
+        :rtype dict(str, tuple(unicode, unicode))
+        """
+        values = {}
+        for attribute_name, get_value in self.value_getters:
+            values[attribute_name] = get_value(record, attribute_name)
+        fields = {}
+        for field, render in self.renderers:
+            fields[field] = render(values)
+        return fields
@@ -22,6 +22,10 @@ import json
 import logging
 # import helper
 import math
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 import jwt
 import six
@@ -42,12 +46,17 @@ except:
     pass
 
 
+# the most actions that UMAPI accepts in a single call
+MAX_BATCH_SIZE = 10
+
+
 class UmapiConnector(object):
     def __init__(self, name, caller_options):
         """
         :type name: str
         :type caller_options: dict
         """
+        self.init_args = (name, caller_options)
         self.name = 'umapi' + name
         caller_config = user_sync.config.DictConfig(self.name + ' configuration', caller_options)
         self.trusted = caller_config.get_bool('trusted', True)
@@ -68,6 +77,11 @@ class UmapiConnector(object):
         server_builder.set_int_value('timeout', 120)
         server_builder.set_int_value('retries', 3)
         server_builder.set_value('ssl_verify', bool, None)
+        server_builder.set_int_value('batch_size', 10)
+        server_builder.set_value('flush_interval', (int, float), 0)
+        server_builder.set_int_value('concurrent_requests', 1)
+        server_builder.set_int_value('page_fetch_workers', 1)
+        server_builder.set_bool_value('page_fetch_ordered', True)
         options['server'] = server_options = server_builder.get_options()
 
         enterprise_config = caller_config.get_dict_config('enterprise')
@@ -80,6 +94,11 @@ class UmapiConnector(object):
         # Override with old umapi entry if present
         if options['server']['ssl_verify'] is not None:
             options['ssl_cert_verify'] = options['server']['ssl_verify']
+        if not 1 <= server_options['batch_size'] <= MAX_BATCH_SIZE:
+            raise AssertionException("%s: server batch_size must be from 1 to %d, as UMAPI accepts at most %d "
+                                     "actions per call" % (self.name, MAX_BATCH_SIZE, MAX_BATCH_SIZE))
+        if server_options['concurrent_requests'] < 1:
+            raise AssertionException("%s: server concurrent_requests must be at least 1" % self.name)
 
         self.options = options
         self.logger = logger = user_sync.connector.helper.create_logger(options)
@@ -95,51 +114,147 @@ class UmapiConnector(object):
         # open the connection
         um_endpoint = "https://" + server_options['host'] + server_options['endpoint']
         logger.debug('%s: creating connection for org %s at endpoint %s', self.name, org_id, um_endpoint)
+        connection_args = dict(
+            org_id=org_id,
+            ims_host=ims_host,
+            ims_endpoint_jwt=server_options['ims_endpoint_jwt'],
+            user_management_endpoint=um_endpoint,
+            test_mode=options['test_mode'],
+            user_agent="user-sync/" + app_version,
+            logger=self.logger,
+            timeout_seconds=float(server_options['timeout']),
+            retry_max_attempts=server_options['retries'] + 1,
+            ssl_verify=options['ssl_cert_verify'],
+            throttle_actions=server_options['batch_size']
+        )
         try:
-            self.connection = connection = umapi_client.Connection(
-                org_id=org_id,
-                auth_dict=auth_dict,
-                ims_host=ims_host,
-                ims_endpoint_jwt=server_options['ims_endpoint_jwt'],
-                user_management_endpoint=um_endpoint,
-                test_mode=options['test_mode'],
-                user_agent="user-sync/" + app_version,
-                logger=self.logger,
-                timeout_seconds=float(server_options['timeout']),
-                retry_max_attempts=server_options['retries'] + 1,
-                ssl_verify=options['ssl_cert_verify']
-            )
+            self.connection = connection = umapi_client.Connection(auth_dict=auth_dict, **connection_args)
         except Exception as e:
             raise AssertionException("Connection to org %s at endpoint %s failed: %s" % (org_id, um_endpoint, e))
         logger.debug('%s: connection established', self.name)
-        # wrap the connection in an action manager
-        self.action_manager = ActionManager(connection, org_id, logger)
+        # wrap the connection in an action manager.  Concurrent requests are sent on connections of their own,
+        # which share the authorization of this one.
+        self.action_manager = ActionManager(connection, org_id, logger,
+                                            batch_size=server_options['batch_size'],
+                                            flush_interval=server_options['flush_interval'],
+                                            concurrent_requests=server_options['concurrent_requests'],
+                                            connection_factory=lambda: umapi_client.Connection(
+                                                auth=connection.auth, **connection_args))
+
+    def __getstate__(self):
+        # a connector sent to another process, like a shard worker, connects again there with the same options
+        return {'init_args': self.init_args}
+
+    def __setstate__(self, state):
+        self.__init__(*state['init_args'])
 
     def get_users(self):
         return list(self.iter_users())
 
     def iter_users(self, in_group=None):
-        users = {}
+        emails = set()
         total_count = 0
-        page_count = 0
-        page_size = 0
-        page_number = 0
         try:
             u_query = umapi_client.UsersQuery(self.connection, in_group=in_group)
-            for i, u in enumerate(u_query):
-                total_count, page_count, page_size, page_number = u_query.stats()
+            if self.options['server']['page_fetch_workers'] > 1:
+                user_source = self.iter_prefetched_query(u_query)
+            else:
+                user_source = self.iter_query(u_query)
+            for i, (u, total_count, page_size) in enumerate(user_source):
                 email = u['email']
-                if not (email in users):
-                    users[email] = u
-                    yield u
+                if not (email in emails):
+                    emails.add(email)
+                    yield UmapiUser(u)
 
-                if (i + 1) % page_size == 0:
-                    self.logger.progress(len(users), total_count)
+                if (i + 1) % max(page_size, 1) == 0:
+                    self.logger.progress(len(emails), total_count)
             self.logger.progress(total_count, total_count)
 
         except umapi_client.UnavailableError as e:
             raise AssertionException("Error contacting UMAPI server: %s" % e)
 
+    @staticmethod
+    def iter_query(query):
+        """
+        Walk the query pages one after another.
+        :type query: umapi_client.QueryMultiple
+        :return: iterator of (result, total_count, page_size)
+        """
+        for result in query:
+            total_count, _, page_size, _ = query.stats()
+            yield result, total_count, page_size
+
+    def iter_prefetched_query(self, query):
+        """
+        Fetch the first page of the query to learn the page count, then fetch the
+        remaining pages with a bounded pool of workers.  Pages are yielded in order,
+        unless page_fetch_ordered is turned off, in which case each page is yielded
+        as soon as it arrives.  If the server reports more pages once the known ones
+        are done, those are fetched one at a time until the last page is seen.
+        :type query: umapi_client.QueryMultiple
+        :return: iterator of (result, total_count, page_size)
+        """
+        workers = self.options['server']['page_fetch_workers']
+        ordered = self.options['server']['page_fetch_ordered']
+
+        def fetch_page(page_index):
+            return self.connection.query_multiple(query.object_type, page_index, query.url_params, query.query_params)
+
+        results, last_page, total_count, page_count, _, page_size = fetch_page(0)
+        for result in results:
+            yield result, total_count, page_size
+        if last_page or not results:
+            return
+
+        next_page = 1
+        last_page_seen = False
+        executor = ThreadPoolExecutor(workers)
+        # keep a few pages ahead of the consumer, but never the whole listing
+        pending = deque()
+        try:
+            while pending or (next_page < page_count and not last_page_seen):
+                while not last_page_seen and next_page < page_count and len(pending) < workers * 2:
+                    pending.append(executor.submit(fetch_page, next_page))
+                    next_page += 1
+                if ordered:
+                    done = [pending.popleft()]
+                else:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        pending.remove(future)
+                for future in done:
+                    results, last_page, total_count, _, _, page_size = future.result()
+                    for result in results:
+                        yield result, total_count, page_size
+                    last_page_seen = last_page_seen or last_page or not results
+                if ordered and last_page_seen:
+                    break
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+        # the listing grew while we were reading it
+        while not last_page_seen:
+            results, last_page, total_count, _, _, page_size = fetch_page(next_page)
+            next_page += 1
+            for result in results:
+                yield result, total_count, page_size
+            last_page_seen = last_page or not results
+
+    def get_user(self, email):
+        """
+        Look up a single user by email.
+        :type email: str
+        :return: the user, or None if there is no such user
+        :rtype: dict
+        """
+        try:
+            user = umapi_client.UserQuery(self.connection, email).result()
+            return UmapiUser(user) if user else None
+        except umapi_client.UnavailableError as e:
+            raise AssertionException("Error contacting UMAPI server: %s" % e)
+
     def get_groups(self):
         return list(self.iter_groups())
 
@@ -164,7 +279,8 @@ class UmapiConnector(object):
         if name:
             group = umapi_client.UserGroupAction(group_name=name)
             group.create(description="Automatically created by User Sync Tool")
-            return self.connection.execute_single(group)
+            # send right away, so the group exists before any user actions refer to it
+            return self.connection.execute_single(group, immediate=True)
 
     def get_action_manager(self):
         return self.action_manager
@@ -186,9 +302,21 @@ class UmapiConnector(object):
 
     def end_sync(self):
         """Send the end sync signal to the connector"""
+        # requests already in flight must finish first, so the signal goes out with the last one
+        self.action_manager.wait_for_sent_batches()
         self.connection.end_sync()
 
 
+class UmapiUser(user_sync.helper.SlotRecord):
+    """
+    A user read from UMAPI.  It behaves like the dict that UMAPI returned, but keeps
+    the usual fields in slots; any other field is kept as well.
+    """
+    __slots__ = ('id', 'type', 'username', 'domain', 'email', 'firstname', 'lastname', 'country', 'groups',
+                 'status')
+    _fields = frozenset(__slots__)
+
+
 class Commands(object):
     def __init__(self, identity_type=None, email=None, username=None, domain=None):
         """
@@ -282,14 +410,56 @@ class Commands(object):
         return params
 
 
+class GroupCommands(object):
+    def __init__(self, group_name):
+        """
+        Commands that change the membership of a single user group.
+        Users are specified by email address.
+        :type group_name: str
+        """
+        self.group_name = group_name
+        self.do_list = []
+
+    def __str__(self):
+        return "GroupCommand "+str(self.__dict__)
+
+    def __repr__(self):
+        return "GroupCommand "+str(self.__dict__)
+
+    def add_users(self, users_to_add):
+        """
+        :type users_to_add: list(str)
+        """
+        if users_to_add:
+            self.do_list.append(('add_users', {'users': list(users_to_add)}))
+
+    def remove_users(self, users_to_remove):
+        """
+        :type users_to_remove: list(str)
+        """
+        if users_to_remove:
+            self.do_list.append(('remove_users', {'users': list(users_to_remove)}))
+
+    def __len__(self):
+        return len(self.do_list)
+
+
 class ActionManager(object):
     next_request_id = 1
+    next_request_id_lock = threading.Lock()
 
-    def __init__(self, connection, org_id, logger):
+    def __init__(self, connection, org_id, logger, batch_size=10, flush_interval=0, concurrent_requests=1,
+                 connection_factory=None):
         """
         :type connection: umapi_client.Connection
         :type org_id: str
         :type logger: logging.Logger
+        :type batch_size: int
+        :type flush_interval: float
+        :type concurrent_requests: int
+        :param connection_factory: makes the connection that each worker thread sends its batches on,
+            which is needed with more than one concurrent request
+        :type connection_factory: callable() -> umapi_client.Connection
         """
         self.action_count = 0
         self.error_count = 0
@@ -297,17 +467,39 @@ class ActionManager(object):
         self.connection = connection
         self.org_id = org_id
         self.logger = logger.getChild('action')
+        # actions are collected into batches which are sent to the server in a single call.
+        # a batch is sent when it is full, or when its oldest action has waited flush_interval seconds.
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.batch_start_time = None
+        # with more than one concurrent request, batches are sent from a pool of worker threads.
+        # The workers only talk to the server, each on a connection of its own, as a connection keeps
+        # the sync signals and its counts without a lock.  Results are always processed on the
+        # calling thread, so counts and callbacks are never touched concurrently.
+        self.concurrent_requests = concurrent_requests
+        self.executor = None
+        if concurrent_requests > 1:
+            if connection_factory is None:
+                raise AssertionException('A connection factory is needed for concurrent requests')
+            self.executor = ThreadPoolExecutor(concurrent_requests)
+        self.connection_factory = connection_factory
+        self.worker_state = threading.local()
+        self.sent_batches = []
 
     def get_statistics(self):
         """Return the count of actions sent so far, and how many had errors."""
         return self.action_count, self.error_count
 
     def get_next_request_id(self):
-        request_id = 'action_%d' % ActionManager.next_request_id
-        ActionManager.next_request_id += 1
+        # action managers for different connectors may be fed from different threads
+        with ActionManager.next_request_id_lock:
+            request_id = 'action_%d' % ActionManager.next_request_id
+            ActionManager.next_request_id += 1
         return request_id
 
     def create_action(self, commands):
+        if isinstance(commands, GroupCommands):
+            return self.create_group_action(commands)
         identity_type = commands.identity_type
         email = commands.email
         username = commands.username
@@ -335,6 +527,16 @@ class ActionManager(object):
             command_function(**command_param)
         return action
 
+    def create_group_action(self, commands):
+        """
+        :type commands: GroupCommands
+        :rtype: umapi_client.UserGroupAction
+        """
+        action = umapi_client.UserGroupAction(group_name=commands.group_name, requestID=self.get_next_request_id())
+        for command_name, command_param in commands.do_list:
+            getattr(action, command_name)(**command_param)
+        return action
+
     def add_action(self, action, callback=None):
         """
         :type action: umapi_client.UserAction
@@ -344,47 +546,115 @@ class ActionManager(object):
             'action': action,
             'callback': callback
         }
+        if not self.items:
+            self.batch_start_time = time.time()
         self.items.append(item)
         self.action_count += 1
         self.logger.debug('Added action: %s', json.dumps(action.wire_dict()))
-        self._execute_action(action)
+        if self.is_batch_ready():
+            self._execute_batch()
 
     def has_work(self):
-        return len(self.items) > 0
+        return len(self.items) > 0 or len(self.sent_batches) > 0
 
-    def _execute_action(self, action):
+    def is_batch_ready(self):
         """
-        :type action: umapi_client.UserAction
+        A batch is ready when it is full, or when a flush interval is set and has elapsed.
+        :rtype: bool
+        """
+        if len(self.items) >= self.batch_size:
+            return True
+        return bool(self.flush_interval) and time.time() - self.batch_start_time >= self.flush_interval
+
+    @staticmethod
+    def get_action_user_key(action):
+        """
+        The key used to keep all the actions for one user in order.  Group actions, which list their users
+        in their commands, are instead never sent while any other batch is in flight.
+        :type action: umapi_client.Action
+        :rtype: tuple(str, str, str)
+        """
+        frame = action.frame
+        return tuple(user_sync.helper.normalize_string(frame.get(key)) for key in ('user', 'domain', 'usergroup'))
+
+    def _execute_batch(self):
+        """
+        Send all the pending actions to the server in a single call.  The connection
+        only splits the batch if some action has more commands than it allows per action,
+        so we attribute results by our own items rather than the server count.
         """
+        batch, self.items = self.items, []
+        actions = [item['action'] for item in batch]
+        if self.executor is None:
+            self.process_sent_items(batch, self._send_actions(actions, self.connection))
+            return
+        if self.connection.sync_started or self.connection.sync_ended or any(
+                isinstance(action, umapi_client.UserGroupAction) for action in actions):
+            # the sync signal is sent with the next batch on the connection it was given to, and it must
+            # come before (or after) all the other batches.  Group actions can touch any user, so they
+            # must not pass the actions of those users either.  Batches like these are sent alone.
+            self.wait_for_sent_batches()
+            self.process_sent_items(batch, self._send_actions(actions, self.connection))
+            return
+        # a user's actions must reach the server in order, so wait for any batch
+        # in flight that has actions for the same users before sending this one.
+        user_keys = set(self.get_action_user_key(action) for action in actions)
+        while any(user_keys & keys for _, _, keys in self.sent_batches):
+            self._complete_oldest_batch()
+        # bound the number of requests in flight
+        while len(self.sent_batches) >= self.concurrent_requests:
+            self._complete_oldest_batch()
+        future = self.executor.submit(self._send_actions, actions)
+        self.sent_batches.append((future, batch, user_keys))
+
+    def _send_actions(self, actions, connection=None):
+        """
+        Send actions to the server; this may run on a worker thread.
+        :param connection: the connection to send them on, by default that of the worker thread
+        :type connection: umapi_client.Connection
+        :return: the batch-level error, if there was one
+        """
+        if connection is None:
+            connection = self.get_worker_connection()
         try:
-            _, sent, _ = self.connection.execute_single(action)
+            connection.execute_multiple(actions, immediate=True)
         except umapi_client.BatchError as e:
-            self.process_sent_items(e.statistics[1], e)
+            return e
         except umapi_client.UnavailableError as e:
             raise AssertionException("Error contacting UMAPI server: %s" % e)
-        else:
-            self.process_sent_items(sent)
+        return None
+
+    def get_worker_connection(self):
+        """
+        The connection of the current worker thread, which is made the first time it sends a batch
+        :rtype: umapi_client.Connection
+        """
+        connection = getattr(self.worker_state, 'connection', None)
+        if connection is None:
+            connection = self.worker_state.connection = self.connection_factory()
+        return connection
+
+    def _complete_oldest_batch(self):
+        future, batch, _ = self.sent_batches.pop(0)
+        self.process_sent_items(batch, future.result())
+
+    def wait_for_sent_batches(self):
+        """Wait for all the batches in flight to complete, and process their results."""
+        while self.sent_batches:
+            self._complete_oldest_batch()
 
     def flush(self):
-        try:
-            _, sent, _ = self.connection.execute_queued()
-        except umapi_client.BatchError as e:
-            self.process_sent_items(e.statistics[1], e)
-        except umapi_client.UnavailableError as e:
-            raise AssertionException("Error contacting UMAPI server: %s" % e)
-        else:
-            self.process_sent_items(sent)
+        if self.items:
+            self._execute_batch()
+        self.wait_for_sent_batches()
 
-    def process_sent_items(self, total_sent, batch_error=None):
+    def process_sent_items(self, sent_items, batch_error=None):
         """
         Note items as sent, log any processing errors, and invoke any callbacks
-        :param total_sent: number of sent items from queue, must be >= 0
+        :param sent_items: the items that were sent together in a batch
         :param batch_error: exception for a batch-level error that affected all items, if there was one
         :return: 
         """
-        # update queue
-        sent_items, self.items = self.items[:total_sent], self.items[total_sent:]
-
         # collect sent actions, their errors, their callbacks
         details = [(item['action'], item['action'].execution_errors(), item['callback']) for item in sent_items]
 
@@ -392,7 +662,7 @@ class ActionManager(object):
         if batch_error:
             request_ids = str([action.frame.get("requestID") for action, _, _ in details])
             self.logger.critical("Unexpected response! Sent actions %s may have failed: %s", request_ids, batch_error)
-            self.error_count += total_sent
+            self.error_count += len(sent_items)
         else:
             for action, errors, _ in details:
                 if errors:
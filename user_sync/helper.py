@@ -20,10 +20,12 @@
 
 import csv
 import datetime
+import logging
 import os
 import sys
 
 import six
+from six.moves import collections_abc
 
 from user_sync.error import AssertionException
 
@@ -41,6 +43,98 @@ def normalize_string(string_value):
     return string_value.strip().lower() if string_value is not None else None
 
 
+def log_progress(self, count, total, message="", *args, **kws):
+    """
+    Log the progress of a job, as the progress method of loggers.  The app installs it at startup,
+    and shard worker processes install it again.
+    :type self: logging.Logger
+    :type count: int
+    :type total: int
+    :type message: str
+    """
+    if self.show_progress:
+        count = int(count)
+        total = int(total)
+        percent_done = round(100*count/total, 1) if total > 0 else 0
+        message = "{0}/{1} ({2}%) {3}".format(count, total, percent_done, message)
+    if message:
+        self._log(logging.INFO, message, args, **kws)
+
+
+class SlotRecord(collections_abc.MutableMapping):
+    """
+    A dict-like record that keeps its well-known keys in slots instead of a per-instance dict,
+    which takes a fraction of the memory when there are many records.  Subclasses list the
+    well-known keys in __slots__ and repeat them in _fields.  A slot that hasn't been assigned
+    is a missing key.  Any other key goes to an overflow dict that is only created when needed.
+    """
+    __slots__ = ('_extra',)
+    _fields = frozenset()
+
+    def __init__(self, *args, **kwargs):
+        self._extra = None
+        if args or kwargs:
+            self.update(*args, **kwargs)
+
+    def __getitem__(self, key):
+        if key in self._fields:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        if self._extra is None:
+            raise KeyError(key)
+        return self._extra[key]
+
+    def __setitem__(self, key, value):
+        if key in self._fields:
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self._fields:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        elif self._extra is None:
+            raise KeyError(key)
+        else:
+            del self._extra[key]
+
+    def __contains__(self, key):
+        if key in self._fields:
+            return hasattr(self, key)
+        return self._extra is not None and key in self._extra
+
+    def __iter__(self):
+        for key in self.__slots__:
+            if hasattr(self, key):
+                yield key
+        if self._extra is not None:
+            for key in self._extra:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, dict(self))
+
+    def get(self, key, default=None):
+        if key in self._fields:
+            return getattr(self, key, default)
+        if self._extra is None:
+            return default
+        return self._extra.get(key, default)
+
+    def copy(self):
+        return type(self)(self)
+
+
 class CSVAdapter:
     """
     Read and write CSV files to and from lists of dictionaries
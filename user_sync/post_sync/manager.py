@@ -1,8 +1,8 @@
 import logging
 import six
-from copy import deepcopy
 from .connectors import get_connector
 from user_sync.error import AssertionException
+from user_sync.helper import SlotRecord
 
 
 class PostSyncManager:
@@ -36,6 +36,14 @@ class PostSyncManager:
             self.logger.info("Finished running " + connector.name)
 
 
+class PostSyncUser(SlotRecord):
+    """
+    The data kept about a user for the post-sync connectors
+    """
+    __slots__ = ('type', 'username', 'domain', 'email', 'firstname', 'lastname', 'groups', 'country')
+    _fields = frozenset(__slots__)
+
+
 class PostSyncData:
     def __init__(self):
         self.umapi_data = {}
@@ -57,29 +65,26 @@ class PostSyncData:
         user_store_data = umapi_data.get(user_key)
 
         if user_store_data is None:
-            user_store_data = self._umapi_data_template()
+            user_store_data = umapi_data[user_key] = self._umapi_data_template()
 
-        updated_store_data = deepcopy(user_store_data)
         groups_to_add = set(self._normalize_groups(add_groups))
-        for k in updated_store_data:
+        for k in PostSyncUser.__slots__:
             if k not in kwargs:
                 continue
             if k == 'groups':
                 groups_to_add |= set(self._normalize_groups(kwargs[k]))
             else:
-                updated_store_data[k] = kwargs[k]
-
-        updated_store_data['groups'] |= groups_to_add
-        updated_store_data['groups'] -= set(self._normalize_groups(remove_groups))
+                user_store_data[k] = kwargs[k]
 
-        self.umapi_data[org_id][user_key] = updated_store_data
+        user_store_data['groups'] |= groups_to_add
+        user_store_data['groups'] -= set(self._normalize_groups(remove_groups))
 
     def remove_umapi_user_groups(self, org_id, user_key):
         umapi_data = self.umapi_data.get(org_id)
         user_store_data = umapi_data.get(user_key)
         if user_store_data is None:
             return
-        user_store_data['groups'] = []
+        user_store_data['groups'] = set()
 
     def remove_umapi_user(self, org_id, user_key):
         umapi_data = self.umapi_data.get(org_id)
@@ -92,16 +97,16 @@ class PostSyncData:
 
     @staticmethod
     def _umapi_data_template():
-        return {
-            'type': None,
-            'username': None,
-            'domain': None,
-            'email': None,
-            'firstname': None,
-            'lastname': None,
-            'groups': set(),
-            'country': None,
-        }
+        return PostSyncUser(
+            type=None,
+            username=None,
+            domain=None,
+            email=None,
+            firstname=None,
+            lastname=None,
+            groups=set(),
+            country=None,
+        )
 
     @staticmethod
     def _normalize_groups(groups):
@@ -19,19 +19,32 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import copy
+import gc
+import hashlib
 import logging
+import logging.handlers
+import multiprocessing
+import re
 import six
+import threading
+import time
+import zlib
 from itertools import chain
-from collections import defaultdict
+from collections import defaultdict, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from six.moves.queue import Queue
 
 import user_sync.connector.umapi
 import user_sync.error
 import user_sync.identity_type
 from user_sync.post_sync.manager import PostSyncData
-from user_sync.helper import normalize_string, CSVAdapter, JobStats
+from user_sync.helper import normalize_string, log_progress, CSVAdapter, JobStats
+from user_sync.state import SyncStateStore
 
 GROUP_NAME_DELIMITER = '::'
 PRIMARY_UMAPI_NAME = None
+EMPTY_GROUPS = frozenset()
 
 
 class RuleProcessor(object):
@@ -40,6 +53,10 @@ class RuleProcessor(object):
     default_options = {
         'adobe_group_filter': None,
         'after_mapping_hook': None,
+        'bulk_group_actions': False,
+        'bulk_group_chunk_size': 100,
+        'bulk_group_min_users': 10,
+        'command_queue_size': 1000,
         'default_country_code': None,
         'delete_strays': False,
         'directory_group_filter': None,
@@ -50,15 +67,23 @@ class RuleProcessor(object):
         'exclude_users': [],
         'extended_attributes': set(),
         'extension_enabled': False,
+        'full_sync_interval': 24,
+        'incremental': False,
+        'incremental_state_file': None,
         'process_groups': False,
         'max_adobe_only_users': 200,
         'new_account_type': user_sync.identity_type.ENTERPRISE_IDENTITY_TYPE,
+        'pipeline_umapi_load': False,
         'remove_strays': False,
+        'secondary_umapi_workers': 1,
+        'shard_count': 1,
         'strategy': 'sync',
+        'stream_commands': False,
         'stray_list_input_path': None,
         'stray_list_output_path': None,
         'test_mode': False,
         'update_user_info': False,
+        'user_exclusion_filter': None,
         'username_filter_regex': None,
     }
 
@@ -73,6 +98,14 @@ class RuleProcessor(object):
         self.filtered_directory_user_by_user_key = {}
         self.umapi_info_by_name = {}
         self.adobeid_user_by_email = {}
+        # in pipelined mode, the users of each umapi are downloaded in the background
+        self.umapi_user_prefetch = {}
+        # in streaming mode, commands are sent while users are still being matched.
+        # We remember which umapis have been sent the start sync signal that way, and the last
+        # command of each stream, which is held back to be sent after the end sync signal.
+        self.command_streams = {}
+        self.sync_started_umapi_names = set()
+        self.held_commands_by_umapi_name = {}
         # counters for action summary log
         self.action_summary = {
             # these are in alphabetical order!  Always add new ones that way!
@@ -90,9 +123,11 @@ class RuleProcessor(object):
         self.logger = logger = logging.getLogger('processor')
 
         # save away the exclude options for use in filtering
-        self.exclude_groups = self.normalize_groups(options['exclude_groups'])
-        self.exclude_identity_types = options['exclude_identity_types']
-        self.exclude_users = options['exclude_users']
+        self.exclude_groups = frozenset(self.normalize_groups(options['exclude_groups']))
+        self.user_exclusion_filter = options['user_exclusion_filter']
+        if self.user_exclusion_filter is None:
+            self.user_exclusion_filter = UserExclusionFilter(options['exclude_identity_types'],
+                                                             options['exclude_users'])
 
         # There's a big difference between how we handle the primary umapi,
         # and how we handle secondary umapis.  We care about all the (non-excluded)
@@ -114,6 +149,12 @@ class RuleProcessor(object):
         self.secondary_users_created = set()
         self.updated_user_keys = set()
 
+        # when users are synced in shards, each shard is a copy of this processor that
+        # syncs a subset of the users in a worker process.  This is None except in shards.
+        # The main process adds up the (sent, error) counts of the actions the shards sent to each umapi.
+        self.shard_index = None
+        self.shard_action_statistics = {}
+
         # stray key input path comes in, stray_list_output_path goes out
         self.stray_key_map = {}
         if options['stray_list_input_path']:
@@ -134,6 +175,24 @@ class RuleProcessor(object):
             self.will_manage_strays = False
             self.will_process_strays = False
 
+        # in incremental mode, only the users that changed since the last successful run are synced.
+        # The incremental user keys are None when all users are synced.
+        self.sync_state = None
+        self.options_fingerprint = None
+        self.is_full_sync = True
+        self.incremental_user_keys = None
+        self.incremental_user_emails = {}
+        self.user_fingerprints = {}
+        self.synced_user_count = 0
+        self.stray_limit_exceeded = False
+        if options['incremental']:
+            if self.push_umapi:
+                raise user_sync.error.AssertionException('Incremental sync cannot be used with strategy push')
+            if options['adobe_group_filter'] is not None:
+                raise user_sync.error.AssertionException('Incremental sync cannot be used with an adobe group filter')
+            if not options['incremental_state_file']:
+                raise user_sync.error.AssertionException('Incremental sync requires an incremental_state_file')
+
         # in/out variables for per-user after-mapping-hook code
         self.after_mapping_hook_scope = {
             # in: attributes retrieved from customer directory system (eg 'c', 'givenName')
@@ -180,10 +239,18 @@ class RuleProcessor(object):
         self.prepare_umapi_infos()
 
         if directory_connector is not None:
+            if self.options['incremental']:
+                self.open_sync_state(directory_groups)
+            # an incremental sync only downloads the changed users, which aren't known until the directory is read
+            if self.options['pipeline_umapi_load'] and not self.push_umapi and self.is_full_sync:
+                connectors = self.get_targeted_umapi_connectors(umapi_connectors)
+                self.prefetch_umapi_users(connectors, len(connectors))
             load_directory_stats = JobStats("Load from Directory", divider="-")
             load_directory_stats.log_start(logger)
             self.read_desired_user_groups(directory_groups, directory_connector)
             load_directory_stats.log_end(logger)
+            if self.sync_state is not None:
+                self.select_incremental_users()
 
         for umapi_info in self.umapi_info_by_name.values():
             self.validate_and_log_additional_groups(umapi_info)
@@ -192,22 +259,44 @@ class RuleProcessor(object):
         umapi_stats.log_start(logger)
         primary_commands = list()
         secondary_command_lists = defaultdict(list)
+        # in a sharded sync, the shards send their own commands
+        sharded = directory_connector is not None and self.options['shard_count'] > 1 and not self.push_umapi
         if directory_connector is not None:
             # note: push mode is not supported because if it is, we won't have a list of groups
             # that exist in the console.  we don't want to attempt to create groups that already exist
             if self.options.get('process_groups') and not self.push_umapi and self.options.get('auto_create'):
                 self.create_umapi_groups(umapi_connectors)
-            primary_commands, secondary_command_lists = self.sync_umapi_users(umapi_connectors)
+            if sharded:
+                self.sync_umapi_users_in_shards(umapi_connectors)
+            else:
+                primary_commands, secondary_command_lists = self.sync_umapi_users(umapi_connectors)
+        if not sharded:
+            self.execute_sync_commands(primary_commands, secondary_command_lists, umapi_connectors)
+            umapi_connectors.execute_actions()
+        umapi_stats.log_end(logger)
+        self.log_action_summary(umapi_connectors)
+        if self.sync_state is not None:
+            self.save_sync_state(umapi_connectors)
+
+    def execute_sync_commands(self, primary_commands, secondary_command_lists, umapi_connectors):
+        """
+        Process the strays, and send the commands of the sync.
+        :type primary_commands: list(user_sync.connector.umapi.Commands)
+        :type secondary_command_lists: dict(str, list(user_sync.connector.umapi.Commands))
+        :type umapi_connectors: UmapiConnectors
+        """
         if self.will_process_strays:
             primary_commands, secondary_command_lists = self.process_strays(primary_commands,
                                                                             secondary_command_lists, umapi_connectors)
+        if self.options['bulk_group_actions']:
+            primary_commands = self.bulk_group_commands(primary_commands)
+            for umapi_name in list(secondary_command_lists):
+                secondary_command_lists[umapi_name] = self.bulk_group_commands(secondary_command_lists[umapi_name])
+        primary_commands, secondary_command_lists = self.add_held_commands(primary_commands, secondary_command_lists)
         # execute secondary commands first so we can safely handle user deletions (if applicable)
-        for umapi_name, command_list in secondary_command_lists.items():
-            self.execute_commands(command_list, umapi_connectors.get_secondary_connectors()[umapi_name])
-        self.execute_commands(primary_commands, umapi_connectors.get_primary_connector())
-        umapi_connectors.execute_actions()
-        umapi_stats.log_end(logger)
-        self.log_action_summary(umapi_connectors)
+        self.execute_secondary_commands(secondary_command_lists, umapi_connectors)
+        self.execute_commands(primary_commands, umapi_connectors.get_primary_connector(),
+                              PRIMARY_UMAPI_NAME in self.sync_started_umapi_names)
 
     def validate_and_log_additional_groups(self, umapi_info):
         """
@@ -323,11 +412,22 @@ class RuleProcessor(object):
             action_count = self.action_summary[action_description[0]]
             logger.info('  %s: %s', description, action_count)
         for name, umapi_connector in connectors:
-            sent, errors = umapi_connector.get_action_manager().get_statistics()
+            sent, errors = self.get_action_statistics(umapi_connector)
             description = (umapi_summary_format % (spacer, name)).rjust(pad, ' ')
             logger.info('  %s: (%s, %s, %s)', description, sent, sent - errors, errors)
         logger.info('------------------------------------------------------------------------------------')
 
+    def get_action_statistics(self, umapi_connector):
+        """
+        The count of actions sent to a umapi, and of those that had errors,
+        including the actions sent by the shards of a sharded sync.
+        :type umapi_connector: user_sync.connector.umapi.UmapiConnector
+        :rtype: tuple(int, int)
+        """
+        sent, errors = umapi_connector.get_action_manager().get_statistics()
+        shard_sent, shard_errors = self.shard_action_statistics.get(umapi_connector.name, (0, 0))
+        return sent + shard_sent, errors + shard_errors
+
     def is_primary_org(self, umapi_info):
         return umapi_info.get_name() == PRIMARY_UMAPI_NAME
 
@@ -354,6 +454,53 @@ class RuleProcessor(object):
             umapi_info = self.get_umapi_info(adobe_group.get_umapi_name())
             umapi_info.add_mapped_group(adobe_group.get_group_name())
 
+    def get_targeted_umapi_connectors(self, umapi_connectors):
+        """
+        The primary connector, followed by the secondary connectors that some group
+        (mapped or additional) can target, as (umapi name, connector) pairs.
+        :type umapi_connectors: UmapiConnectors
+        :rtype: list(tuple(str, user_sync.connector.umapi.UmapiConnector))
+        """
+        additional_umapi_names = set(rule['target'].get_umapi_name()
+                                     for rule in self.options.get('additional_groups', []))
+        connectors = [(PRIMARY_UMAPI_NAME, umapi_connectors.get_primary_connector())]
+        for umapi_name, umapi_connector in six.iteritems(umapi_connectors.get_secondary_connectors()):
+            if umapi_name in self.umapi_info_by_name or umapi_name in additional_umapi_names:
+                connectors.append((umapi_name, umapi_connector))
+        return connectors
+
+    def prefetch_umapi_users(self, connectors, max_workers):
+        """
+        Start downloading the users of the given umapis on background threads, so the download
+        overlaps with other work.  update_umapi_users_for_connector then matches against
+        the buffered users instead of listing them itself.
+        :type connectors: list(tuple(str, user_sync.connector.umapi.UmapiConnector))
+        :type max_workers: int
+        """
+        connectors = [(umapi_name, umapi_connector) for umapi_name, umapi_connector in connectors
+                      if umapi_name not in self.umapi_user_prefetch]
+        if not connectors:
+            return
+        executor = ThreadPoolExecutor(max_workers)
+        for umapi_name, umapi_connector in connectors:
+            self.logger.debug('Prefetching users for umapi %s...', umapi_name if umapi_name else 'primary')
+            umapi_users = self.iter_umapi_users(self.get_umapi_info(umapi_name), umapi_connector)
+            self.umapi_user_prefetch[umapi_name] = executor.submit(list, umapi_users)
+        executor.shutdown(wait=False)
+
+    def iter_umapi_users(self, umapi_info, umapi_connector):
+        """
+        The adobe users to sync in the given umapi, honoring any adobe group filter
+        :type umapi_info: UmapiTargetInfo
+        :type umapi_connector: user_sync.connector.umapi.UmapiConnector
+        :rtype: iterator(dict)
+        """
+        if self.incremental_user_keys is not None:
+            return self.iter_incremental_umapi_users(umapi_connector)
+        if self.options['adobe_group_filter'] is not None:
+            return self.get_umapi_user_in_groups(umapi_info, umapi_connector, self.options['adobe_group_filter'])
+        return umapi_connector.iter_users()
+
     def read_desired_user_groups(self, mappings, directory_connector):
         """
         :type mappings: dict(str, list(AdobeGroup))
@@ -368,6 +515,7 @@ class RuleProcessor(object):
         extended_attributes = options.get('extended_attributes')
 
         directory_user_by_user_key = self.directory_user_by_user_key
+        mapping_index = GroupMappingIndex(mappings)
 
         directory_groups = set(six.iterkeys(mappings)) if self.will_process_groups() else set()
         if directory_group_filter is not None:
@@ -392,18 +540,21 @@ class RuleProcessor(object):
             self.post_sync_data.update_source_attributes(user_key, directory_user['source_attributes'])
             self.get_umapi_info(PRIMARY_UMAPI_NAME).add_desired_group_for(user_key, None)
 
-            # set up groups in hook scope; the target groups will be used whether or not there's customer hook code
-            self.after_mapping_hook_scope['source_groups'] = set()
-            self.after_mapping_hook_scope['target_groups'] = set()
-            for group in directory_user['groups']:
-                self.after_mapping_hook_scope['source_groups'].add(group)  # this is a directory group name
-                adobe_groups = mappings.get(group)
-                if adobe_groups is not None:
-                    for adobe_group in adobe_groups:
-                        self.after_mapping_hook_scope['target_groups'].add(adobe_group.get_qualified_name())
-
-            # only if there actually is hook code: set up rest of hook scope, invoke hook, update user attributes
-            if options['after_mapping_hook'] is not None:
+            if options['after_mapping_hook'] is None:
+                # without hook code, the desired groups come straight from the resolved mappings
+                for umapi_name, groups in mapping_index.resolve(directory_user['groups']):
+                    self.get_umapi_info(umapi_name).set_desired_groups(user_key, groups)
+            else:
+                # set up hook scope, invoke hook, update user attributes
+                self.after_mapping_hook_scope['source_groups'] = set()
+                self.after_mapping_hook_scope['target_groups'] = set()
+                for group in directory_user['groups']:
+                    self.after_mapping_hook_scope['source_groups'].add(group)  # this is a directory group name
+                    adobe_groups = mappings.get(group)
+                    if adobe_groups is not None:
+                        for adobe_group in adobe_groups:
+                            self.after_mapping_hook_scope['target_groups'].add(adobe_group.get_qualified_name())
+
                 self.after_mapping_hook_scope['source_attributes'] = directory_user['source_attributes'].copy()
 
                 target_attributes = dict()
@@ -423,13 +574,13 @@ class RuleProcessor(object):
                 # copy modified attributes back to the user object
                 directory_user.update(self.after_mapping_hook_scope['target_attributes'])
 
-            for target_group_qualified_name in self.after_mapping_hook_scope['target_groups']:
-                target_group = AdobeGroup.lookup(target_group_qualified_name)
-                if target_group is not None:
-                    umapi_info = self.get_umapi_info(target_group.get_umapi_name())
-                    umapi_info.add_desired_group_for(user_key, target_group.get_group_name())
-                else:
-                    self.logger.error('Target adobe group %s is not known; ignored', target_group_qualified_name)
+                for target_group_qualified_name in self.after_mapping_hook_scope['target_groups']:
+                    target_group = AdobeGroup.lookup(target_group_qualified_name)
+                    if target_group is not None:
+                        umapi_info = self.get_umapi_info(target_group.get_umapi_name())
+                        umapi_info.add_desired_group_for(user_key, target_group.get_group_name())
+                    else:
+                        self.logger.error('Target adobe group %s is not known; ignored', target_group_qualified_name)
 
             additional_groups = self.options.get('additional_groups', [])
             member_groups = directory_user.get('member_groups', [])
@@ -468,6 +619,133 @@ class RuleProcessor(object):
                 return True
         return False
 
+    def open_sync_state(self, directory_groups):
+        """
+        Open the incremental sync state, and decide whether this run must be a full sync:
+        that is the case on the first run, when the full sync interval has passed since
+        the last full sync, and when the settings that decide what is synced have changed.
+        :type directory_groups: dict(str, list(AdobeGroup))
+        """
+        self.sync_state = SyncStateStore(self.options['incremental_state_file'])
+        self.options_fingerprint = self.get_options_fingerprint(directory_groups)
+        last_full_sync = self.sync_state.get_setting('last_full_sync')
+        if last_full_sync is None:
+            self.logger.info('Incremental sync: no sync state found, doing a full sync')
+        elif self.sync_state.get_setting('options_fingerprint') != self.options_fingerprint:
+            self.logger.info('Incremental sync: sync settings have changed, doing a full sync')
+        elif time.time() - float(last_full_sync) >= self.options['full_sync_interval'] * 3600:
+            self.logger.info('Incremental sync: full sync interval has passed, doing a full sync')
+        else:
+            self.is_full_sync = False
+
+    def get_options_fingerprint(self, directory_groups):
+        """
+        A fingerprint of the settings that decide which users are synced, and how
+        :type directory_groups: dict(str, list(AdobeGroup))
+        :rtype: str
+        """
+        options = self.options
+        directory_group_filter = options['directory_group_filter']
+        username_filter_regex = options['username_filter_regex']
+        settings = [
+            sorted((group, sorted(adobe_group.get_qualified_name() for adobe_group in adobe_groups))
+                   for group, adobe_groups in six.iteritems(directory_groups)),
+            sorted(rule['source'].pattern + ' ' + rule['target'].get_qualified_name()
+                   for rule in options.get('additional_groups', [])),
+            sorted(directory_group_filter) if directory_group_filter is not None else None,
+            username_filter_regex.pattern if username_filter_regex is not None else None,
+            options['default_country_code'],
+            options['exclude_unmapped_users'],
+            options['new_account_type'],
+            options['process_groups'],
+            options['update_user_info'],
+        ]
+        return hashlib.sha1(repr(settings).encode('utf8')).hexdigest()
+
+    def get_user_fingerprint(self, user_key, directory_user):
+        """
+        A fingerprint of the attributes and desired groups of a directory user
+        :type user_key: str
+        :type directory_user: dict
+        :rtype: str
+        """
+        values = [directory_user.get(name) for name in ('identity_type', 'username', 'domain', 'email',
+                                                       'firstname', 'lastname', 'country')]
+        for umapi_name, umapi_info in sorted(six.iteritems(self.umapi_info_by_name), key=lambda item: item[0] or ''):
+            groups = umapi_info.get_desired_groups(user_key)
+            if groups:
+                values.append((umapi_name or '', sorted(groups)))
+        return hashlib.sha1(repr(values).encode('utf8')).hexdigest()
+
+    def select_incremental_users(self):
+        """
+        Fingerprint the selected directory users.  In an incremental sync, the users to sync are those
+        whose fingerprint differs from the stored one, and the stored users that have left the directory.
+        """
+        for user_key, directory_user in six.iteritems(self.filtered_directory_user_by_user_key):
+            self.user_fingerprints[user_key] = (directory_user['email'],
+                                                self.get_user_fingerprint(user_key, directory_user))
+        if self.is_full_sync:
+            return
+        stored_users = dict((UserKey.parse(user_key), user)
+                            for user_key, user in six.iteritems(self.sync_state.get_users()))
+        self.synced_user_count = len(stored_users)
+        for user_key, fingerprint in six.iteritems(self.user_fingerprints):
+            if stored_users.get(user_key) != fingerprint:
+                self.incremental_user_emails[user_key] = fingerprint[0]
+        changed_count = len(self.incremental_user_emails)
+        for user_key, (email, _) in six.iteritems(stored_users):
+            if user_key not in self.user_fingerprints:
+                self.incremental_user_emails[user_key] = email
+        self.incremental_user_keys = set(self.incremental_user_emails)
+        self.logger.info('Incremental sync: %d changed and %d removed directory users, out of %d synced last time',
+                         changed_count, len(self.incremental_user_keys) - changed_count, len(stored_users))
+
+    def iter_incremental_umapi_users(self, umapi_connector):
+        """
+        Look up the users of an incremental sync in the given umapi, by email.
+        :type umapi_connector: user_sync.connector.umapi.UmapiConnector
+        :rtype: iterator(dict)
+        """
+        for user_key in sorted(self.incremental_user_keys):
+            umapi_user = umapi_connector.get_user(self.incremental_user_emails[user_key])
+            if umapi_user is None:
+                continue
+            # an Adobe ID that shares the user's email keeps the user from being created
+            self.filter_adobeID_user(umapi_user)
+            if self.get_umapi_user_key(umapi_user) == user_key:
+                yield umapi_user
+
+    def save_sync_state(self, umapi_connectors):
+        """
+        Remember the users synced in this run, so the next incremental run can skip them.
+        Nothing is saved in test mode, or if the run was not entirely successful.
+        :type umapi_connectors: UmapiConnectors
+        """
+        try:
+            if self.options['test_mode']:
+                self.logger.info('Incremental sync: test mode, sync state not saved')
+                return
+            errors = sum(self.get_action_statistics(umapi_connector)[1]
+                         for umapi_connector in umapi_connectors.connectors)
+            if errors or self.stray_limit_exceeded:
+                self.logger.warning('Incremental sync: run was not successful, sync state not saved')
+                return
+            if self.is_full_sync:
+                self.sync_state.update_users(self.user_fingerprints, replace=True)
+                self.sync_state.set_setting('last_full_sync', repr(time.time()))
+                self.sync_state.set_setting('options_fingerprint', self.options_fingerprint)
+            else:
+                changed_users = dict((user_key, fingerprint) for user_key, fingerprint
+                                     in six.iteritems(self.user_fingerprints)
+                                     if user_key in self.incremental_user_keys)
+                removed_user_keys = self.incremental_user_keys - set(changed_users)
+                self.sync_state.update_users(changed_users, removed_user_keys)
+            self.logger.info('Incremental sync: saved sync state for %d users',
+                             len(self.user_fingerprints) if self.is_full_sync else len(self.incremental_user_keys))
+        finally:
+            self.sync_state.close()
+
     def sync_umapi_users(self, umapi_connectors):
         """
         This is where we actually "do the sync"; that is, where we match users on the two sides.
@@ -483,6 +761,16 @@ class RuleProcessor(object):
         else:
             verb = "Sync"
         exclude_unmapped_users = self.will_exclude_unmapped_users()
+        # in parallel mode, the secondary users are downloaded while we work on the primary.
+        # Matching stays on this thread, in a fixed order, so the results don't depend on timing.
+        secondary_workers = self.options['secondary_umapi_workers']
+        if secondary_workers > 1 and not self.push_umapi:
+            secondary_connectors = [(umapi_name, umapi_connector) for umapi_name, umapi_connector
+                                    in six.iteritems(umapi_connectors.get_secondary_connectors())
+                                    if self.get_umapi_info(umapi_name).get_mapped_groups()]
+            self.prefetch_umapi_users(secondary_connectors, secondary_workers)
+        if self.options['stream_commands']:
+            self.open_command_streams(umapi_connectors)
         # first sync the primary connector, so the users get created in the primary
         if umapi_connectors.get_secondary_connectors():
             self.logger.debug('Processing %s users for primary umapi...', verb)
@@ -506,7 +794,8 @@ class RuleProcessor(object):
                 continue
             # We always create every user in the primary umapi, because it's believed to own the directories.
             self.primary_users_created.add(user_key)
-            primary_commands.append(self.create_umapi_user(user_key, groups_to_add, umapi_info, umapi_connector.trusted))
+            self.add_commands(PRIMARY_UMAPI_NAME, primary_commands,
+                              self.create_umapi_user(user_key, groups_to_add, umapi_info, umapi_connector.trusted))
 
         # then sync the secondary connectors
         for umapi_name, umapi_connector in umapi_connectors.get_secondary_connectors().items():
@@ -527,10 +816,458 @@ class RuleProcessor(object):
                     if user_key not in self.primary_users_created:
                         # We pushed an existing user to a secondary in order to update his groups
                         self.updated_user_keys.add(user_key)
-                    secondary_command_lists[umapi_name].append(self.create_umapi_user(user_key, groups_to_add, umapi_info, umapi_connector.trusted))
+                    self.add_commands(umapi_name, secondary_command_lists[umapi_name],
+                                      self.create_umapi_user(user_key, groups_to_add, umapi_info,
+                                                             umapi_connector.trusted))
+        self.close_command_streams()
         return primary_commands, secondary_command_lists
 
-    def execute_commands(self, command_list, connector):
+    def sync_umapi_users_in_shards(self, umapi_connectors):
+        """
+        Do the sync with the users split into shards, each of which is synced in its own worker process.
+        User keys are assigned to shards by hash, so a user is in the same shard in every umapi.
+        The umapi users are downloaded here, and matched in the shards.  The shards then wait until
+        the max_adobe_only_users limit has been checked here over all shards, before they process their
+        strays and send their commands.
+        :type umapi_connectors: UmapiConnectors
+        """
+        shard_count = self.options['shard_count']
+        if self.options['stream_commands']:
+            self.logger.warning('Commands are not streamed when users are synced in shards')
+        shard_args = self.create_shards(umapi_connectors)
+        self.logger.info('Syncing users in %d shards...', shard_count)
+
+        # the workers are spawned rather than forked, as the threads that download the umapi users
+        # may still be running, and a forked child would get copies of their locks in whatever state.
+        # Spawned workers have no log handlers of their own, so they log through a queue to ours.
+        context = multiprocessing.get_context('spawn')
+        log_queue = context.Queue()
+        root_logger = logging.getLogger()
+        log_handlers = root_logger.handlers or [logging.lastResort]
+        log_level = max(root_logger.getEffectiveLevel(), min(handler.level for handler in log_handlers))
+        log_listener = logging.handlers.QueueListener(log_queue, *log_handlers, respect_handler_level=True)
+        log_listener.start()
+        connections = []
+        processes = []
+        try:
+            for shard, _ in shard_args:
+                connection, worker_connection = context.Pipe()
+                process = context.Process(target=sync_shard, name='shard-%d' % shard.shard_index,
+                                          args=(worker_connection, log_queue, log_level,
+                                                getattr(logging.Logger, 'show_progress', False)))
+                process.daemon = True
+                process.start()
+                worker_connection.close()
+                connections.append(connection)
+                processes.append(process)
+            self.send_shards(connections, shard_args, umapi_connectors)
+            shard_args = None
+            self.merge_shard_matches(connections)
+            for connection in connections:
+                connection.send(self.stray_limit_exceeded)
+            self.merge_shard_executions(connections)
+        finally:
+            # shards that are still waiting stop when their connection is closed
+            for connection in connections:
+                connection.close()
+            for process in processes:
+                process.join()
+            log_listener.stop()
+
+    def create_shards(self, umapi_connectors):
+        """
+        Download the umapi users, and split them and the directory users into shards.
+        :type umapi_connectors: UmapiConnectors
+        :return: each shard's processor, with the shard's users in each umapi by umapi name
+        :rtype: list(tuple(RuleProcessor, dict(str, list(dict))))
+        """
+        shard_count = self.options['shard_count']
+        connectors = [(PRIMARY_UMAPI_NAME, umapi_connectors.get_primary_connector())]
+        connectors.extend((umapi_name, umapi_connector) for umapi_name, umapi_connector
+                          in six.iteritems(umapi_connectors.get_secondary_connectors())
+                          if self.get_umapi_info(umapi_name).get_mapped_groups())
+        self.prefetch_umapi_users(connectors, len(connectors))
+
+        shards = [self.create_shard(shard_index) for shard_index in range(shard_count)]
+        shard_by_user_key = {}
+
+        def get_shard(user_key):
+            shard = shard_by_user_key.get(user_key)
+            if shard is None:
+                shard = shard_by_user_key[user_key] = shards[self.get_shard_index(user_key, shard_count)]
+            return shard
+
+        for user_key, directory_user in six.iteritems(self.directory_user_by_user_key):
+            get_shard(user_key).directory_user_by_user_key[user_key] = directory_user
+        for user_key, directory_user in six.iteritems(self.filtered_directory_user_by_user_key):
+            get_shard(user_key).filtered_directory_user_by_user_key[user_key] = directory_user
+        for umapi_name, umapi_info in six.iteritems(self.umapi_info_by_name):
+            for user_key, groups in six.iteritems(umapi_info.get_desired_groups_by_user_key()):
+                get_shard(user_key).get_umapi_info(umapi_name).desired_groups_by_user_key[user_key] = groups
+        if self.incremental_user_keys is not None:
+            for user_key in self.incremental_user_keys:
+                get_shard(user_key).incremental_user_keys.add(user_key)
+
+        umapi_users_by_shard = [dict((umapi_name, []) for umapi_name, _ in connectors) for _ in shards]
+        for umapi_name, _ in connectors:
+            for umapi_user in self.umapi_user_prefetch.pop(umapi_name).result():
+                if umapi_name == PRIMARY_UMAPI_NAME:
+                    # adobe ids are found by email, which can be that of a user in any shard
+                    self.filter_adobeID_user(umapi_user)
+                user_key = self.get_umapi_user_key(umapi_user)
+                shard_index = get_shard(user_key).shard_index if user_key else 0
+                umapi_users_by_shard[shard_index][umapi_name].append(umapi_user)
+            self.get_umapi_info(umapi_name).set_umapi_users_loaded()
+        for shard in shards:
+            shard.adobeid_user_by_email = self.adobeid_user_by_email
+        return list(zip(shards, umapi_users_by_shard))
+
+    @staticmethod
+    def send_shards(connections, shard_args, umapi_connectors):
+        """
+        Send each shard, with its umapi users and the umapi connectors, to its worker process.
+        :type connections: list(multiprocessing.connection.Connection)
+        :param shard_args: as returned by create_shards
+        :type shard_args: list(tuple(RuleProcessor, dict(str, list(dict))))
+        :type umapi_connectors: UmapiConnectors
+        """
+        # pickling the users makes many small objects, and the garbage collector would
+        # go over all the users held here each time it runs
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for connection, (shard, umapi_users_by_name) in zip(connections, shard_args):
+                connection.send((shard, umapi_connectors, umapi_users_by_name))
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+    @staticmethod
+    def get_shard_index(user_key, shard_count):
+        """
+        The shard of a user key.  Unlike hash(), the CRC is the same in every process and every run.
+        :type user_key: UserKey
+        :type shard_count: int
+        :rtype: int
+        """
+        return zlib.crc32(six.text_type(user_key).encode('utf-8')) % shard_count
+
+    def create_shard(self, shard_index):
+        """
+        A copy of this processor, without any users, to sync one shard in a worker process.
+        Everything that can't be sent to another process, or that the shard doesn't need, is left out.
+        :type shard_index: int
+        :rtype: RuleProcessor
+        """
+        shard = copy.copy(self)
+        shard.shard_index = shard_index
+        shard.options = dict(self.options, after_mapping_hook=None, secondary_umapi_workers=1, stream_commands=False)
+        shard.directory_user_by_user_key = {}
+        shard.filtered_directory_user_by_user_key = {}
+        shard.umapi_info_by_name = dict((umapi_name, umapi_info.create_shard())
+                                        for umapi_name, umapi_info in six.iteritems(self.umapi_info_by_name))
+        shard.adobeid_user_by_email = {}
+        shard.umapi_user_prefetch = {}
+        shard.command_streams = {}
+        shard.sync_started_umapi_names = set()
+        shard.held_commands_by_umapi_name = {}
+        shard.action_summary = dict(self.action_summary)
+        shard.shard_action_statistics = {}
+        shard.user_exclusion_filter = self.user_exclusion_filter.create_shard()
+        shard.primary_user_count = 0
+        shard.included_user_keys = set()
+        shard.excluded_user_count = 0
+        shard.primary_users_created = set()
+        shard.secondary_users_created = set()
+        shard.updated_user_keys = set()
+        shard.stray_key_map = {}
+        # the main process writes the strays of all shards
+        shard.stray_list_output_path = None
+        shard.sync_state = None
+        shard.incremental_user_keys = None if self.incremental_user_keys is None else set()
+        shard.incremental_user_emails = {}
+        shard.user_fingerprints = {}
+        shard.after_mapping_hook_scope = None
+        shard.email_override = {}
+        shard.post_sync_data = PostSyncData()
+        return shard
+
+    def sync_shard_users(self, umapi_connectors, umapi_users_by_name):
+        """
+        Match the users of this shard, in a worker process.
+        :type umapi_connectors: UmapiConnectors
+        :param umapi_users_by_name: the shard's users in each umapi, as downloaded by the main process
+        :type umapi_users_by_name: dict(str, list(dict))
+        :return: the commands of the shard, to be sent by execute_sync_commands
+        :rtype: tuple(list(user_sync.connector.umapi.Commands), dict(str, list(user_sync.connector.umapi.Commands)))
+        """
+        for umapi_name, umapi_users in six.iteritems(umapi_users_by_name):
+            prefetched_users = self.umapi_user_prefetch[umapi_name] = Future()
+            prefetched_users.set_result(umapi_users)
+        return self.sync_umapi_users(umapi_connectors)
+
+    def get_shard_matches(self):
+        """
+        The counters and user keys of this shard once its users are matched, for merge_shard_matches.
+        :rtype: dict
+        """
+        return {
+            'primary_user_count': self.primary_user_count,
+            'excluded_user_count': self.excluded_user_count,
+            'included_user_keys': self.included_user_keys,
+            'primary_users_created': self.primary_users_created,
+            'secondary_users_created': self.secondary_users_created,
+            'updated_user_keys': self.updated_user_keys,
+            'stray_key_map': self.stray_key_map,
+            'email_override': self.email_override,
+            'exclusion_counts': dict(self.user_exclusion_filter.exclusion_counts),
+        }
+
+    def get_shard_executions(self, umapi_connectors):
+        """
+        What this shard did once its commands are sent, for merge_shard_executions.
+        :type umapi_connectors: UmapiConnectors
+        :rtype: dict
+        """
+        return {
+            'primary_strays_processed': self.action_summary['primary_strays_processed'],
+            'action_statistics': dict((umapi_connector.name, umapi_connector.get_action_manager().get_statistics())
+                                      for umapi_connector in umapi_connectors.connectors),
+            'umapi_data': self.post_sync_data.umapi_data,
+        }
+
+    @staticmethod
+    def receive_shard_results(connections):
+        """
+        :type connections: list(multiprocessing.connection.Connection)
+        :rtype: list(dict)
+        """
+        shard_results = []
+        for shard_index, connection in enumerate(connections):
+            try:
+                shard_result = connection.recv()
+            except EOFError:
+                raise user_sync.error.AssertionException('Shard %d exited unexpectedly' % shard_index)
+            if 'error' in shard_result:
+                raise user_sync.error.AssertionException('Shard %d failed: %s' % (shard_index, shard_result['error']))
+            shard_results.append(shard_result)
+        return shard_results
+
+    def merge_shard_matches(self, connections):
+        """
+        Add the counters and user keys of the matched shards to those of this processor, then write
+        and check the strays of all shards.  Shards have no user keys in common, so their maps can
+        simply be combined.
+        :type connections: list(multiprocessing.connection.Connection)
+        """
+        for shard_result in self.receive_shard_results(connections):
+            self.primary_user_count += shard_result['primary_user_count']
+            self.excluded_user_count += shard_result['excluded_user_count']
+            self.included_user_keys.update(shard_result['included_user_keys'])
+            self.primary_users_created.update(shard_result['primary_users_created'])
+            self.secondary_users_created.update(shard_result['secondary_users_created'])
+            self.updated_user_keys.update(shard_result['updated_user_keys'])
+            for umapi_name, strays in six.iteritems(shard_result['stray_key_map']):
+                self.stray_key_map.setdefault(umapi_name, {}).update(strays)
+            self.email_override.update(shard_result['email_override'])
+            for rule, count in six.iteritems(shard_result['exclusion_counts']):
+                self.user_exclusion_filter.exclusion_counts[rule] += count
+        self.user_exclusion_filter.log_exclusion_counts(self.logger)
+        if self.will_process_strays:
+            if self.stray_list_output_path:
+                self.write_stray_key_map()
+            if self.will_manage_strays:
+                self.check_stray_limit()
+
+    def merge_shard_executions(self, connections):
+        """
+        Add what the shards did when they sent their commands to the counters of this processor.
+        :type connections: list(multiprocessing.connection.Connection)
+        """
+        for shard_result in self.receive_shard_results(connections):
+            self.action_summary['primary_strays_processed'] += shard_result['primary_strays_processed']
+            for name, (sent, errors) in six.iteritems(shard_result['action_statistics']):
+                shard_sent, shard_errors = self.shard_action_statistics.get(name, (0, 0))
+                self.shard_action_statistics[name] = (shard_sent + sent, shard_errors + errors)
+            for org_id, umapi_data in six.iteritems(shard_result['umapi_data']):
+                self.post_sync_data.umapi_data.setdefault(org_id, {}).update(umapi_data)
+
+    def __getstate__(self):
+        # loggers can't be pickled on all supported pythons, so shards look theirs up again
+        state = self.__dict__.copy()
+        del state['logger']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.logger = logging.getLogger('processor')
+
+    def open_command_streams(self, umapi_connectors):
+        """
+        Start a command stream for each umapi, so update and create commands are sent
+        as soon as they are computed rather than after all users have been matched.
+        Adobe-only users are not streamed: they are only handled after the
+        max_adobe_only_users check, once all users have been matched.
+        :type umapi_connectors: UmapiConnectors
+        """
+        queue_size = self.options['command_queue_size']
+        self.command_streams[PRIMARY_UMAPI_NAME] = CommandStream(umapi_connectors.get_primary_connector(), queue_size)
+        for umapi_name, umapi_connector in six.iteritems(umapi_connectors.get_secondary_connectors()):
+            self.command_streams[umapi_name] = CommandStream(umapi_connector, queue_size)
+
+    def close_command_streams(self):
+        """
+        Wait for the command streams to finish, and remember the commands each one held back,
+        so they are sent together with the end sync signal.  They are kept apart from the command
+        lists, which are dropped if there are too many Adobe-only users.
+        """
+        for umapi_name, stream in six.iteritems(self.command_streams):
+            last_commands = stream.close()
+            if last_commands is not None:
+                self.held_commands_by_umapi_name[umapi_name] = last_commands
+            if stream.sent_count:
+                self.sync_started_umapi_names.add(umapi_name)
+        self.command_streams = {}
+
+    def add_held_commands(self, primary_commands, secondary_command_lists):
+        """
+        Put the commands held back by the command streams in front of the commands still to be sent.
+        Those streams already sent the start sync signal, so this way the end sync signal is always sent,
+        even if the other commands were dropped.
+        :type primary_commands: list(user_sync.connector.umapi.Commands)
+        :type secondary_command_lists: dict(str, list(user_sync.connector.umapi.Commands))
+        :rtype tuple(list(user_sync.connector.umapi.Commands), dict(str, list(user_sync.connector.umapi.Commands)))
+        """
+        if not self.held_commands_by_umapi_name:
+            return primary_commands, secondary_command_lists
+        primary_commands = list(primary_commands or [])
+        secondary_command_lists = dict(secondary_command_lists or {})
+        for umapi_name, commands in six.iteritems(self.held_commands_by_umapi_name):
+            if umapi_name == PRIMARY_UMAPI_NAME:
+                primary_commands.insert(0, commands)
+            else:
+                secondary_command_lists[umapi_name] = [commands] + list(secondary_command_lists.get(umapi_name, []))
+        self.held_commands_by_umapi_name = {}
+        return primary_commands, secondary_command_lists
+
+    def add_commands(self, umapi_name, command_list, commands):
+        """
+        Queue the commands for a umapi: they go to its command stream if there is one,
+        otherwise to its command list.
+        :type umapi_name: str
+        :type command_list: list(user_sync.connector.umapi.Commands)
+        :type commands: user_sync.connector.umapi.Commands
+        """
+        stream = self.command_streams.get(umapi_name)
+        if stream is not None:
+            stream.put(commands)
+        else:
+            command_list.append(commands)
+
+    def bulk_group_commands(self, command_list):
+        """
+        Turn per-user group changes into group-level member changes.  Only commands that make
+        nothing but group changes, for users that can be addressed by email, are considered.
+        A change to a group is only inverted when at least bulk_group_min_users users need it;
+        per-user commands are kept for everything else, including creates and removals.
+        :type command_list: list(user_sync.connector.umapi.Commands)
+        :rtype: list(user_sync.connector.umapi.Commands or user_sync.connector.umapi.GroupCommands)
+        """
+        # find the users that need each change, in command order
+        emails_by_change = defaultdict(list)
+        for commands in command_list:
+            if self.is_group_only_commands(commands):
+                for command_name, params in commands.do_list:
+                    for group in params['groups']:
+                        emails_by_change[(command_name, group)].append(commands.email)
+        min_users = self.options['bulk_group_min_users']
+        bulk_changes = set(change for change, emails in six.iteritems(emails_by_change) if len(emails) >= min_users)
+        if not bulk_changes:
+            return command_list
+
+        # take the bulk changes out of the per-user commands, dropping commands left empty
+        result = []
+        for commands in command_list:
+            if self.is_group_only_commands(commands):
+                do_list = []
+                for command_name, params in commands.do_list:
+                    groups = [group for group in params['groups'] if (command_name, group) not in bulk_changes]
+                    if groups:
+                        do_list.append((command_name, {'groups': groups}))
+                if not do_list:
+                    continue
+                commands.do_list = do_list
+            result.append(commands)
+
+        chunk_size = self.options['bulk_group_chunk_size']
+        for command_name, group in sorted(bulk_changes):
+            emails = emails_by_change[(command_name, group)]
+            self.logger.info('%s %d users %s group: %s', 'Adding' if command_name == 'add_to_groups' else 'Removing',
+                             len(emails), 'to' if command_name == 'add_to_groups' else 'from', group)
+            for start in range(0, len(emails), chunk_size):
+                group_commands = user_sync.connector.umapi.GroupCommands(group)
+                if command_name == 'add_to_groups':
+                    group_commands.add_users(emails[start:start + chunk_size])
+                else:
+                    group_commands.remove_users(emails[start:start + chunk_size])
+                result.append(group_commands)
+        return result
+
+    @staticmethod
+    def is_group_only_commands(commands):
+        """
+        Whether these are per-user commands that only add and remove named groups for
+        a user with an email address that is not an Adobe ID.  Group-level actions find
+        users by email, and prefer non-Adobe ID users when an email is ambiguous.
+        :type commands: user_sync.connector.umapi.Commands
+        :rtype: bool
+        """
+        if not isinstance(commands, user_sync.connector.umapi.Commands) or not commands.do_list:
+            return False
+        if not commands.email or commands.identity_type == user_sync.identity_type.ADOBEID_IDENTITY_TYPE:
+            return False
+        for command_name, params in commands.do_list:
+            if command_name not in ('add_to_groups', 'remove_from_groups') or 'groups' not in params:
+                return False
+        return True
+
+    def execute_secondary_commands(self, secondary_command_lists, umapi_connectors):
+        """
+        Send the commands for each secondary umapi.  In parallel mode, each secondary gets
+        its own worker, which sends all of its commands and waits for them to complete.
+        :type secondary_command_lists: dict(str, list(user_sync.connector.umapi.Commands))
+        :type umapi_connectors: UmapiConnectors
+        """
+        secondary_connectors = umapi_connectors.get_secondary_connectors()
+        secondary_workers = self.options['secondary_umapi_workers']
+        if secondary_workers <= 1 or len(secondary_command_lists) <= 1:
+            for umapi_name, command_list in secondary_command_lists.items():
+                self.execute_commands(command_list, secondary_connectors[umapi_name],
+                                      umapi_name in self.sync_started_umapi_names)
+            return
+
+        def execute(umapi_name, command_list):
+            connector = secondary_connectors[umapi_name]
+            self.execute_commands(command_list, connector, umapi_name in self.sync_started_umapi_names)
+            action_manager = connector.get_action_manager()
+            while action_manager.has_work():
+                action_manager.flush()
+
+        executor = ThreadPoolExecutor(secondary_workers)
+        try:
+            futures = [executor.submit(execute, umapi_name, command_list)
+                       for umapi_name, command_list in secondary_command_lists.items()]
+            for future in futures:
+                future.result()
+        finally:
+            executor.shutdown()
+
+    def execute_commands(self, command_list, connector, sync_started=False):
+        """
+        :type command_list: list(user_sync.connector.umapi.Commands)
+        :type connector: user_sync.connector.umapi.UmapiConnector
+        :param sync_started: whether the start sync signal was already sent while streaming commands
+        """
         # do nothing if we have no commands for this connector
         if not command_list:
             return
@@ -541,10 +1278,12 @@ class RuleProcessor(object):
 
         total_users = len(command_list)
 
-        # split off the last command if we have more than 10, so we can send the signals
-        if len(command_list) > 10:
+        # split off the last command if we have more than 10 (or the sync was already started),
+        # so we can send the signals
+        if command_list and (sync_started or len(command_list) > 10):
             command_list, last_command = command_list[0:-1], command_list[-1]
-            connector.start_sync()
+            if not sync_started:
+                connector.start_sync()
         else:
             last_command = None
 
@@ -598,12 +1337,11 @@ class RuleProcessor(object):
 
     def is_selected_user_key(self, user_key):
         """
-        :type user_key: str
+        :type user_key: UserKey
         """
         username_filter_regex = self.options['username_filter_regex']
         if username_filter_regex is not None:
-            username = self.get_username_from_user_key(user_key)
-            search_result = username_filter_regex.search(username)
+            search_result = username_filter_regex.search(user_key.username)
             if search_result is None:
                 return False
         return True
@@ -628,28 +1366,43 @@ class RuleProcessor(object):
     def process_strays(self, primary_commands, secondary_command_lists, umapi_connectors):
         """
         Do the top-level logic for stray processing (output to file or clean them up), enforce limits, etc.
-        The actual work is done in sub-functions that we call.
+        The actual work is done in sub-functions that we call.  Shards don't check the limit: the main
+        process checks it over the strays of all shards, and tells them whether it was exceeded.
         :param umapi_connectors:
         :return:
         """
-        stray_count = len(self.get_stray_keys())
         if self.stray_list_output_path:
             self.write_stray_key_map()
         if self.will_manage_strays:
-            max_missing_option = self.options['max_adobe_only_users']
-            if isinstance(max_missing_option, str) and '%' in max_missing_option:
-                percent = float(max_missing_option.strip('%')) / 100
-                max_missing = int((self.primary_user_count - self.excluded_user_count) * percent)
-            else:
-                max_missing = max_missing_option
-            if stray_count > max_missing:
-                self.logger.critical('Unable to process Adobe-only users, as their count (%s) is larger '
-                                     'than the max_adobe_only_users setting (%s)', stray_count, max_missing_option)
+            if self.shard_index is None:
+                self.check_stray_limit()
+            if self.stray_limit_exceeded:
                 self.action_summary['primary_strays_processed'] = 0
                 return [], {}
             self.logger.debug("Processing Adobe-only users...")
             return self.manage_strays(primary_commands, secondary_command_lists, umapi_connectors)
 
+    def check_stray_limit(self):
+        """
+        Check the count of Adobe-only users against the max_adobe_only_users setting,
+        and remember whether it was exceeded.
+        """
+        stray_count = len(self.get_stray_keys())
+        max_missing_option = self.options['max_adobe_only_users']
+        if isinstance(max_missing_option, str) and '%' in max_missing_option:
+            percent = float(max_missing_option.strip('%')) / 100
+            if self.incremental_user_keys is not None:
+                # an incremental sync only reads the changed users, so go by the users synced last time
+                max_missing = int(self.synced_user_count * percent)
+            else:
+                max_missing = int((self.primary_user_count - self.excluded_user_count) * percent)
+        else:
+            max_missing = max_missing_option
+        if stray_count > max_missing:
+            self.logger.critical('Unable to process Adobe-only users, as their count (%s) is larger '
+                                 'than the max_adobe_only_users setting (%s)', stray_count, max_missing_option)
+            self.stray_limit_exceeded = True
+
     def manage_strays(self, primary_commands, secondary_command_lists, umapi_connectors):
         """
         Manage strays.  This doesn't require having loaded users from the umapi.
@@ -674,7 +1427,7 @@ class RuleProcessor(object):
         # convenience function to get umapi Commands given a user key
         def get_commands(key):
             """Given a user key, returns the umapi commands targeting that user"""
-            id_type, username, domain = self.parse_user_key(key)
+            id_type, username, domain = key
             if '@' in username and username.lower() in self.email_override:
                 username = self.email_override[username.lower()]
             return user_sync.connector.umapi.Commands(identity_type=id_type, username=username, domain=domain)
@@ -933,20 +1686,26 @@ class RuleProcessor(object):
         # That way, any key/value pairs left in the map are the unmatched adobe users and their groups.
         user_to_group_map = umapi_info.get_desired_groups_by_user_key()
         user_to_group_map = {} if user_to_group_map is None else user_to_group_map.copy()
+        if self.incremental_user_keys is not None:
+            user_to_group_map = dict((user_key, groups) for user_key, groups in six.iteritems(user_to_group_map)
+                                     if user_key in self.incremental_user_keys)
 
         # compute all static options before looping over users
         in_primary_org = self.is_primary_org(umapi_info)
         update_user_info = self.will_update_user_info(umapi_info)
         process_groups = self.will_process_groups()
+        mapped_groups = umapi_info.get_mapped_groups_mask()
+        exclude_groups = umapi_info.get_groups_mask(self.exclude_groups) if in_primary_org else 0
 
         # prepare the strays map if we are going to be processing them
         if self.will_process_strays:
             self.add_stray(umapi_info.get_name(), None)
 
-        if self.options['adobe_group_filter'] is not None:
-            umapi_users = self.get_umapi_user_in_groups(umapi_info, umapi_connector, self.options['adobe_group_filter'])
+        prefetched_users = self.umapi_user_prefetch.pop(umapi_info.get_name(), None)
+        if prefetched_users is not None:
+            umapi_users = prefetched_users.result()
         else:
-            umapi_users = umapi_connector.iter_users()
+            umapi_users = self.iter_umapi_users(umapi_info, umapi_connector)
         # Walk all the adobe users, getting their group data, matching them with directory users,
         # and adjusting their attribute and group data accordingly.
         for umapi_user in umapi_users:
@@ -963,7 +1722,9 @@ class RuleProcessor(object):
             umapi_info.add_umapi_user(user_key, umapi_user)
             self.post_sync_data.update_umapi_data(None, user_key, [], [], **umapi_user)
             attribute_differences = {}
-            current_groups = self.normalize_groups(umapi_user.get('groups'))
+            # group memberships are bit masks over this umapi's mapped and excluded groups;
+            # group names are only produced for the users that need changes
+            current_groups = umapi_info.get_current_groups_mask(umapi_user.get('groups'))
             groups_to_add = set()
             groups_to_remove = set()
 
@@ -971,10 +1732,12 @@ class RuleProcessor(object):
             # map because we know they don't need to be created.
             # Also, keep track of the mapped groups for the directory user
             # so we can update the adobe user's groups as needed.
-            desired_groups = user_to_group_map.pop(user_key, None) or set()
+            desired_groups = umapi_info.get_groups_mask(user_to_group_map.pop(user_key, None) or EMPTY_GROUPS)
 
             # check for excluded users
-            if self.is_umapi_user_excluded(in_primary_org, user_key, current_groups):
+            excluded_groups = current_groups & exclude_groups
+            if self.is_umapi_user_excluded(in_primary_org, user_key,
+                                           umapi_info.get_group_names(excluded_groups) if excluded_groups else ()):
                 continue
 
             self.map_email_override(umapi_user)
@@ -989,8 +1752,8 @@ class RuleProcessor(object):
                     self.excluded_user_count += 1
                 elif self.will_process_strays:
                     self.logger.debug("Found Adobe-only user: %s", user_key)
-                    self.add_stray(umapi_info.get_name(), user_key,
-                                   None if not process_groups else current_groups & umapi_info.get_mapped_groups())
+                    self.add_stray(umapi_info.get_name(), user_key, None if not process_groups
+                                   else umapi_info.get_group_names(current_groups & mapped_groups))
             else:
                 # There is a selected directory user who matches this adobe user,
                 # so mark any changed umapi attributes,
@@ -1000,17 +1763,20 @@ class RuleProcessor(object):
                 if update_user_info:
                     attribute_differences = self.get_user_attribute_difference(directory_user, umapi_user)
                 if process_groups:
-                    groups_to_add = desired_groups - current_groups
-                    groups_to_remove = (current_groups - desired_groups) & umapi_info.get_mapped_groups()
+                    groups_to_add = umapi_info.get_group_names(desired_groups & ~current_groups)
+                    groups_to_remove = umapi_info.get_group_names(current_groups & ~desired_groups & mapped_groups)
 
             # Finally, execute the attribute and group adjustments
             # if we have nothing to update, omit this user
             if not attribute_differences and not groups_to_add and not groups_to_remove:
                 continue
-            command_list.append(self.update_umapi_user(umapi_info, user_key, attribute_differences,
-                                groups_to_add, groups_to_remove, umapi_user))
+            self.add_commands(umapi_info.get_name(), command_list,
+                              self.update_umapi_user(umapi_info, user_key, attribute_differences,
+                                                     groups_to_add, groups_to_remove, umapi_user))
         # mark the umapi's adobe users as processed and return the remaining ones in the map
         umapi_info.set_umapi_users_loaded()
+        if in_primary_org and self.shard_index is None:
+            self.user_exclusion_filter.log_exclusion_counts(self.logger)
         return (user_to_group_map, command_list)
 
     def map_email_override(self, umapi_user):
@@ -1033,24 +1799,22 @@ class RuleProcessor(object):
                 umapi_users_iters.append(umapi_connector.iter_users(in_group=group.get_group_name()))
         return chain.from_iterable(umapi_users_iters)
 
-    def is_umapi_user_excluded(self, in_primary_org, user_key, current_groups):
+    def is_umapi_user_excluded(self, in_primary_org, user_key, excluded_group_names):
+        """
+        :type in_primary_org: bool
+        :type user_key: UserKey
+        :param excluded_group_names: the user's groups that are excluded groups
+        :type excluded_group_names: set(str)
+        :rtype: bool
+        """
         if in_primary_org:
             self.primary_user_count += 1
             # in the primary umapi, we actually check the exclusion conditions
-            identity_type, username, domain = self.parse_user_key(user_key)
-            if identity_type in self.exclude_identity_types:
-                self.logger.debug("Excluding adobe user (due to type): %s", user_key)
+            rule = self.user_exclusion_filter.get_exclusion_rule(user_key, excluded_group_names)
+            if rule is not None:
+                self.logger.debug("Excluding adobe user (due to %s): %s", rule, user_key)
                 self.excluded_user_count += 1
                 return True
-            if len(current_groups & self.exclude_groups) > 0:
-                self.logger.debug("Excluding adobe user (due to group): %s", user_key)
-                self.excluded_user_count += 1
-                return True
-            for re_ in self.exclude_users:
-                if re_.match(username):
-                    self.logger.debug("Excluding adobe user (due to name): %s", user_key)
-                    self.excluded_user_count += 1
-                    return True
             self.included_user_keys.add(user_key)
             return False
         else:
@@ -1115,15 +1879,15 @@ class RuleProcessor(object):
     def get_user_key(self, id_type, username, domain, email=None):
         """
         Construct the user key for a directory or adobe user.
-        The user key is the stringification of the tuple (id_type, username, domain)
-        but the domain part is left empty if the username is an email address.
+        The user key is the tuple (id_type, username, domain), where the domain part
+        is left empty if the username is an email address.
         If the parameters are invalid, None is returned.
         :param username: (required) username of the user, can be his email
         :param domain: (optional) domain of the user
         :param email: (optional) email of the user
         :param id_type: (required) id_type of the user
-        :return: string "id_type,username,domain" (or None)
-        :rtype: str
+        :return: the user key for (id_type, username, domain) (or None)
+        :rtype: UserKey
         """
         id_type = user_sync.identity_type.parse_identity_type(id_type)
         email = normalize_string(email) if email else None
@@ -1138,7 +1902,7 @@ class RuleProcessor(object):
             domain = ""
         elif not domain:
             return None
-        return six.text_type(id_type) + u',' + six.text_type(username) + u',' + six.text_type(domain)
+        return UserKey.create(six.text_type(id_type), six.text_type(username), six.text_type(domain))
 
     def parse_user_key(self, user_key):
         """
@@ -1146,10 +1910,12 @@ class RuleProcessor(object):
         The domain part is empty except if the username is not an email address.
         :rtype: tuple
         """
-        return user_key.split(',')
+        if isinstance(user_key, UserKey):
+            return user_key
+        return UserKey.parse(user_key)
 
     def get_username_from_user_key(self, user_key):
-        return self.parse_user_key(user_key)[1]
+        return user_key.username
 
     def read_stray_key_map(self, file_path, delimiter=None):
         """
@@ -1206,7 +1972,7 @@ class RuleProcessor(object):
                 secondary_count += 1
         for umapi_name in self.stray_key_map:
             for user_key in self.get_stray_keys(umapi_name):
-                id_type, username, domain = self.parse_user_key(user_key)
+                id_type, username, domain = user_key
                 umapi = umapi_name if umapi_name else ""
                 if secondary_count:
                     row_dict = {'type': id_type, 'username': username, 'domain': domain, 'umapi': umapi}
@@ -1269,6 +2035,237 @@ class UmapiConnectors(object):
                 break
 
 
+def sync_shard(connection, log_queue, log_level, show_progress):
+    """
+    The entry point of a shard worker process.  The shard's processor, the umapi connectors and the shard's
+    umapi users are received from the main process, which is sent the results of matching the users.
+    The shard then waits to be told whether the max_adobe_only_users limit was exceeded over all shards,
+    before it processes its strays and sends its commands.
+    :type connection: multiprocessing.connection.Connection
+    :param log_queue: where the records logged in the worker are sent, for the main process to handle
+    :type log_queue: multiprocessing.Queue
+    :type log_level: int
+    :type show_progress: bool
+    """
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    # progress is logged without checking the level of the logger, so the handler checks it
+    log_handler = logging.handlers.QueueHandler(log_queue)
+    log_handler.setLevel(log_level)
+    root_logger.addHandler(log_handler)
+    root_logger.setLevel(log_level)
+    logging.Logger.progress = log_progress
+    logging.Logger.show_progress = show_progress
+    try:
+        rule_processor, umapi_connectors, umapi_users_by_name = connection.recv()
+        primary_commands, secondary_command_lists = rule_processor.sync_shard_users(umapi_connectors,
+                                                                                    umapi_users_by_name)
+        connection.send(rule_processor.get_shard_matches())
+        rule_processor.stray_limit_exceeded = connection.recv()
+        rule_processor.execute_sync_commands(primary_commands, secondary_command_lists, umapi_connectors)
+        umapi_connectors.execute_actions()
+        connection.send(rule_processor.get_shard_executions(umapi_connectors))
+    except EOFError:
+        # the main process gave up on the sync
+        pass
+    except Exception as e:
+        root_logger.exception('Shard failed')
+        try:
+            connection.send({'error': '%s: %s' % (type(e).__name__, e)})
+        except (EOFError, OSError):
+            pass
+    finally:
+        connection.close()
+
+
+class CommandStream(object):
+    """
+    Sends commands to a umapi connector from a background thread, while the rule processor
+    is still producing them.  The queue between the two is bounded, so a slow server holds
+    back the producer instead of letting commands pile up in memory.  The last command is
+    held back, so the caller can send it after the end sync signal.
+    """
+    end_of_stream = object()
+
+    def __init__(self, connector, queue_size):
+        """
+        :type connector: user_sync.connector.umapi.UmapiConnector
+        :type queue_size: int
+        """
+        self.connector = connector
+        self.queue = Queue(queue_size)
+        self.held_commands = None
+        self.sent_count = 0
+        self.error = None
+        self.thread = threading.Thread(target=self.send_commands, name='stream-' + connector.name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, commands):
+        """
+        :type commands: user_sync.connector.umapi.Commands
+        """
+        if self.error is not None:
+            raise self.error
+        # Instead of a Commands object, we might get None: this can happen if country code is invalid
+        if commands is not None:
+            self.queue.put(commands)
+
+    def send_commands(self):
+        try:
+            while True:
+                commands = self.queue.get()
+                if commands is self.end_of_stream:
+                    return
+                if self.held_commands is not None:
+                    if self.sent_count == 0:
+                        self.connector.start_sync()
+                    self.connector.send_commands(self.held_commands)
+                    self.sent_count += 1
+                self.held_commands = commands
+        except Exception as e:
+            self.error = e
+            # keep draining, so the producer never blocks on a full queue
+            while self.queue.get() is not self.end_of_stream:
+                pass
+
+    def close(self):
+        """
+        Wait for all but the last of the commands to be sent.
+        :return: the held back commands, if any
+        """
+        self.queue.put(self.end_of_stream)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.held_commands
+
+
+class UserExclusionFilter(object):
+    """
+    The rules that exclude adobe users from updates, compiled into a single check.  Identity types
+    are looked up in a set, and the exclude_users patterns are merged into one regex whose named
+    alternatives tell which pattern matched.  Patterns that refer to their own groups by number
+    or name can't be merged, so in that case they are tried one at a time, as are patterns
+    compiled with different flags.  The number of users excluded by each rule is counted.
+    """
+    group_reference_regex = re.compile(r'\\[1-9]|\(\?P=|\(\?\(')
+
+    def __init__(self, exclude_identity_types=(), exclude_users=()):
+        """
+        :type exclude_identity_types: list(str)
+        :param exclude_users: the compiled patterns for usernames to exclude
+        :type exclude_users: list(re.Pattern)
+        """
+        self.exclude_identity_types = frozenset(exclude_identity_types)
+        self.exclude_users = list(exclude_users)
+        self.exclude_users_regex = self.merge_regexes(self.exclude_users)
+        self.exclusion_counts = defaultdict(int)
+
+    @classmethod
+    def merge_regexes(cls, regexes):
+        """
+        :type regexes: list(re.Pattern)
+        :return: one regex with an alternative named r<index> for each regex, or None if they can't be merged
+        :rtype: re.Pattern
+        """
+        if not regexes or len(set(regex.flags for regex in regexes)) > 1:
+            return None
+        if any(cls.group_reference_regex.search(regex.pattern) for regex in regexes):
+            return None
+        try:
+            return re.compile('|'.join('(?P<r%d>%s)' % (index, regex.pattern) for index, regex in enumerate(regexes)),
+                              regexes[0].flags)
+        except re.error:
+            return None
+
+    def get_exclusion_rule(self, user_key, excluded_group_names=()):
+        """
+        :type user_key: UserKey
+        :param excluded_group_names: the user's groups that are excluded groups
+        :type excluded_group_names: set(str)
+        :return: a description of the rule that excludes the user, or None if the user is not excluded
+        :rtype: str
+        """
+        identity_type, username, _ = user_key
+        if identity_type in self.exclude_identity_types:
+            rule = 'type: %s' % identity_type
+        elif excluded_group_names:
+            rule = 'group: %s' % min(excluded_group_names)
+        else:
+            regex = self.match_username(username)
+            if regex is None:
+                return None
+            rule = 'name: %s' % regex.pattern
+        self.exclusion_counts[rule] += 1
+        return rule
+
+    def match_username(self, username):
+        """
+        :type username: str
+        :return: the first exclude_users pattern that matches the username, if any
+        :rtype: re.Pattern
+        """
+        if self.exclude_users_regex is not None:
+            match = self.exclude_users_regex.match(username)
+            return None if match is None else self.exclude_users[int(match.lastgroup[1:])]
+        for regex in self.exclude_users:
+            if regex.match(username):
+                return regex
+        return None
+
+    def create_shard(self):
+        """
+        A copy of this filter with its own exclusion counts, for a shard of the users
+        :rtype: UserExclusionFilter
+        """
+        shard = copy.copy(self)
+        shard.exclusion_counts = defaultdict(int)
+        return shard
+
+    def log_exclusion_counts(self, logger):
+        for rule, count in sorted(six.iteritems(self.exclusion_counts)):
+            logger.info('Adobe users excluded due to %s: %d', rule, count)
+
+
+class UserKey(namedtuple('UserKey', ['identity_type', 'username', 'domain'])):
+    """
+    The key that identifies a user on both sides of the sync.  Its parts are already
+    normalized, and equal keys are interned so they share a single instance.
+    The string form is "id_type,username,domain", as written to the stray list.
+    """
+    __slots__ = ()
+    index_map = {}
+
+    def __str__(self):
+        return u','.join(self)
+
+    def __reduce__(self):
+        # keys sent to and from shard processes are interned again when they arrive
+        return UserKey.create, tuple(self)
+
+    @classmethod
+    def create(cls, identity_type, username, domain):
+        """
+        :type identity_type: str
+        :type username: str
+        :type domain: str
+        :rtype: UserKey
+        """
+        user_key = cls(identity_type, username, domain)
+        return cls.index_map.setdefault(user_key, user_key)
+
+    @classmethod
+    def parse(cls, user_key):
+        """
+        Convert the string form of a user key back into a user key.
+        :type user_key: str
+        :rtype: UserKey
+        """
+        return cls.create(*user_key.split(','))
+
+
 class AdobeGroup(object):
     index_map = {}
 
@@ -1339,6 +2336,52 @@ class AdobeGroup(object):
         return six.itervalues(cls.index_map)
 
 
+class GroupMappingIndex(object):
+    """
+    The group mappings, resolved once: each directory group maps to the normalized names of the
+    Adobe groups it targets in each umapi.  Users with the same directory groups share the result,
+    and equal group sets are shared as a single frozenset.
+    """
+
+    def __init__(self, mappings):
+        """
+        :type mappings: dict(str, list(AdobeGroup))
+        """
+        self.targets_by_directory_group = {}
+        for directory_group, adobe_groups in six.iteritems(mappings):
+            self.targets_by_directory_group[directory_group] = [
+                (adobe_group.get_umapi_name(), normalize_string(adobe_group.get_group_name()))
+                for adobe_group in adobe_groups]
+        self.resolved_by_directory_groups = {}
+        self.group_sets = {}
+
+    def resolve(self, directory_groups):
+        """
+        :type directory_groups: list(str)
+        :return: the umapi names targeted by the directory groups, each with its desired groups
+        :rtype: tuple(tuple(str, frozenset(str)))
+        """
+        key = tuple(directory_groups)
+        resolved = self.resolved_by_directory_groups.get(key)
+        if resolved is None:
+            groups_by_umapi_name = defaultdict(set)
+            for directory_group in directory_groups:
+                for umapi_name, group_name in self.targets_by_directory_group.get(directory_group, ()):
+                    groups_by_umapi_name[umapi_name].add(group_name)
+            resolved = tuple((umapi_name, self.intern_groups(groups))
+                             for umapi_name, groups in six.iteritems(groups_by_umapi_name))
+            self.resolved_by_directory_groups[key] = resolved
+        return resolved
+
+    def intern_groups(self, groups):
+        """
+        :type groups: set(str)
+        :rtype: frozenset(str)
+        """
+        groups = frozenset(groups)
+        return self.group_sets.setdefault(groups, groups)
+
+
 class UmapiTargetInfo(object):
     def __init__(self, name):
         """
@@ -1347,6 +2390,14 @@ class UmapiTargetInfo(object):
         self.name = name
         self.mapped_groups = set()
         self.non_normalize_mapped_groups = set()
+
+        # each group of interest (mapped or excluded) gets a bit, so group memberships can be int masks.
+        # Masks of shared desired group sets are cached, as are the normalized forms of raw group names.
+        self.group_bits = {}
+        self.group_names = []
+        self.mapped_groups_mask = 0
+        self.masks_by_groups = {}
+        self.normalized_group_names = {}
         self.desired_groups_by_user_key = {}
         self.umapi_user_by_user_key = {}
         self.umapi_users_loaded = False
@@ -1361,6 +2412,17 @@ class UmapiTargetInfo(object):
     def get_name(self):
         return self.name
 
+    def create_shard(self):
+        """
+        A copy of this target with the same groups but none of the users, for a shard of the users
+        :rtype: UmapiTargetInfo
+        """
+        shard = copy.copy(self)
+        shard.desired_groups_by_user_key = {}
+        shard.umapi_user_by_user_key = {}
+        shard.umapi_users_loaded = False
+        return shard
+
     def add_mapped_group(self, group):
         """
         :type group: str
@@ -1368,6 +2430,7 @@ class UmapiTargetInfo(object):
         normalized_group_name = normalize_string(group)
         self.mapped_groups.add(normalized_group_name)
         self.non_normalize_mapped_groups.add(group)
+        self.mapped_groups_mask |= self.get_group_bit(normalized_group_name)
 
     def add_additional_group(self, rename_group, member_group):
         normalized_rename_group = normalize_string(rename_group)
@@ -1380,6 +2443,63 @@ class UmapiTargetInfo(object):
     def get_mapped_groups(self):
         return self.mapped_groups
 
+    def get_mapped_groups_mask(self):
+        return self.mapped_groups_mask
+
+    def get_group_bit(self, group):
+        """
+        The bit for a group, which is assigned the first time the group is seen
+        :type group: str
+        :rtype: int
+        """
+        bit = self.group_bits.get(group)
+        if bit is None:
+            bit = self.group_bits[group] = 1 << len(self.group_names)
+            self.group_names.append(group)
+        return bit
+
+    def get_groups_mask(self, groups):
+        """
+        :type groups: set(str) or frozenset(str)
+        :rtype: int
+        """
+        mask = self.masks_by_groups.get(groups) if isinstance(groups, frozenset) else None
+        if mask is None:
+            mask = 0
+            for group in groups:
+                mask |= self.get_group_bit(group)
+            if isinstance(groups, frozenset):
+                self.masks_by_groups[groups] = mask
+        return mask
+
+    def get_current_groups_mask(self, group_names):
+        """
+        The mask for the groups of an adobe user.  Names are not normalized yet, and
+        groups that are neither mapped nor excluded are left out.
+        :type group_names: list(str)
+        :rtype: int
+        """
+        mask = 0
+        if group_names is not None:
+            for group_name in group_names:
+                normalized_group_name = self.normalized_group_names.get(group_name)
+                if normalized_group_name is None:
+                    normalized_group_name = self.normalized_group_names[group_name] = normalize_string(group_name)
+                mask |= self.group_bits.get(normalized_group_name, 0)
+        return mask
+
+    def get_group_names(self, mask):
+        """
+        :type mask: int
+        :rtype: set(str)
+        """
+        group_names = set()
+        while mask:
+            bit = mask & -mask
+            group_names.add(self.group_names[bit.bit_length() - 1])
+            mask ^= bit
+        return group_names
+
     def get_non_normalize_mapped_groups(self):
         return self.non_normalize_mapped_groups
 
@@ -1395,15 +2515,26 @@ class UmapiTargetInfo(object):
 
     def add_desired_group_for(self, user_key, group):
         """
-        :type user_key: str
+        Desired group sets are shared between users, so they are replaced rather than changed.
+        :type user_key: UserKey
         :type group: Optional(str)
         """
         desired_groups = self.get_desired_groups(user_key)
-        if desired_groups is None:
-            self.desired_groups_by_user_key[user_key] = desired_groups = set()
         if group is not None:
             normalized_group_name = normalize_string(group)
-            desired_groups.add(normalized_group_name)
+            if desired_groups is None or normalized_group_name not in desired_groups:
+                self.desired_groups_by_user_key[user_key] = (desired_groups or EMPTY_GROUPS) | {normalized_group_name}
+        elif desired_groups is None:
+            self.desired_groups_by_user_key[user_key] = EMPTY_GROUPS
+
+    def set_desired_groups(self, user_key, groups):
+        """
+        Add already normalized groups, which may be shared with other users, to the desired groups for the user.
+        :type user_key: UserKey
+        :type groups: frozenset(str)
+        """
+        desired_groups = self.get_desired_groups(user_key)
+        self.desired_groups_by_user_key[user_key] = groups if not desired_groups else desired_groups | groups
 
     def add_umapi_user(self, user_key, user):
         """
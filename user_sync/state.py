@@ -0,0 +1,150 @@
+# Copyright (c) 2016-2017 Adobe Inc.  All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json
+import sqlite3
+
+import six
+
+from user_sync.error import AssertionException
+
+
+class StateStore(object):
+    """
+    A SQLite file that keeps what User Sync needs to remember between runs, with a table of named settings.
+    Subclasses create their own tables in create_tables.
+    """
+
+    def __init__(self, path):
+        """
+        :type path: str
+        """
+        self.path = path
+        try:
+            self.connection = sqlite3.connect(path)
+            with self.connection:
+                self.create_tables()
+                self.connection.execute('CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT)')
+        except sqlite3.Error as e:
+            raise AssertionException("Unable to open sync state file '%s': %s" % (path, e))
+
+    def create_tables(self):
+        pass
+
+    def get_setting(self, name):
+        """
+        :type name: str
+        :rtype: str
+        """
+        row = self.connection.execute('SELECT value FROM settings WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else None
+
+    def set_setting(self, name, value):
+        """
+        :type name: str
+        :type value: str
+        """
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO settings (name, value) VALUES (?, ?)', (name, value))
+
+    def close(self):
+        self.connection.close()
+
+
+class SyncStateStore(StateStore):
+    """
+    Remembers, between runs, what each directory user looked like the last time it was synced.
+    Each user key is stored with the user's email and a fingerprint of the attributes and groups
+    that were synced, so an incremental run only has to look at the users whose fingerprint changed.
+    """
+
+    def create_tables(self):
+        self.connection.execute('CREATE TABLE IF NOT EXISTS users '
+                                '(user_key TEXT PRIMARY KEY, email TEXT, fingerprint TEXT)')
+
+    def get_users(self):
+        """
+        The stored users, as a map from user key to (email, fingerprint)
+        :rtype: dict(str, tuple(str, str))
+        """
+        rows = self.connection.execute('SELECT user_key, email, fingerprint FROM users')
+        return dict((user_key, (email, fingerprint)) for user_key, email, fingerprint in rows)
+
+    def update_users(self, users, removed_user_keys=(), replace=False):
+        """
+        Store the given users, and forget the removed ones.  If replace is True,
+        every user not given is forgotten.  All changes are made in one transaction.
+        :param users: map from user key to (email, fingerprint); keys are stored in their string form
+        :type users: dict(str, tuple(str, str))
+        :type removed_user_keys: iterable(str)
+        :type replace: bool
+        """
+        with self.connection:
+            if replace:
+                self.connection.execute('DELETE FROM users')
+            self.connection.executemany('DELETE FROM users WHERE user_key = ?',
+                                        ((six.text_type(user_key),) for user_key in removed_user_keys))
+            self.connection.executemany('INSERT OR REPLACE INTO users (user_key, email, fingerprint) VALUES (?, ?, ?)',
+                                        ((six.text_type(user_key), email, fingerprint)
+                                         for user_key, (email, fingerprint) in users.items()))
+
+
+class DirectorySnapshotStore(StateStore):
+    """
+    A copy of the directory entries of the users, kept by a directory connector so that a later run
+    only has to read the entries that changed.  Each entry is stored by DN, with its attributes in JSON.
+    """
+
+    def create_tables(self):
+        self.connection.execute('CREATE TABLE IF NOT EXISTS entries (dn TEXT PRIMARY KEY, attributes TEXT)')
+
+    def get_entries(self):
+        """
+        :return: the attributes of each entry, by DN
+        :rtype: dict(str, dict)
+        """
+        rows = self.connection.execute('SELECT dn, attributes FROM entries')
+        return dict((dn, json.loads(attributes)) for dn, attributes in rows)
+
+    def update_entries(self, entries, removed_dns=(), replace=False):
+        """
+        Store the given entries, and forget the removed ones.  If replace is True,
+        every entry not given is forgotten.  All changes are made in one transaction.
+        :param entries: the attributes of each entry, by DN, as returned by encode_entry
+        :type entries: dict(str, dict)
+        :type removed_dns: iterable(str)
+        :type replace: bool
+        """
+        with self.connection:
+            if replace:
+                self.connection.execute('DELETE FROM entries')
+            self.connection.executemany('DELETE FROM entries WHERE dn = ?', ((dn,) for dn in removed_dns))
+            self.connection.executemany('INSERT OR REPLACE INTO entries (dn, attributes) VALUES (?, ?)',
+                                        ((dn, json.dumps(attributes)) for dn, attributes in six.iteritems(entries)))
+
+    @staticmethod
+    def encode_entry(attributes):
+        """
+        The attributes of an entry as they are stored, and read back: values that JSON
+        can't hold, like dates, are kept as strings.
+        :type attributes: dict
+        :rtype: dict
+        """
+        return json.loads(json.dumps(attributes, default=six.text_type))